@@ -38,12 +38,13 @@ setup(name='explosive.fuse',
       install_requires=[
           'setuptools',
           # -*- Extra requirements: -*-
-          'fusepy',
+          'fusepy>=3.0',
       ],
       test_suite="tests",
       entry_points="""
       # -*- Entry points: -*-
       [console_scripts]
       explode = explosive.fuse.ctrl:main
+      explode-index = explosive.fuse.ctrl:index_main
       """,
       )
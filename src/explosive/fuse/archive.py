@@ -1,6 +1,17 @@
+import mmap
+import os
 import os.path
+import struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import getLogger
+from threading import Lock
 
 from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from zipfile import sizeFileHeader
+from zipfile import structFileHeader
 try:
     from zipfile import BadZipFile
     FileNotFoundError = FileNotFoundError  # pragma: no cover
@@ -14,7 +25,20 @@ from ._rarfile import BadRarFile
 
 from .exception import BadArchiveFile
 from .exception import UnsupportedArchiveFile
+from .reader import DeflateReader
+from .reader import pread
+from .reader import StoredReader
+from .reader import StreamReader
 
+logger = getLogger(__name__)
+
+# Default number of parsed archives kept open by the pool.
+ARCHIVE_POOL_SIZE = 64
+
+# Magic number and field indexes of a zip local file header.
+_FH_SIGNATURE = b'PK\003\004'
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
 
 # Lookup table for archive filename extension to its respective class.
 _archive_lookup = {
@@ -28,7 +52,29 @@ class ArchiveFile(object):
     Generic archive file implementation.
     """
 
-    def __init__(self, archive_filename):
+    def __init__(self, archive_filename, use_mmap=False):
+        self.archive_filename = archive_filename
+        # zip archives may be memory-mapped, such that reads of their
+        # contents are done by slicing the view of the map.
+        self.use_mmap = use_mmap
+        self.map = None
+        self.map_stat = None
+        self.view = None
+        # data offsets of zip entries resolved from their local headers.
+        self.data_offsets = {}
+        # number of references held by readers and the pool; the
+        # archive file only gets closed once all of them are released.
+        self.refs = 0
+        self.closing = False
+        self._lock = Lock()
+        self.archive_file = self._open(archive_filename)
+        # serializes the seek and read on the shared file object where
+        # positional reads are not available, with the lock the streams
+        # of the zip archive take around theirs where there is one.
+        self._read_lock = getattr(self.archive_file, '_lock', None) or Lock()
+        self.identity = self._identity()
+
+    def _open(self, archive_filename):
         archive_type = archive_filename.rsplit('.', 1)[-1]
         archive_class = _archive_lookup.get(archive_type)
         if archive_class is None:
@@ -37,14 +83,14 @@ class ArchiveFile(object):
             # various file formats that bundle stuff together (such as
             # .odt or .docx).
             try:
-                self.archive_file = ZipFile(archive_filename)
+                return self._open_zip(archive_filename)
             except Exception:
                 raise UnsupportedArchiveFile('unsupported archive format.')
-            else:
-                return
 
         try:
-            self.archive_file = archive_class(archive_filename)
+            if archive_class is ZipFile:
+                return self._open_zip(archive_filename)
+            return archive_class(archive_filename)
         except BadZipFile:
             raise BadArchiveFile()
         except BadRarFile:
@@ -59,6 +105,39 @@ class ArchiveFile(object):
         except Exception:  # pragma: no cover
             raise
 
+    def _open_zip(self, archive_filename):
+        if not self.use_mmap:
+            return ZipFile(archive_filename)
+
+        with open(archive_filename, 'rb') as fd:
+            st = os.fstat(fd.fileno())
+            if not st.st_size:
+                # empty files cannot be mapped.
+                return ZipFile(archive_filename)
+            archive_map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            archive_file = ZipFile(archive_map)
+        except Exception:
+            archive_map.close()
+            raise
+        self.map = archive_map
+        self.map_stat = st
+        self.view = map_view(archive_map)
+        return archive_file
+
+    def _close(self):
+        self.archive_file.close()
+        if self.map is None:
+            return
+        if isinstance(self.view, memoryview):
+            self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # slices of the map are still around; it gets unmapped once
+            # these are gone.
+            logger.debug('`%s` remains mapped', self.archive_filename)
+
     def __enter__(self):
         return self
 
@@ -66,10 +145,277 @@ class ArchiveFile(object):
         self.close()
 
     def close(self):
-        self.archive_file.close()
+        """
+        Close the archive file once it is no longer referenced.
+        """
+
+        with self._lock:
+            self.closing = True
+            if self.refs > 0:
+                return
+        self._close()
+
+    def acquire(self):
+        with self._lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0 or not self.closing:
+                return
+        self._close()
+
+    def fileno(self):
+        return self.archive_file.fp.fileno()
+
+    def read_at(self, size, offset):
+        """
+        Read up to size bytes at offset from the archive file.
+        """
+
+        fp = self.archive_file.fp
+        with self._read_lock:
+            fp.seek(offset)
+            return fp.read(size)
+
+    def _identity(self):
+        fp = getattr(self.archive_file, 'fp', None)
+        if self.map_stat is not None:
+            st = self.map_stat
+        elif fp:
+            st = os.fstat(fp.fileno())
+        else:
+            st = os.stat(self.archive_filename)
+        return (self.archive_filename,) + _stat_identity(st)
+
+    def stale(self):
+        """
+        Whether the file at the location of the archive has been changed
+        or replaced since the archive was opened.
+        """
+
+        try:
+            st = os.stat(self.archive_filename)
+        except OSError:
+            return True
+        return self.identity[1:] != _stat_identity(st)
 
     def infolist(self):
         return self.archive_file.infolist()
 
     def open(self, *a, **kw):
         return self.archive_file.open(*a, **kw)
+
+    def data_offset(self, info):
+        """
+        Return the cached data offset of the zip entry described by
+        info, resolving it from the archive if not already cached.
+        """
+
+        offset = self.data_offsets.get(info.filename)
+        if offset is None:
+            offset = self.data_offsets[info.filename] = zip_data_offset(
+                self, info)
+        return offset
+
+    def entry_key(self, name, info=None):
+        """
+        Return the key identifying the contents of the entry, for these
+        to be cached by, which changes once the archive is replaced.
+        """
+
+        if info is None:
+            info = self.archive_file.getinfo(name)
+        # the crc and size guard against the contents changing without
+        # the identity of the archive changing.
+        return (
+            self.identity, name, getattr(info, 'CRC', None), info.file_size)
+
+    def open_reader(self, name, checkpoints=None):
+        """
+        Return a positional reader for the entry identified by name.
+        Zip entries that are stored are read directly from the archive,
+        deflated entries are inflated directly from the archive with
+        checkpoints recorded into the checkpoints store, while all other
+        entries are read through the sequential stream of the archive.
+        The reader holds a reference to this archive until it's closed.
+        """
+
+        info = self.archive_file.getinfo(name)
+        key = self.entry_key(name, info)
+        if (isinstance(self.archive_file, ZipFile) and
+                info.compress_type in (ZIP_STORED, ZIP_DEFLATED) and
+                not info.flag_bits & 0x1):
+            data_offset = self.data_offset(info)
+            if info.compress_type == ZIP_STORED:
+                return StoredReader(
+                    ArchiveHandle(self), data_offset, info.file_size, key,
+                    info.CRC)
+            return DeflateReader(
+                ArchiveHandle(self), data_offset, info.compress_size,
+                info.file_size, key, checkpoints, info.CRC)
+
+        handle = ArchiveHandle(self)
+        try:
+            return StreamReader(
+                lambda: self.archive_file.open(name), info.file_size, key,
+                handle)
+        except Exception:
+            handle.close()
+            raise
+
+
+def map_view(archive_map):
+    """
+    Return a view of the map, for slices of it to be taken without
+    copying, or the map itself where it cannot be viewed (Python 2), as
+    slices of that are copies.
+    """
+
+    try:
+        return memoryview(archive_map)
+    except TypeError:
+        return archive_map
+
+
+class ArchiveHandle(object):
+    """
+    A reference to an archive file held by a reader, which provides the
+    file descriptor (or the view of the map) of the archive for
+    positional reads, or a position of its own to seek and read from
+    where those are not available.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive.acquire()
+        self.closed = False
+        self.pos = 0
+
+    def fileno(self):
+        return self.archive.fileno()
+
+    def seek(self, offset):
+        self.pos = offset
+
+    def read(self, size):
+        data = self.archive.read_at(size, self.pos)
+        self.pos += len(data)
+        return data
+
+    @property
+    def view(self):
+        return self.archive.view
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.archive.release()
+
+
+class ArchivePool(object):
+    """
+    A pool of parsed archive files keyed by their paths, so that entries
+    can be opened without reopening and parsing the archive every time.
+    Up to size archives are kept open, with the least recently used
+    archive closed once that is exceeded, though an archive still in use
+    by a reader is only closed after the reader is closed.  An archive
+    is reopened if the file at its path has changed since it was opened.
+    Zip archives are memory-mapped if use_mmap is set, and the data
+    offsets of their entries are taken from the index if one is provided.
+    """
+
+    def __init__(self, size=ARCHIVE_POOL_SIZE, use_mmap=False, index=None):
+        self.size = size
+        self.use_mmap = use_mmap
+        self.index = index
+        self.archives = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.archives)
+
+    def acquire(self, archive_path):
+        """
+        Return the parsed archive file for archive_path with a reference
+        acquired, which must be released when done.
+        """
+
+        with self.lock:
+            archive = self.archives.pop(archive_path, None)
+            if archive is not None and not archive.stale():
+                self.archives[archive_path] = archive
+                return archive.acquire()
+
+        if archive is not None:
+            logger.info('`%s` changed since it was opened', archive_path)
+            archive.close()
+
+        # parse outside of the lock so other archives remain available.
+        archive = ArchiveFile(archive_path, use_mmap=self.use_mmap)
+        if self.index is not None:
+            archive.data_offsets.update(self.index.data_offsets(archive_path))
+        with self.lock:
+            current = self.archives.pop(archive_path, None)
+            if current is not None:
+                current.close()
+            self.archives[archive_path] = archive
+            archive.acquire()
+            while len(self.archives) > self.size:
+                key, oldest = self.archives.popitem(last=False)
+                oldest.close()
+        return archive
+
+    @contextmanager
+    def archive(self, archive_path):
+        """
+        Context manager for the pooled archive file for archive_path.
+        """
+
+        archive = self.acquire(archive_path)
+        try:
+            yield archive
+        finally:
+            archive.release()
+
+    def discard(self, archive_path):
+        with self.lock:
+            archive = self.archives.pop(archive_path, None)
+        if archive is not None:
+            archive.close()
+
+    def close(self):
+        with self.lock:
+            archives = list(self.archives.values())
+            self.archives.clear()
+        for archive in archives:
+            archive.close()
+
+
+def _stat_identity(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+def archive_identity(archive_filename):
+    """
+    Return the identity of the archive file, which changes whenever the
+    file at that location is replaced or modified.
+    """
+
+    st = os.stat(archive_filename)
+    return (archive_filename,) + _stat_identity(st)
+
+
+def zip_data_offset(fp, info):
+    """
+    Return the offset to the data of the zip entry described by info, as
+    resolved from its local file header.
+    """
+
+    header = pread(fp, sizeFileHeader, info.header_offset)
+    if len(header) != sizeFileHeader or header[:4] != _FH_SIGNATURE:
+        raise BadArchiveFile('bad local file header')
+    fheader = struct.unpack(structFileHeader, header)
+    return (info.header_offset + sizeFileHeader +
+            fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH])
@@ -0,0 +1,374 @@
+"""
+Caches for decompressed data shared across all open handles.
+"""
+
+import errno
+import os
+import re
+from collections import OrderedDict
+from hashlib import sha1
+from logging import getLogger
+from tempfile import mkstemp
+from threading import Lock
+
+from .reader import EntryReader
+from .reader import pread
+
+logger = getLogger(__name__)
+
+# Size of each decompressed block held by the block cache.
+BLOCK_CACHE_BLOCK_SIZE = 1 << 17
+# Default total size of all blocks held by the block cache.
+BLOCK_CACHE_BUDGET = 1 << 26
+# Entries up to this size are held whole by the entry cache.
+ENTRY_CACHE_THRESHOLD = 1 << 16
+# Default total size of all entries held by the entry cache.
+ENTRY_CACHE_BUDGET = 1 << 24
+# Size of each decompressed chunk persisted by the disk cache.
+DISK_CACHE_CHUNK_SIZE = 1 << 20
+# Default total size of all chunks persisted by the disk cache.
+DISK_CACHE_BUDGET = 1 << 30
+# Prefix of the chunk files that are still being written.
+DISK_CACHE_TEMP_PREFIX = '.tmp'
+# Names of the chunk files, and of those still being written, such that
+# any other file within the directory is left alone.
+_CHUNK_NAME = re.compile(r'^[0-9a-f]{40}$')
+_CHUNK_TEMP_NAME = re.compile(
+    r'^' + re.escape(DISK_CACHE_TEMP_PREFIX) + r'.*-[0-9a-f]{40}$')
+
+
+class LRUCache(object):
+    """
+    A cache of byte strings, with the least recently used ones evicted
+    once their total size exceeds the budget.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.items[key] = item
+            return item
+
+    def put(self, key, item):
+        if len(item) > self.budget:
+            return
+        with self.lock:
+            self._discard(key)
+            self.items[key] = item
+            self.used += len(item)
+            while self.used > self.budget:
+                key, item = self.items.popitem(last=False)
+                self.used -= len(item)
+
+    def _discard(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.used -= len(item)
+
+    def discard(self, key):
+        with self.lock:
+            self._discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.used = 0
+
+    def stats(self):
+        return {
+            'used': self.used,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class BlockCache(LRUCache):
+    """
+    A cache of fixed-size decompressed blocks, keyed by the key of the
+    reader (which identifies the archive and the entry) along with the
+    index of the block, with least recently used blocks evicted once
+    the total size of the blocks exceeds the budget.
+    """
+
+    def __init__(self, budget=BLOCK_CACHE_BUDGET,
+            block_size=BLOCK_CACHE_BLOCK_SIZE):
+        super(BlockCache, self).__init__(budget)
+        self.block_size = block_size
+
+    @property
+    def blocks(self):
+        return self.items
+
+    def stats(self):
+        result = super(BlockCache, self).stats()
+        result['blocks'] = len(self.items)
+        return result
+
+    def pread(self, reader, size, offset):
+        """
+        Read up to size bytes at offset from the entry provided by the
+        reader, filling the request from the cached blocks where
+        possible and only falling back to the reader for the rest.
+        """
+
+        if not reader.cacheable or reader.key is None or not self.budget:
+            return reader.pread(size, offset)
+
+        end = min(offset + size, reader.size)
+        if offset >= end:
+            return b''
+
+        block_size = self.block_size
+        result = []
+        for index in range(offset // block_size, (end - 1) // block_size + 1):
+            key = (reader.key, index)
+            block = self.get(key)
+            start = index * block_size
+            if block is None:
+                block = reader.pread(block_size, start)
+                self.put(key, block)
+            result.append(block[max(offset - start, 0):end - start])
+        if len(result) == 1:
+            return result[0]
+        return b''.join(result)
+
+
+class EntryCache(LRUCache):
+    """
+    A cache of the complete decompressed contents of small entries,
+    keyed as the readers are by the identity of the archive along with
+    the name, CRC and size of the entry, such that repeated reads of
+    these are served from memory without decompressing them again.
+    Only entries no larger than the threshold are admitted, and a
+    threshold of 0 admits none.
+    """
+
+    def __init__(self, budget=ENTRY_CACHE_BUDGET,
+            threshold=ENTRY_CACHE_THRESHOLD):
+        super(EntryCache, self).__init__(budget)
+        self.threshold = threshold
+
+    def admits(self, size):
+        return 0 < self.threshold and size <= min(self.threshold, self.budget)
+
+    def discard_archive(self, archive_path):
+        """
+        Discard the entries that originate from the archive.
+        """
+
+        with self.lock:
+            for key in [
+                    k for k in self.items if k[0][0] == archive_path]:
+                self._discard(key)
+
+    def stats(self):
+        result = super(EntryCache, self).stats()
+        result['entries'] = len(self.items)
+        result['threshold'] = self.threshold
+        return result
+
+
+class DiskCache(object):
+    """
+    A cache of fixed-size decompressed chunks persisted as files within
+    a directory, such that these remain available across remounts.  The
+    chunks are keyed by the key of the reader, which includes the
+    identity of the archive along with the name, CRC and size of the
+    entry, and the least recently used chunks are removed once their
+    total size exceeds the budget.  Chunks are written to a temporary
+    file that is then renamed into place, so that a partially written
+    chunk is never served.  Only the files named as chunks are ever
+    removed from the directory.
+    """
+
+    def __init__(self, path, budget=DISK_CACHE_BUDGET,
+            chunk_size=DISK_CACHE_CHUNK_SIZE):
+        self.path = path
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.chunks = OrderedDict()
+        self.lock = Lock()
+        self._scan()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def _scan(self):
+        """
+        Index the chunks persisted by previous instances, from the least
+        to the most recently written.
+        """
+
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        found = []
+        for name in os.listdir(self.path):
+            target = os.path.join(self.path, name)
+            if _CHUNK_TEMP_NAME.match(name):
+                # left behind by an instance that did not finish writing.
+                os.unlink(target)
+                continue
+            if not _CHUNK_NAME.match(name):
+                continue
+            st = os.stat(target)
+            found.append((st.st_mtime, name, st.st_size))
+
+        for mtime, name, size in sorted(found):
+            self.chunks[name] = size
+            self.used += size
+        with self.lock:
+            self._evict()
+
+    def _name(self, key, index):
+        return sha1(repr((key, self.chunk_size, index)).encode(
+            'utf8')).hexdigest()
+
+    def _discard(self, name):
+        self.used -= self.chunks.pop(name)
+        try:
+            os.unlink(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.used > self.budget and self.chunks:
+            self._discard(next(iter(self.chunks)))
+
+    def get(self, name, size, offset):
+        """
+        Return size bytes at offset from the named chunk, or None if
+        the chunk is absent or too short to provide these.
+        """
+
+        with self.lock:
+            if name not in self.chunks:
+                self.misses += 1
+                return None
+            self.chunks[name] = self.chunks.pop(name)
+            self.hits += 1
+
+        target = os.path.join(self.path, name)
+        try:
+            with open(target, 'rb') as fd:
+                data = pread(fd, size, offset)
+        except (OSError, IOError):
+            # removed from underneath.
+            data = b''
+        if len(data) < size:
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return data
+
+    def put(self, name, chunk):
+        if len(chunk) > self.budget:
+            return
+        fd, tmp = mkstemp(
+            prefix=DISK_CACHE_TEMP_PREFIX, suffix='-' + name, dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(chunk)
+            os.rename(tmp, os.path.join(self.path, name))
+        except (OSError, IOError):
+            logger.warning('failed to write chunk to `%s`', self.path)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        with self.lock:
+            self.used -= self.chunks.pop(name, 0)
+            self.chunks[name] = len(chunk)
+            self.used += len(chunk)
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            for name in list(self.chunks):
+                self._discard(name)
+
+    def stats(self):
+        return {
+            'chunks': len(self.chunks),
+            'used': self.used,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def pread(self, reader, size, offset):
+        """
+        Read up to size bytes at offset from the entry provided by the
+        reader, filling the request from the persisted chunks where
+        possible, with the chunks that are absent read from the reader
+        and persisted.
+        """
+
+        if not reader.cacheable or reader.key is None or not self.budget:
+            return reader.pread(size, offset)
+
+        end = min(offset + size, reader.size)
+        if offset >= end:
+            return b''
+
+        chunk_size = self.chunk_size
+        result = []
+        for index in range(offset // chunk_size, (end - 1) // chunk_size + 1):
+            name = self._name(reader.key, index)
+            start = index * chunk_size
+            lower = max(offset - start, 0)
+            upper = min(end - start, chunk_size)
+            data = self.get(name, upper - lower, lower)
+            if data is None:
+                chunk = reader.pread(chunk_size, start)
+                self.put(name, chunk)
+                data = chunk[lower:upper]
+            result.append(data)
+        if len(result) == 1:
+            return result[0]
+        return b''.join(result)
+
+
+class CachedReader(EntryReader):
+    """
+    A reader with its reads filled through the cache.
+    """
+
+    def __init__(self, reader, cache):
+        super(CachedReader, self).__init__(reader.size, reader.key)
+        self.reader = reader
+        self.cache = cache
+        self.cacheable = reader.cacheable
+        self.shareable = reader.shareable
+
+    def pread(self, size, offset):
+        return self.cache.pread(self.reader, size, offset)
+
+    def close(self):
+        self.reader.close()
+        super(CachedReader, self).close()
@@ -9,11 +9,24 @@ from argparse import ArgumentParser
 from argparse import Action
 from argparse import _StoreAction
 from argparse import HelpFormatter
-from fuse import FUSE
 
 from explosive.fuse import pathmaker
+from explosive.fuse.archive import ArchivePool
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import BLOCK_CACHE_BUDGET
+from explosive.fuse.cache import DiskCache
+from explosive.fuse.cache import DISK_CACHE_BUDGET
+from explosive.fuse.cache import EntryCache
+from explosive.fuse.cache import ENTRY_CACHE_BUDGET
+from explosive.fuse.cache import ENTRY_CACHE_THRESHOLD
+from explosive.fuse.fs import ATTR_TIMEOUT
+from explosive.fuse.fs import ENTRY_TIMEOUT
 from explosive.fuse.fs import ExplosiveFUSE
 from explosive.fuse.fs import ManagedExplosiveFUSE
+from explosive.fuse.fs import PagedFUSE
+from explosive.fuse.fs import kernel_invalidation
+from explosive.fuse.index import ArchiveIndex
+from explosive.fuse.reader import READAHEAD_MAXIMUM
 
 
 class _Version(Action):
@@ -114,6 +127,10 @@ def get_argparse():
     parser.add_argument(
         '-f', '--foreground', dest='foreground', action='store_true',
         help='Run in foreground.')
+    parser.add_argument(
+        '-t', '--threads', dest='threads', action='store_true',
+        help='Run multithreaded, such that slow reads do not block the '
+             'other operations on the filesystem.')
     parser.add_argument(
         '-m', '--manager', dest='manager', action='store_true',
         help='Enable the symlink manager directory, where all the archives '
@@ -141,6 +158,88 @@ def get_argparse():
         action='store_true',
         help='Split the filename extension from the archive name; only in'
              'effect if origin archive name is not omitted.')
+    parser.add_argument(
+        '--block-cache-size', dest='block_cache_size', type=int,
+        metavar='<MiB>', default=BLOCK_CACHE_BUDGET >> 20,
+        help='Size of the cache for decompressed blocks that is shared '
+             'across all open files, in MiB; 0 disables the cache. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--readahead-size', dest='readahead_size', type=int,
+        metavar='<KiB>', default=READAHEAD_MAXIMUM >> 10,
+        help='Maximum amount of data to decompress ahead of sequential '
+             'reads for each open file, in KiB; 0 disables read-ahead. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--small-file-size', dest='small_file_size', type=int,
+        metavar='<KiB>', default=ENTRY_CACHE_THRESHOLD >> 10,
+        help='Files up to this size, in KiB, are kept in memory in their '
+             'entirety once read; 0 disables this. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--small-file-cache-size', dest='small_file_cache_size', type=int,
+        metavar='<MiB>', default=ENTRY_CACHE_BUDGET >> 20,
+        help='Total size of the small files kept in memory, in MiB. '
+             'Default is %(default)s.')
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', metavar='<dir>', default=None,
+        help='Directory to persist decompressed data in, such that it '
+             'remains available across remounts.  Disabled by default.')
+    parser.add_argument(
+        '--cache-size', dest='cache_size', type=int,
+        metavar='<MiB>', default=DISK_CACHE_BUDGET >> 20,
+        help='Total size of the data persisted in the cache directory, in '
+             'MiB. Default is %(default)s.')
+    parser.add_argument(
+        '--index-dir', dest='index_dir', metavar='<dir>', default=None,
+        help='Directory of the index of the archives, such that archives '
+             'that remain unchanged since they were indexed are loaded '
+             'without being parsed.  Archives not yet indexed are added to '
+             'it as they are loaded.  Disabled by default.')
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs', type=int, metavar='<n>', default=1,
+        help='Number of processes to parse the archives with while '
+             'mounting; 0 for one per CPU. Default is %(default)s.')
+    parser.add_argument(
+        '--lazy', dest='lazy', action='store_true',
+        help='Only parse an archive once its directory is first accessed; '
+             'only in effect if origin archive name is not omitted.')
+    parser.add_argument(
+        '--hibernate', dest='hibernate', type=int, metavar='<seconds>',
+        default=0,
+        help='Unload the archives parsed on access after they are left '
+             'untouched for this many seconds, until accessed again; only '
+             'in effect with --lazy. Default is %(default)s (never).')
+    parser.add_argument(
+        '--mmap', dest='mmap', action='store_true',
+        help='Memory-map the zip archives, such that their contents are '
+             'read without a system call for every read.')
+    parser.add_argument(
+        '--attr-timeout', dest='attr_timeout', type=float,
+        metavar='<seconds>', default=None,
+        help='Number of seconds the kernel may cache the attributes of the '
+             'files and directories for. Default is %s.' % ATTR_TIMEOUT)
+    parser.add_argument(
+        '--entry-timeout', dest='entry_timeout', type=float,
+        metavar='<seconds>', default=None,
+        help='Number of seconds the kernel may cache the lookups of the '
+             'names of the files and directories for. Default is %s.' % (
+                 ENTRY_TIMEOUT))
+    parser.add_argument(
+        '--negative-timeout', dest='negative_timeout', type=float,
+        metavar='<seconds>', default=None,
+        help='Number of seconds the kernel may cache the lookups of names '
+             'that do not exist for. Default is 0.')
+    parser.add_argument(
+        '--kernel-cache', dest='kernel_cache', action='store_const',
+        const=True, default=None,
+        help='Keep the contents of the files cached by the kernel across '
+             'opens, which is the default.')
+    parser.add_argument(
+        '--no-kernel-cache', dest='kernel_cache', action='store_const',
+        const=False,
+        help='Drop the contents of the files cached by the kernel once '
+             'these are opened again.')
     parser.add_argument(
         '-V', '--version', action='version_verbose',
         help='Print version information and exit.')
@@ -154,6 +253,74 @@ def get_argparse():
     return parser
 
 
+def get_fuse_options(parsed_args, invalidation=True):
+    """
+    Return the options for the caching done by the kernel.  Archives
+    loaded and unloaded through the manager will not show up until what
+    the kernel cached expires, unless the libfuse in use can invalidate
+    it, so the defaults of libfuse are kept then unless specified.
+    """
+
+    cached = invalidation or not parsed_args.manager
+    options = {}
+    for key, default in (
+            ('attr_timeout', ATTR_TIMEOUT),
+            ('entry_timeout', ENTRY_TIMEOUT),
+            ('negative_timeout', None)):
+        value = getattr(parsed_args, key)
+        if value is None and cached:
+            value = default
+        if value is not None:
+            options[key] = value
+    kernel_cache = parsed_args.kernel_cache
+    if kernel_cache is None:
+        kernel_cache = cached
+    if kernel_cache:
+        options['kernel_cache'] = True
+    return options
+
+
+def get_index_argparse():
+    parser = ArgumentParser(
+        prog='explode-index',
+        description='Build the index of the archives ahead of mounting '
+                    'them with the same --index-dir.'
+    )
+    parser.add_argument(
+        '-d', '--debug', dest='debug', action='store_true',
+        help='Run with debug messages.')
+    parser.add_argument(
+        '--index-dir', dest='index_dir', metavar='<dir>', required=True,
+        help='Directory of the index of the archives.')
+    parser.add_argument(
+        'archives', metavar='archives', nargs='+',
+        help='The archive(s) to index.')
+
+    return parser
+
+
+def index_main(args=None):
+    if args is None:  # pragma: no cover
+        args = sys.argv[1:]
+
+    parser = get_index_argparse()
+
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.debug:
+        logging.basicConfig(
+            level='INFO',
+            format='%(asctime)s %(levelname)s %(name)s %(message)s'
+        )
+
+    index = ArchiveIndex(abspath(parsed_args.index_dir))
+    indexed = sum(index.build(abspath(p)) for p in parsed_args.archives)
+    print('indexed %d of %d archive(s).' % (
+        indexed, len(parsed_args.archives)))
+    if indexed != len(parsed_args.archives):
+        sys.exit(1)
+
+
 def main(args=None):
     if args is None:  # pragma: no cover
         args = sys.argv[1:]
@@ -168,6 +335,25 @@ def main(args=None):
             format='%(asctime)s %(levelname)s %(name)s %(message)s'
         )
 
+    block_cache = BlockCache(budget=parsed_args.block_cache_size << 20)
+    entry_cache = EntryCache(
+        budget=parsed_args.small_file_cache_size << 20,
+        threshold=parsed_args.small_file_size << 10,
+    )
+    index = None
+    if parsed_args.index_dir:
+        index = ArchiveIndex(abspath(parsed_args.index_dir))
+    pool = ArchivePool(use_mmap=parsed_args.mmap, index=index)
+    disk_cache = None
+    if parsed_args.cache_dir:
+        disk_cache = DiskCache(
+            abspath(parsed_args.cache_dir),
+            budget=parsed_args.cache_size << 20,
+        )
+
+    invalidate_path = kernel_invalidation()
+    options = get_fuse_options(
+        parsed_args, invalidation=invalidate_path is not None)
     if parsed_args.manager:
         mount_root = abspath(join(getcwd(), parsed_args.dir))
         fuse = ManagedExplosiveFUSE(
@@ -178,6 +364,16 @@ def main(args=None):
             overwrite=parsed_args.overwrite,
             include_arcname=parsed_args.include_arcname,
             splitext_arcname=parsed_args.splitext_arcname,
+            block_cache=block_cache,
+            readahead=parsed_args.readahead_size << 10,
+            entry_cache=entry_cache,
+            disk_cache=disk_cache,
+            pool=pool,
+            index=index,
+            processes=parsed_args.jobs,
+            lazy=parsed_args.lazy,
+            hibernate=parsed_args.hibernate,
+            invalidate_path=invalidate_path,
         )
     else:
         fuse = ExplosiveFUSE(
@@ -186,11 +382,21 @@ def main(args=None):
             overwrite=parsed_args.overwrite,
             include_arcname=parsed_args.include_arcname,
             splitext_arcname=parsed_args.splitext_arcname,
+            block_cache=block_cache,
+            readahead=parsed_args.readahead_size << 10,
+            entry_cache=entry_cache,
+            disk_cache=disk_cache,
+            pool=pool,
+            index=index,
+            processes=parsed_args.jobs,
+            lazy=parsed_args.lazy,
+            hibernate=parsed_args.hibernate,
         )
 
     try:
-        FUSE(fuse, parsed_args.dir, foreground=parsed_args.foreground,
-             nothreads=True)
+        PagedFUSE(
+            fuse, parsed_args.dir, foreground=parsed_args.foreground,
+            nothreads=not parsed_args.threads, use_ino=True, **options)
     except RuntimeError:
         # assume error messages are properly handled.
         sys.exit(255)
@@ -1,4 +1,10 @@
 import logging
+from ctypes import c_char_p
+from ctypes import c_int
+from ctypes import c_size_t
+from ctypes import c_uint64
+from ctypes import c_void_p
+from functools import partial
 from os.path import join
 from os.path import abspath
 from os.path import basename
@@ -12,12 +18,26 @@ from errno import EPERM
 from stat import S_IFDIR
 from stat import S_IFLNK
 from stat import S_IFREG
+from threading import Lock
+from threading import Thread
 from time import time
 
 from fuse import FuseOSError, Operations, LoggingMixIn
 from fuse import ENOTSUP
-
+from fuse import FUSE
+from fuse import c_stat
+from fuse import set_st_attrs
+from fuse import _libfuse
+
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import CachedReader
+from explosive.fuse.exception import BadArchiveFile
 from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.mapper import inode_number
+from explosive.fuse.mapper import ROOT_INODE
+from explosive.fuse.reader import ReadAhead
+from explosive.fuse.reader import SharedReader
+from explosive.fuse.reader import READAHEAD_MAXIMUM
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +77,58 @@ link_record = dict(
     st_gid=st_gid,
 )
 
+# Maximum number of stat records of files kept at once.
+STAT_RECORDS_MAXIMUM = 1 << 16
+# Maximum number of directory listings kept at once.
+LISTINGS_MAXIMUM = 1 << 8
+# Default number of seconds the kernel may cache the attributes of the
+# entries and the lookups of their names for, as these do not change
+# unless archives are loaded or unloaded.
+ATTR_TIMEOUT = 60.0
+ENTRY_TIMEOUT = 60.0
+# The node id of the root of the mount, as assigned by libfuse.
+FUSE_ROOT_ID = 1
+
+
+def kernel_invalidation(libfuse=_libfuse):
+    """
+    Return the function that has the kernel drop what it cached for the
+    entry of a path at the root of the mount, or None if the libfuse in
+    use provides no means to (before libfuse 2.8).
+    """
+
+    try:
+        get_session = libfuse.fuse_get_session
+        next_chan = libfuse.fuse_session_next_chan
+        inval_entry = libfuse.fuse_lowlevel_notify_inval_entry
+    except AttributeError:
+        return None
+    get_session.argtypes = (c_void_p,)
+    get_session.restype = c_void_p
+    next_chan.argtypes = (c_void_p, c_void_p)
+    next_chan.restype = c_void_p
+    inval_entry.argtypes = (c_void_p, c_uint64, c_char_p, c_size_t)
+    inval_entry.restype = c_int
+
+    def invalidate_path(fuse_ptr, path):
+        parent, _, name = path.rpartition(b'/')
+        if parent or not name:
+            # only the entries of the root have a known node id.
+            return None
+        chan = next_chan(get_session(fuse_ptr), None)
+        if not chan:
+            return None
+        return inval_entry(chan, FUSE_ROOT_ID, name, len(name))
+
+    return invalidate_path
+
+
+def _invalidate(invalidate_path, fuse_ptr, paths):
+    for path in paths:
+        if not isinstance(path, bytes):
+            path = path.encode('utf8')
+        invalidate_path(fuse_ptr, path)
+
 
 class ExplosiveFUSE(LoggingMixIn, Operations):
     """
@@ -66,7 +138,9 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
 
     def __init__(self, archive_paths, pathmaker_name='default',
             _pathmaker=None, overwrite=False, include_arcname=False,
-            splitext_arcname=False):
+            splitext_arcname=False, block_cache=None,
+            readahead=READAHEAD_MAXIMUM, entry_cache=None, disk_cache=None,
+            pool=None, index=None, processes=1, lazy=False, hibernate=0):
         # if include_arcname is not defined, define it based whether
         # there is a single or multiple archives.
         self.mapping = DefaultMapper(
@@ -75,14 +149,62 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
             overwrite=overwrite,
             include_arcname=include_arcname,
             splitext_arcname=splitext_arcname,
+            entry_cache=entry_cache,
+            pool=pool,
+            index=index,
+            lazy=lazy,
+            hibernate=hibernate,
         )
-        loaded = sum(self.mapping.load_archive(abspath(p))
-                     for p in archive_paths)
+        loaded = self.mapping.load_archives(
+            [abspath(p) for p in archive_paths], processes=processes)
         logger.info('loaded %d archive(s).', loaded)
 
         self.open_entries = {}
+        # the readers shared by the handles opened on the same entry,
+        # keyed by the id of the file entry.
+        self.shared_readers = {}
+        self.shared_readers_lock = Lock()
+        # decompressed blocks shared across all open handles.
+        self.block_cache = BlockCache() if block_cache is None else block_cache
+        # maximum size of the read-ahead window for each open handle.
+        self.readahead = readahead
+        # optional decompressed chunks persisted across remounts.
+        self.disk_cache = disk_cache
+        # the stat records of files keyed by their paths, along with the
+        # generation of the mapping these were derived from.
+        self.stat_records = (self.mapping.generation, {})
+        # the listings of directories keyed by their paths, along with
+        # the generation of the mapping these were derived from.
+        self.listings = (self.mapping.generation, {})
+        # the listings held by the open directory handles, such that
+        # these are listed from the same snapshot in batches.
+        self.open_listings = {}
+
+    def _file_record(self, key, fentry):
+        """
+        Return the stat record for the file entry at key, with its times
+        taken from the archive where recorded.
+        """
+
+        mtime = self.mapping.mtime(key, fentry)
+        if mtime is None:
+            mtime = now
+        return dict(
+            file_record, st_size=fentry[2],
+            st_ino=self.mapping.inode(key, fentry),
+            st_ctime=mtime, st_mtime=mtime, st_atime=mtime)
 
     def getattr(self, path, fh=None):
+        generation, records = self.stat_records
+        if generation != self.mapping.generation:
+            generation = self.mapping.generation
+            records = {}
+            self.stat_records = (generation, records)
+
+        result = records.get(path)
+        if result is not None:
+            return result
+
         key = path[1:]
 
         info = self.mapping.traverse(key)
@@ -90,18 +212,65 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
             raise FuseOSError(ENOENT)
 
         if isinstance(info, dict):
-            return dir_record
-
-        result = {'st_size': info[2]}
-        result.update(file_record)
+            result = dict(dir_record, st_ino=self.mapping.inode(key, info))
+        else:
+            result = self._file_record(key, info)
+        if not self.mapping.hibernate_after:
+            # the archives must see the traversals to stay loaded if
+            # they are hibernated when left untouched.
+            if len(records) >= STAT_RECORDS_MAXIMUM:
+                records.clear()
+            records[path] = result
         return result
 
+    def _open_reader(self, fentry):
+        reader = self.mapping.open_fentry(fentry)
+        if reader and self.disk_cache is not None:
+            reader = CachedReader(reader, self.disk_cache)
+        return reader
+
+    def _release_reader(self, idfe, fp):
+        if fp.release():
+            with self.shared_readers_lock:
+                if self.shared_readers.get(idfe) is fp:
+                    self.shared_readers.pop(idfe)
+
     def _mapping_open(self, key):
-        idfe_fp = self.mapping.open(key)
-        if not idfe_fp:
+        """
+        Return the id of the file entry at key along with the reader
+        shared by all handles opened on it.  The caller is responsible
+        for releasing the reader.
+        """
+
+        fentry = self.mapping.traverse(key)
+        if not isinstance(fentry, tuple):
+            raise FuseOSError(ENOENT)
+        idfe = id(fentry)
+        with self.shared_readers_lock:
+            fp = self.shared_readers.get(idfe)
+            if fp is None or fp.acquire() is None:
+                fp = self.shared_readers[idfe] = SharedReader(
+                    partial(self._open_reader, fentry), fentry).acquire()
+
+        # opened without holding the lock of the mount, as this may
+        # have to read the entry or parse the archive.
+        opened = fp.open()
+        if fp.reader and not fp.shareable:
+            # reading a stream at another offset reopens it from the
+            # start, so each handle reads from a stream of its own.
+            with self.shared_readers_lock:
+                if self.shared_readers.get(idfe) is fp:
+                    self.shared_readers.pop(idfe)
+            if not opened:
+                self._release_reader(idfe, fp)
+                fp = SharedReader(
+                    partial(self._open_reader, fentry), fentry).acquire()
+                fp.open()
+        if not fp.reader:
+            self._release_reader(idfe, fp)
             # should this errno instead be transport error? io error?
             raise FuseOSError(ENOENT)
-        return idfe_fp
+        return idfe, fp
 
     def open(self, path, flags):
         # TODO implement memory usage tracking by reusing cache.
@@ -109,24 +278,29 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
         logger.info('opening for %s', key)
 
         # the idfe is the stable identifier for this "version" of the
-        # given path (id of fileentry), fp is the file pointer.
+        # given path (id of fileentry), fp is the file pointer shared
+        # with all other handles opened on the same version.
         idfe, fp = self._mapping_open(key)
         # initial position is 0
         pos = 0
+        # only data that is expensive to produce is read ahead.
+        readahead = ReadAhead(
+            partial(self.block_cache.pread, fp), fp.size,
+            maximum=self.readahead if fp.cacheable else 0,
+        )
         # add this to mapping, accompanied by the current position of 0
+        # and the lock that serializes the operations on this handle;
         # this is the open_entry and its id is the fh returned.
-        open_entry = [fp, pos, idfe]
-        # TODO ideally, the idfe is returned as the fh, but we need
-        # additional tracking on all open handles.  Reference counting
-        # should be use.
+        open_entry = [fp, pos, idfe, readahead, Lock()]
         fh = id(open_entry)
         self.open_entries[fh] = open_entry
         return fh
 
     def release(self, path, fh):
-        fp, pos, idfe = self.open_entries.pop(fh, None)
-        if fp:
-            fp.close()
+        fp, pos, idfe, readahead, lock = self.open_entries.pop(fh, None)
+        with lock:
+            readahead.close()
+        self._release_reader(idfe, fp)
 
     def read(self, path, size, offset, fh):
         key = path[1:]
@@ -136,33 +310,128 @@ class ExplosiveFUSE(LoggingMixIn, Operations):
         open_entry = self.open_entries.get(fh)
         if not open_entry:
             raise FuseOSError(EIO)
-        zf, pos, idfe = open_entry
+        fp, pos, idfe, readahead, lock = open_entry
         logger.debug(
-            'open_entry: zf: %s, pos: %d, idfe: %s', zf, pos, idfe)
-        seek = offset - pos
-        if seek < 0:
-            # have to reopen...
-            logger.info('seek position is %d, need reopening', seek)
-            new_idfe, zf = self._mapping_open(key)
-            if idfe != new_idfe:
-                # different file entry, ignoring by kiling this
+            'open_entry: fp: %s, pos: %d, idfe: %s', fp, pos, idfe)
+        with lock:
+            if self.open_entries.get(fh) is not open_entry:
+                # released by another thread.
                 raise FuseOSError(EIO)
-            # overwrite the open_entry's zipfile with the new one.
-            open_entry[0] = zf
-            # reset rest of the values
-            seek = offset
-            pos = 0
-        junk = zf.read(seek)
-        open_entry[1] = pos + size
-        return zf.read(size)
-
-    def readdir(self, path, fh):
-        key = path[1:]
-        return ['.', '..'] + self.mapping.readdir(key)
+            try:
+                data = readahead.pread(size, offset)
+            except BadArchiveFile:
+                logger.warning('failed to read data for %s', key)
+                raise FuseOSError(EIO)
+            open_entry[1] = offset + len(data)
+        return data
+
+    def _list(self, path):
+        return ['.', '..'] + self.mapping.readdir(path[1:])
+
+    def _listing(self, path):
+        """
+        Return the listing of the directory at path, which is only listed
+        again once the mapping is modified.  The listing is not to be
+        modified, as it is shared.
+        """
+
+        generation, listings = self.listings
+        if generation != self.mapping.generation:
+            generation = self.mapping.generation
+            listings = {}
+            self.listings = (generation, listings)
+
+        result = listings.get(path)
+        if result is not None:
+            return result
+
+        result = self._list(path)
+        if not self.mapping.hibernate_after:
+            # the archives must see the traversals to stay loaded if
+            # they are hibernated when left untouched.
+            if len(listings) >= LISTINGS_MAXIMUM:
+                listings.clear()
+            listings[path] = result
+        return result
+
+    def opendir(self, path):
+        open_listing = [self._listing(path)]
+        fh = id(open_listing)
+        self.open_listings[fh] = open_listing
+        return fh
+
+    def releasedir(self, path, fh):
+        self.open_listings.pop(fh, None)
+        return 0
+
+    def _attrs(self, path):
+        try:
+            return self.getattr(path)
+        except FuseOSError:
+            return None
+
+    def _page(self, path, listing, offset):
+        prefix = path.rstrip('/') + '/'
+        for index in range(offset, len(listing)):
+            name = listing[index]
+            if index > 1:
+                attrs = self._attrs(prefix + name)
+            elif index == 0:
+                attrs = self._attrs(path)
+            else:
+                # the parent is left to be looked up.
+                attrs = None
+            yield name, attrs, index + 1
+
+    def readdir(self, path, fh, offset=None):
+        """
+        Return the names within the directory at path, or if an offset
+        is provided, yield these from there along with their attributes
+        and the offset of the next one, such that large directories are
+        listed in batches with the attributes of every entry included.
+        """
+
+        open_listing = self.open_listings.get(fh)
+        if open_listing is None:
+            listing = self._listing(path)
+        else:
+            listing = open_listing[0]
+        if offset is None:
+            return list(listing)
+        return self._page(path, listing, offset)
 
     def statfs(self, path):
-        # TODO report total size of the zips?
-        return dict(f_bsize=1024, f_blocks=1024, f_bavail=0)
+        # report the total size of the entries in the loaded archives.
+        tables = list(self.mapping.archive_tables.values())
+        total = sum(table.total() for table in tables)
+        return dict(
+            f_bsize=1024, f_frsize=1024, f_blocks=(total + 1023) // 1024,
+            f_bavail=0, f_files=sum(len(table) for table in tables))
+
+
+class PagedFUSE(FUSE):
+    """
+    The FUSE bindings, with the offset requested by readdir passed on
+    to the operations, such that the directories are listed in batches
+    as the kernel asks for these rather than in their entirety.
+    """
+
+    def readdir(self, path, buf, filler, offset, fip):
+        if path is not None:
+            path = path.decode(self.encoding)
+        for item in self.operations(
+                'readdir', path, fip.contents.fh, offset):
+            if isinstance(item, tuple):
+                name, attrs, offset = item
+            else:
+                name, attrs, offset = item, None, 0
+            st = None
+            if attrs:
+                st = c_stat()
+                set_st_attrs(st, attrs, use_ns=self.use_ns)
+            if filler(buf, name.encode(self.encoding), st, offset) != 0:
+                break
+        return 0
 
 
 class _SymlinkFUSE(LoggingMixIn, Operations):
@@ -183,6 +452,10 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
         self.fd = 0
         self.symlinks = {}  # keys are the basename.
 
+    def _dir_record(self, path):
+        st_ino = inode_number(b'', path[1:]) if path else ROOT_INODE
+        return dict(dir_record, st_ino=st_ino)
+
     def getattr(self, path, fh=None):
         if path == '/':
             path = ''
@@ -191,17 +464,20 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
             if (self.base_path.startswith(path) and
                     self.base_path[len(path)] == '/'):
                 # a valid parent directory to the base_path.
-                return dir_record
+                return self._dir_record(path)
             raise FuseOSError(ENOENT)
 
         if path == self.base_path:
-            return dir_record
+            return self._dir_record(path)
 
         symkey = basename(path)
         data = self.symlinks.get(symkey)
         if data is None:
             raise FuseOSError(ENOENT)
-        result = {'st_size': len(data)}
+        result = {
+            'st_size': len(data),
+            'st_ino': inode_number(b'l', path[1:]),
+        }
         result.update(link_record)
         return result
 
@@ -218,12 +494,22 @@ class _SymlinkFUSE(LoggingMixIn, Operations):
         symkey = basename(path)
         return self.symlinks[symkey]
 
-    def readdir(self, path, fh):
+    def readdir(self, path, fh, offset=None):
         if not path == self.base_path:
             if path == '/':
                 path = ''
-            return ['.', '..', self.base_path[len(path):].split('/')[1]]
-        return ['.', '..'] + list(self.symlinks.keys())
+            result = ['.', '..', self.base_path[len(path):].split('/')[1]]
+        else:
+            result = ['.', '..'] + list(self.symlinks.keys())
+        if offset is None:
+            return result
+        # the attributes of the parent directories are left out.
+        prefix = path.rstrip('/') + '/'
+        return [
+            (name, self.getattr(prefix + name) if index > 1 else None,
+                index + 1)
+            for index, name in enumerate(result) if index >= offset
+        ]
 
     def symlink(self, path, source):
         if not path.startswith(self.base_path):
@@ -270,21 +556,59 @@ class ManagedExplosiveFUSE(ExplosiveFUSE):
         if '/' in management_node:
             raise ValueError('Management node must be a valid directory name')
         self.management_node = management_node
+        # the function to have the kernel drop what it cached for the
+        # paths affected by the archives loaded and unloaded.
+        self.invalidate_path = kw.pop('invalidate_path', None)
         base_path = '/' + management_node
         self.symlinkfs = _SymlinkFUSE(mount_root, base_path)
         super(ManagedExplosiveFUSE, self).__init__(*a, **kw)
+        self.mapping.on_dropped = self._drop_symlinks
         symlinks = self.symlinkfs.symlinks
         for n, k in enumerate(sorted(self.mapping.archives.keys())):
             fn = basename(k)
             fn = fn if fn not in symlinks else '%s_%d' % (basename(fn), n)
             symlinks[fn] = k
 
-    def readdir(self, path, fh):
-        result = super(ManagedExplosiveFUSE, self).readdir(path, fh)
+    def _drop_symlinks(self, archive_path):
+        """
+        Remove the symlinks to the archive, as it is no longer loaded.
+        """
+
+        symlinks = self.symlinkfs.symlinks
+        for name, target in list(symlinks.items()):
+            if target == archive_path:
+                symlinks.pop(name, None)
+
+    def _attrs(self, path):
+        if path.startswith(self.symlinkfs.base_path):
+            try:
+                return self.symlinkfs.getattr(path)
+            except FuseOSError:
+                return None
+        return super(ManagedExplosiveFUSE, self)._attrs(path)
+
+    def _list(self, path):
+        result = super(ManagedExplosiveFUSE, self)._list(path)
         if path == '/' and self.management_node not in result:
             result.append(self.management_node)
         return result
 
+    def invalidate(self, paths):
+        """
+        Have the kernel drop the entries and attributes it cached for the
+        paths.  This is done once the current operation returns, as the
+        kernel may hold locks that the invalidation would wait on.
+        """
+
+        if self.invalidate_path is None or not paths:
+            return
+        fuse_ptr = _libfuse.fuse_get_context().contents.fuse
+        thread = Thread(
+            target=_invalidate,
+            args=(self.invalidate_path, fuse_ptr, sorted(paths)))
+        thread.daemon = True
+        thread.start()
+
     def __call__(self, op, path, *args):
         if path.startswith(self.symlinkfs.base_path):
             result = getattr(self.symlinkfs, op)(path, *args)
@@ -299,10 +623,13 @@ class ManagedExplosiveFUSE(ExplosiveFUSE):
                     self.symlinkfs.unlink(path)
                     # Assume I/O error due to archive inaccessible.
                     raise FuseOSError(EIO)
+                self.invalidate(self.mapping.toplevel_paths(result))
                 return None
 
             elif op == 'unlink':
+                paths = self.mapping.toplevel_paths(result)
                 self.mapping.unload_archive(result)
+                self.invalidate(paths)
                 return None
 
             return result
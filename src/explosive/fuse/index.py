@@ -0,0 +1,174 @@
+"""
+Persistent index of the entries within archives.
+"""
+
+import json
+import os
+from collections import namedtuple
+from hashlib import sha1
+from logging import getLogger
+from tempfile import mkstemp
+from zipfile import ZipFile
+
+from .archive import ArchiveFile
+from .archive import archive_identity
+from .archive import FileNotFoundError
+from .exception import BadArchiveFile
+from .exception import UnsupportedArchiveFile
+
+logger = getLogger(__name__)
+
+# Version of the format of the index files; files of any other version
+# are ignored.
+INDEX_VERSION = 3
+# Prefix of the index files that are still being written.
+INDEX_TEMP_PREFIX = '.tmp'
+
+# The subset of the attributes of ZipInfo/RarInfo used by the mapper,
+# along with the data offset if it was resolved.
+IndexedInfo = namedtuple('IndexedInfo', [
+    'filename', 'file_size', 'data_offset', 'date_time',
+    'compress_size', 'CRC', 'compress_type'])
+IndexedInfo.__new__.__defaults__ = (None, None, None, None)
+
+
+def indexed_info(info, data_offset=None):
+    """
+    Return the IndexedInfo of the ZipInfo/RarInfo.
+    """
+
+    return IndexedInfo(
+        info.filename, info.file_size, data_offset,
+        getattr(info, 'date_time', None),
+        getattr(info, 'compress_size', None),
+        getattr(info, 'CRC', None),
+        getattr(info, 'compress_type', None),
+    )
+
+
+class ArchiveIndex(object):
+    """
+    An index of the entries within archives, persisted as a file per
+    archive within a directory.  Each index file records the identity
+    of the archive at the time it was indexed (its path, device, inode,
+    size and modification time), and it is only used while the archive
+    still has that identity, such that archives can be loaded without
+    parsing them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            if not os.path.isdir(self.path):
+                raise
+
+    def _target(self, archive_path):
+        name = sha1(archive_path.encode('utf8')).hexdigest() + '.json'
+        return os.path.join(self.path, name)
+
+    def _read(self, archive_path):
+        try:
+            with open(self._target(archive_path)) as fd:
+                record = json.load(fd)
+        except (OSError, IOError, ValueError):
+            return None
+        try:
+            identity = archive_identity(archive_path)
+        except OSError:
+            return None
+        if (record.get('version') != INDEX_VERSION or
+                record.get('identity') != list(identity)):
+            return None
+        return record
+
+    def get(self, archive_path):
+        """
+        Return the list of IndexedInfo for the archive, or None if the
+        archive is not indexed or has changed since it was indexed.
+        """
+
+        record = self._read(archive_path)
+        if record is None:
+            return None
+        return [
+            IndexedInfo._make(entry)._replace(
+                date_time=entry[3] and tuple(entry[3]))
+            for entry in record['entries']
+        ]
+
+    def data_offsets(self, archive_path):
+        """
+        Return the data offsets that were resolved for the entries of
+        the archive, keyed by their filenames.
+        """
+
+        record = self._read(archive_path)
+        if record is None:
+            return {}
+        return dict(
+            (entry[0], entry[2])
+            for entry in record['entries']
+            if entry[2] is not None
+        )
+
+    def put(self, archive, resolve=False):
+        """
+        Write the index of the opened archive.  The data offsets of all
+        entries are resolved if resolve is set, otherwise only the ones
+        already resolved are recorded.
+        """
+
+        resolve = resolve and isinstance(archive.archive_file, ZipFile)
+        entries = []
+        for info in archive.infolist():
+            data_offset = archive.data_offsets.get(info.filename)
+            if data_offset is None and resolve:
+                try:
+                    data_offset = archive.data_offset(info)
+                except BadArchiveFile:
+                    logger.warning(
+                        '`%s` in `%s` has a bad local file header',
+                        info.filename, archive.archive_filename)
+            entries.append(indexed_info(info, data_offset))
+
+        record = {
+            'version': INDEX_VERSION,
+            'identity': list(archive.identity),
+            'entries': entries,
+        }
+        fd, tmp = mkstemp(prefix=INDEX_TEMP_PREFIX, dir=self.path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(record, f)
+            os.rename(tmp, self._target(archive.archive_filename))
+        except (OSError, IOError):
+            logger.warning(
+                'failed to write index for `%s`', archive.archive_filename)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def build(self, archive_path):
+        """
+        Index the archive at archive_path, with the data offsets of all
+        its entries resolved.  Archives already indexed are skipped.
+        """
+
+        if self._read(archive_path) is not None:
+            return True
+        try:
+            with ArchiveFile(archive_path) as archive:
+                return self.put(archive, resolve=True)
+        except BadArchiveFile:
+            logger.warning(
+                '`%s` appears to be an invalid archive file', archive_path)
+        except UnsupportedArchiveFile as e:
+            logger.warning('`%s` %s', archive_path, str(e))
+        except FileNotFoundError:
+            logger.warning('`%s` does not exist.', archive_path)
+        return False
@@ -1,32 +1,132 @@
+import gc
+import os
 from time import time
 from collections import defaultdict
-from collections import deque
 from collections import namedtuple
+from functools import partial
+from hashlib import sha1
+from itertools import count
+from multiprocessing import Pool
 from os.path import basename
 from os.path import splitext
 from logging import getLogger
+from threading import RLock
+try:
+    from sys import intern
+except ImportError:  # pragma: no cover
+    # Assume python 2, where only str can be interned.
+    def intern(s, _intern=intern):
+        return _intern(s) if isinstance(s, str) else s
 
 from . import pathmaker
 from .archive import ArchiveFile
+from .archive import ArchivePool
+from .archive import archive_identity
+from .cache import EntryCache
 from .archive import FileNotFoundError
 from .exception import BadArchiveFile
 from .exception import UnsupportedArchiveFile
+from .index import indexed_info
+from .reader import CheckpointStore
+from .reader import MemoryReader
+from .table import ArchiveTable
 
 logger = getLogger(__name__)
 
+# The memory the mapping is expected to take for every file entry loaded
+# with a typical path (about 30 characters, a few directories deep), in
+# bytes, which includes the file entry, its place in its directory, the
+# reverse mapping and the internal filename.
+ENTRY_MEMORY_TARGET = 512
+# The inode number of the root of the mapping, as with FUSE.
+ROOT_INODE = 1
+
 
 # XXX the i prefix here means archive internal, not for mapper.
 FileEntry = namedtuple(
     'FileEntry', ['archive_path', 'ifilename', 'ifile_size'])
 
 
+def inode_number(seed, name):
+    """
+    Return the inode number derived from the name within the namespace
+    identified by seed.
+    """
+
+    if not isinstance(name, bytes):
+        name = name.encode('utf8')
+    value = int(sha1(seed + name).hexdigest()[:16], 16) >> 1
+    # clear of 0, which is not a valid inode number, and of the root.
+    return value if value > ROOT_INODE else value + 2
+
+
+def read_infolist(archive_path, index=None, pool=None):
+    """
+    Return the entries of the archive identified by archive_path, from
+    the index if the archive is indexed, otherwise parsed from the
+    archive (acquired through the pool if provided) and then recorded
+    into the index.  Return None if the archive cannot be read.
+    """
+
+    try:
+        infolist = None
+        if index is not None:
+            infolist = index.get(archive_path)
+        if infolist is not None:
+            return infolist
+        if pool is None:
+            archive = ArchiveFile(archive_path)
+        else:
+            archive = pool.archive(archive_path)
+        with archive as af:
+            infolist = af.infolist()
+            if index is not None:
+                index.put(af)
+        return infolist
+    except BadArchiveFile:
+        logger.warning(
+            '`%s` appears to be an invalid archive file', archive_path)
+    except UnsupportedArchiveFile as e:
+        logger.warning('`%s` %s', archive_path, str(e))
+    except FileNotFoundError:
+        logger.warning(
+            '`%s` does not exist.', archive_path)
+    except:
+        logger.exception('Exception')
+    return None
+
+
+def _read_indexedinfos(archive_path, index=None):
+    # for the worker processes, as the IndexedInfo are cheaper to send
+    # back than the ZipInfo/RarInfo.
+    infolist = read_infolist(archive_path, index)
+    if infolist is None:
+        return None
+    return [indexed_info(info) for info in infolist]
+
+
+class ArchivePlaceholder(dict):
+    """
+    Stands in for the directory of an archive loaded lazily, until the
+    contents of that directory are needed.
+    """
+
+    __slots__ = ('archive_path',)
+
+    def __init__(self, archive_path):
+        super(ArchivePlaceholder, self).__init__()
+        self.archive_path = archive_path
+
+
 class DefaultMapper(object):
     """
     Mapper that tracks the nested structure within archive files.
     """
 
     def __init__(self, path=None, pathmaker_name='default', _pathmaker=None,
-            overwrite=False, include_arcname=False, splitext_arcname=False):
+            overwrite=False, include_arcname=False, splitext_arcname=False,
+            pool=None, entry_cache=None, index=None, lazy=False,
+            hibernate=0):
         """
         Initialize the mapping, optionally with a path to an archive
         file.
@@ -46,24 +146,118 @@ class DefaultMapper(object):
 
         # The actual filesystem mapping
         self.mapping = {}
+        # A flat index of the nodes within the mapping keyed by their
+        # full path, such that these are looked up without walking the
+        # directories.
+        self.nodes = {'': self.mapping}
         # a mapping with keys of generated paths against source archive.
         # its keys includes a map of directory to its source archive.
-        self.reverse_mapping = defaultdict(deque)
+        # The values are tuples of the file entries of every archive
+        # that provides the path, ordered by the layer of the archives,
+        # as these take a fraction of the memory of deques.
+        self.reverse_mapping = defaultdict(tuple)
+        # Every archive loaded is a layer, with the layers ordered by the
+        # order the archives were loaded in; the entry of the lowest
+        # layer is the one visible, or of the highest with overwrite.
+        self.layers = {}
+        self.layer_order = count()
         # Tracked file added timestamps (see _load_infolist)
         self.archives = {}
         # A flattened mapping of archive to its list of internal entries
         # including directory entries.
         self.archive_ifilenames = {}
+        # The metadata of the entries within each archive, as columns.
+        self.archive_tables = {}
+        # The digest of the identity of each archive, which the inode
+        # numbers of its entries are derived from.
+        self.inode_seeds = {}
+        # Decompressor checkpoints for seeking within deflated entries.
+        self.checkpoints = CheckpointStore()
+        # The parsed archive files that are kept open.
+        self.pool = ArchivePool() if pool is None else pool
+        # The complete contents of small entries.
+        self.entry_cache = (
+            EntryCache() if entry_cache is None else entry_cache)
+        # The optional persistent index of the archives, used in place
+        # of parsing them while loading.
+        self.index = index
+        # Serializes modifications to the mappings; lookups are done
+        # without it.
+        self.lock = RLock()
+        # Incremented for every modification to the mappings, such that
+        # anything derived from these can tell when to be discarded.
+        self.generation = 0
+        # Whether archives are only parsed once their directory is first
+        # traversed into, and the number of seconds after which those
+        # left untouched are returned to placeholders (0 for never).
+        self.lazy = lazy
+        self.hibernate_after = hibernate
+        self.hibernate_checked = time()
+        # The archives loaded lazily against the name of their directory,
+        # and vice versa.
+        self.lazy_archives = {}
+        self.lazy_names = {}
+        # Called with the lazily loaded archives that are dropped as they
+        # failed to load once accessed.
+        self.on_dropped = None
+        # The last time the lazily loaded archives that have been parsed
+        # were traversed into.
+        self.accessed = {}
 
         if path:
             self.load_archive(path)
 
+    def _index_nodes(self):
+        """
+        Rebuild the index of full paths from the mapping, for when the
+        mapping was replaced outright.
+        """
+
+        nodes = {'': self.mapping}
+        dirs = [('', self.mapping)]
+        while dirs:
+            prefix, current = dirs.pop()
+            for name, node in current.items():
+                path = prefix + name
+                nodes[path] = node
+                if isinstance(node, dict):
+                    dirs.append((path + '/', node))
+        self.nodes = nodes
+        return nodes
+
+    def _link(self, path, node):
+        """
+        Record the node at path within the index of full paths, in place
+        of whatever was there before.
+        """
+
+        if isinstance(self.nodes.get(path), dict):
+            self._unlink(path)
+        self.nodes[path] = node
+
+    def _unlink(self, path):
+        """
+        Remove the node at path from the index of full paths, along with
+        everything beneath it.
+        """
+
+        node = self.nodes.pop(path, None)
+        if isinstance(node, dict):
+            for name in list(node):
+                self._unlink(path + '/' + name)
+
     def mkdir(self, path_fragments):
         """
         Creates the dir entries identified by path if not already exists
         and return the complete directory.
         """
 
+        if self.nodes.get('') is not self.mapping:
+            self._index_nodes()
+        current = self.nodes.get('/'.join(path_fragments))
+        if isinstance(current, dict):
+            return current
+
         # set current to root node
         current = self.mapping
 
@@ -81,6 +275,7 @@ class DefaultMapper(object):
             else:
                 # create directory dict entry and set current.
                 current[frag] = current = {}
+                self.nodes['/'.join(path_fragments[:c + 1])] = current
 
         return current
 
@@ -89,125 +284,384 @@ class DefaultMapper(object):
         Traverse to path, or return the entry identified by path.
         """
 
-        path_fragments = path and path.split('/') or []
-        return self._traverse(path_fragments)
+        path = path or ''
+        nodes = self.nodes
+        if nodes.get('') is not self.mapping:
+            nodes = self._index_nodes()
+        current = nodes.get(path)
+        if self.lazy_names and path:
+            name = path.split('/', 1)[0]
+            if (current is None and
+                    isinstance(nodes.get(name), ArchivePlaceholder)):
+                # the entries of the archive have yet to be loaded.
+                return self._traverse(path.split('/'))
+            self._touch(name)
+        return current
 
     def _traverse(self, path_fragments):
         current = self.mapping
 
         for frag in path_fragments:
-            if not isinstance(current, dict) or frag not in current:
+            if not isinstance(current, dict):
+                return None
+            if isinstance(current, ArchivePlaceholder):
+                current = self._materialize(current.archive_path)
+                if current is None:
+                    return None
+            # single lookup, as the directory may be modified by
+            # another thread between checking and getting the frag.
+            current = current.get(frag)
+            if current is None:
                 # No such frag in dir.
                 return None
-            current = current[frag]
 
+        if self.lazy_names and path_fragments:
+            self._touch(path_fragments[0])
         return current
 
-    def _load_infolist(self, archive_path, infolist):
-        self.archives[archive_path] = time()
-        archive_name = (
+    def _archive_name(self, archive_path):
+        return (
             splitext(basename(archive_path))[0]
             if self.splitext_arcname else
             basename(archive_path)
         ) + '/'
-        self.archive_ifilenames[archive_path] = i_filenames = []
 
-        for info in infolist:
-            if self.include_arcname:
-                raw_filename = archive_name + info.filename
+    def _placeholder_name(self, archive_path):
+        """
+        Return the name of the directory all entries of the archive are
+        placed in, or None if the layout does not place them into a
+        single directory named after the archive.
+        """
+
+        archive_name = self._archive_name(archive_path)
+        try:
+            frags, _ = self.pathmaker(archive_name + 'x')
+            nested, _ = self.pathmaker(archive_name + 'x/x')
+        except ValueError:
+            return None
+        if frags and nested[:1] == frags[:1]:
+            return frags[0]
+        return None
+
+    def _materialize(self, archive_path):
+        """
+        Load the lazily loaded archive into its placeholder, and return
+        its directory, or None if it could not be loaded.
+        """
+
+        name = self.lazy_archives.get(archive_path)
+        current = self.mapping.get(name)
+        if not isinstance(current, ArchivePlaceholder):
+            # already loaded by another thread.
+            return current
+
+        infolist = read_infolist(archive_path, self.index, self.pool)
+        with self.lock:
+            current = self.mapping.get(name)
+            if (not isinstance(current, ArchivePlaceholder) or
+                    current.archive_path != archive_path):
+                return current
+            if infolist is not None:
+                self.mapping[name] = {}
+                self._link(name, self.mapping[name])
+                if not self._try_load_infolist(archive_path, infolist):
+                    infolist = None
+            if infolist is None:
+                self._forget(archive_path)
+                if self.mapping.get(name) == {}:
+                    self.mapping.pop(name)
+                    self._unlink(name)
+                self.generation += 1
+                self.archives.pop(archive_path, None)
+                self.layers.pop(archive_path, None)
+                if self.on_dropped is not None:
+                    self.on_dropped(archive_path)
+                return None
+            self.accessed[archive_path] = time()
+            logger.info('loaded `%s` on demand', archive_path)
+            return self.mapping.get(name)
+
+    def _forget(self, archive_path):
+        """
+        Stop tracking the archive as one that is loaded lazily.
+        """
+
+        name = self.lazy_archives.pop(archive_path, None)
+        self.lazy_names.pop(name, None)
+        self.accessed.pop(archive_path, None)
+        return name
+
+    def _pin(self, name):
+        """
+        Load the lazily loaded archive with its directory at name, such
+        that another archive can add its entries there, and stop it from
+        being hibernated as its directory is no longer its own.
+        """
+
+        archive_path = self.lazy_names.get(name)
+        self._materialize(archive_path)
+        self._forget(archive_path)
+
+    def _touch(self, name):
+        archive_path = self.lazy_names.get(name)
+        if archive_path not in self.accessed:
+            return
+        now = self.accessed[archive_path] = time()
+        if (self.hibernate_after and
+                now - self.hibernate_checked >= self.hibernate_after):
+            self.hibernate_checked = now
+            self.hibernate(self.hibernate_after)
+
+    def hibernate(self, idle=0):
+        """
+        Return the lazily loaded archives left untouched for idle seconds
+        back to placeholders, releasing the resources used by them.
+        """
+
+        now = time()
+        with self.lock:
+            for archive_path, accessed in list(self.accessed.items()):
+                if now - accessed < idle:
+                    continue
+                name = self.lazy_archives[archive_path]
+                loaded = self.archives[archive_path]
+                layer = self.layers[archive_path]
+                self._unload_infolist(archive_path)
+                self.mapping[name] = ArchivePlaceholder(archive_path)
+                self._link(name, self.mapping[name])
+                self.archives[archive_path] = loaded
+                self.layers[archive_path] = layer
+                self.accessed.pop(archive_path)
+                self.pool.discard(archive_path)
+                self.entry_cache.discard_archive(archive_path)
+                logger.info('hibernated `%s`', archive_path)
+
+    def _layer(self, archive_path):
+        """
+        Return the layer of the archive, with archives not seen before
+        placed above every other.
+        """
+
+        layer = self.layers.get(archive_path)
+        if layer is None:
+            layer = self.layers[archive_path] = next(self.layer_order)
+        return layer
+
+    def _bisect(self, fentries, layer):
+        """
+        Return the position of the first of the file entries that does
+        not come from a layer below the layer.
+        """
+
+        layers = self.layers
+        lo, hi = 0, len(fentries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if layers[fentries[mid].archive_path] < layer:
+                lo = mid + 1
             else:
-                raw_filename = info.filename
-            frags, filename = self.pathmaker(raw_filename)
+                hi = mid
+        return lo
+
+    def _visible(self, fentries):
+        """
+        Return the file entry visible out of the file entries provided
+        by the layers.
+        """
+
+        return fentries[-1] if self.overwrite else fentries[0]
+
+    def _load_infolist(self, archive_path, infolist):
+        # none of the objects created while loading can form reference
+        # cycles, so spare the collector from repeatedly going through
+        # the growing mapping.
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._load_entries(archive_path, infolist)
+        finally:
+            self.generation += 1
+            if collecting:
+                gc.enable()
+
+    def _try_load_infolist(self, archive_path, infolist):
+        """
+        Load the infolist, or if that fails (such as when the pathmaker
+        cannot handle the names of the entries), undo whatever was
+        loaded of it and return False.
+        """
+
+        try:
+            self._load_infolist(archive_path, infolist)
+            return True
+        except Exception:
+            logger.exception('failed to load `%s`', archive_path)
+        if archive_path in self.archive_ifilenames:
+            self._unload_infolist(archive_path)
+        else:
+            self.archives.pop(archive_path, None)
+            self.layers.pop(archive_path, None)
+            self.archive_tables.pop(archive_path, None)
+        return False
+
+    def _load_entries(self, archive_path, infolist):
+        self.generation += 1
+        self.archives[archive_path] = time()
+        layer = self._layer(archive_path)
+        archive_name = self._archive_name(archive_path)
+        self.archive_ifilenames[archive_path] = i_filenames = []
+        # the table shares the list of internal filenames, which is
+        # filled in the same order as the infolist below.
+        self.archive_tables[archive_path] = ArchiveTable.from_infolist(
+            infolist, i_filenames)
+
+        # entries are listed grouped by their directory, so the
+        # directory of the previous entry is kept at hand along with the
+        # prefix of the internal filenames within it, such that neither
+        # has to be resolved again for the entries that follow.
+        last_raw = last_frags = None
+        target = error = prefix = None
+        reverse_mapping = self.reverse_mapping
+        if self.nodes.get('') is not self.mapping:
+            self._index_nodes()
+        nodes = self.nodes
+        overwrite = self.overwrite
+        lazy_names = self.lazy_names
+        append = i_filenames.append
+        new_fentry = partial(tuple.__new__, FileEntry)
+
+        if self.include_arcname:
+            raw_filenames = [
+                archive_name + info.filename for info in infolist]
+        else:
+            raw_filenames = [info.filename for info in infolist]
+        batch = getattr(self.pathmaker, 'batch', None)
+        if batch is not None:
+            paths = batch(raw_filenames)
+        else:
+            paths = map(self.pathmaker, raw_filenames)
+
+        for info, (frags, filename) in zip(infolist, paths):
+            # the same names tend to appear across directories and
+            # archives, so only keep a single copy of each.
+            filename = intern(filename)
+
+            if lazy_names:
+                name = frags[0] if frags else filename
+                if lazy_names.get(name, archive_path) != archive_path:
+                    self._pin(name)
+
+            if batch is not None and frags is last_raw:
+                # shared by the batch form of the pathmaker.
+                frags = last_frags
+            elif frags != last_frags:
+                last_raw = frags
+                frags = [intern(frag) for frag in frags]
+                last_frags = frags
+                prefix = ''.join(frag + '/' for frag in frags)
+                try:
+                    target, error = self.mkdir(frags), None
+                except ValueError as e:
+                    target, error = None, e.args[0]
 
             # the internal filename.
-            ifilename = '/'.join([] + frags + [filename])
+            ifilename = prefix + filename
+            if ifilename == info.filename:
+                # share the string where the layout left it unchanged.
+                ifilename = info.filename
 
-            fentry = FileEntry(archive_path, info.filename, info.file_size)
+            fentry = new_fentry(
+                (archive_path, info.filename, info.file_size))
 
             # These may appear redundant compared to the ones below, but
             # do note these are always added despite conflict that will
             # appear at the filesystem presentation level.  This is used
             # for locating current zip files for regeneration if an
             # archive was removed from this mapping.
-            self.reverse_mapping[ifilename].append(fentry)
-            i_filenames.append(ifilename)
-
-            try:
-                target = self.mkdir(frags)
-            except ValueError as e:
+            fentries = (fentry,)
+            existing = reverse_mapping.setdefault(ifilename, fentries)
+            if existing is not fentries:
+                fentries = existing
+                # after any entry from the same layer, as archives may
+                # hold duplicate entries.
+                pos = self._bisect(fentries, layer + 1)
+                fentries = fentries[:pos] + (fentry,) + fentries[pos:]
+                reverse_mapping[ifilename] = fentries
+            append(ifilename)
+
+            if target is None:
                 # using info.filename rather than raw_filename because
                 # the message is provided by the exception generated by
                 # self.mkdir.
                 logger.warning(
-                    '`%s` could not be created: %s', info.filename, e.args[0])
+                    '`%s` could not be created: %s', info.filename, error)
                 continue
 
             if not filename:
                 # was a directory entry
                 continue
 
-            if filename in target:
-                if not self.overwrite:
-                    logger.info('`%s` already exists; ignoring', info.filename)
+            if len(fentries) > 1:
+                if self._visible(fentries) is not fentry:
+                    # hidden by the entry of another layer.
+                    logger.info(
+                        '`%s` already exists; ignoring', info.filename)
                     continue
-            target[filename] = fentry
 
-    def _unload_functions(self):
-        """
-        Return a tuple of needed functions for unloading an archive out
-        of the mappings.
-        """
+            current = target.setdefault(filename, fentry)
+            if current is not fentry:
+                if not overwrite and current not in fentries:
+                    logger.info(
+                        '`%s` already exists; ignoring', info.filename)
+                    continue
+                target[filename] = fentry
+                self._link(ifilename, fentry)
+            else:
+                nodes[ifilename] = fentry
 
-        if self.overwrite:
-            # check the rightmost (newest) item, pop from right
-            return -1, deque.pop
-        else:
-            # check the leftmost (oldest) item, pop from left
-            return 0, deque.popleft
+        # the entry visible out of the ones sharing a name within the
+        # archive follows the same rule as the ones across archives.
+        self.archive_tables[archive_path].sort(last=overwrite)
 
     def _unload_infolist(self, archive_path):
         # pop this out right away to mark this as to be pruned off.
         ifilenames = self.archive_ifilenames.pop(archive_path)
-        index, pop = self._unload_functions()
-        all_frags = set()
+        self.generation += 1
+        self.archive_tables.pop(archive_path, None)
+        layer = self.layers[archive_path]
+        parents = set()
         for ifilename in ifilenames:
-            # lookup via the reverse mapping to see that this ifilename
-            # is the active check that the current active
             fentries = self.reverse_mapping[ifilename]
+            pos = self._bisect(fentries, layer)
+            fentry = fentries[pos]
+            visible = self._visible(fentries) is fentry
+            fentries = fentries[:pos] + fentries[pos + 1:]
 
-            if fentries[index].archive_path != archive_path:
-                # leave the reverse mapping in place.
-                continue
-
-            original_filename = fentries[index].ifilename
-
-            archive_ifilenames = self.archive_ifilenames
-            # We have a match, time to clean up to the latest fresh and
-            # active entry that other previous calls to this function
-            # have left behind.
             fentry_replacement = None
-            try:
-                while fentries[index].archive_path not in archive_ifilenames:
-                    pop(fentries)
-                else:
-                    # Successfully left the loop, the fileentry is now
-                    # the replacement.
-                    fentry_replacement = fentries[index]
-            except IndexError:
+            if fentries:
+                fentry_replacement = self._visible(fentries)
+                self.reverse_mapping[ifilename] = fentries
+            else:
                 # This no longer exists in any active archive.
                 self.reverse_mapping.pop(ifilename)
 
+            if not visible:
+                # hidden by another layer, so the mapping is unaffected.
+                continue
+
+            original_filename = fentry.ifilename
+
             # We have an ifilename created in _load_infolist, invert
-            # operation to derive filename and frags.
-            raw = ifilename.split('/')
-            filename = raw[-1]
-            frags = raw[:-1]
+            # operation to derive the path of its directory and the
+            # filename, with the directory looked up through the index
+            # rather than from the root.
+            parent, _, filename = ifilename.rpartition('/')
 
-            if frags:
-                all_frags.add(tuple(frags))
+            if parent:
+                parents.add(parent)
 
-            info = self._traverse(frags)
-            if not info is None:
+            info = self.nodes.get(parent)
+            if isinstance(info, dict):
                 # The file's directory may not have been added to
                 # self.mapping, if its creation may have been blocked
                 # by another file.
@@ -219,11 +673,13 @@ class DefaultMapper(object):
                         # this entry be removed (file for file, dir for
                         # dir).
                         info.pop(filename)
+                        self._unlink(ifilename)
 
                     if fentry_replacement:
                         # Restore the fileentry with the replacement
                         # from above.
                         info[filename] = fentry_replacement
+                        self._link(ifilename, fentry_replacement)
 
                 # XXX filename could be empty, does it mean the
                 # directory can be removed if empty?
@@ -235,14 +691,33 @@ class DefaultMapper(object):
             # are two different types.
 
         # finally, purge all empty directories.  Yes this includes
-        # directories that may not be wholly owned by this archive.
-        for frags in sorted(all_frags, key=lambda x: len(x)):
-            target = self._traverse(frags[:-1])
-            if target.get(frags[-1]) == {}:
-                target.pop(frags[-1])
-
-        # discard the date associated with this archive path too.
+        # directories that may not be wholly owned by this archive,
+        # but not the ones still declared by the directory entries of
+        # another archive.
+        for parent in parents:
+            self._prune(parent)
+
+        # discard the date and the layer associated with this archive
+        # path too.
         self.archives.pop(archive_path)
+        self.layers.pop(archive_path)
+        self.generation += 1
+
+    def _prune(self, path):
+        """
+        Remove the directory at path if it is empty, followed by every
+        directory above it that becomes empty as a result.
+        """
+
+        while path:
+            current = self.nodes.get(path)
+            if (current != {} or isinstance(current, ArchivePlaceholder) or
+                    path + '/' in self.reverse_mapping):
+                return
+            parent, _, name = path.rpartition('/')
+            self.nodes[parent].pop(name)
+            self._unlink(path)
+            path = parent
 
     def load_archive(self, archive_path):
         """
@@ -250,39 +725,187 @@ class DefaultMapper(object):
         mapping.
         """
 
+        if self.lazy and self.include_arcname:
+            name = self._placeholder_name(archive_path)
+            if name is not None and self._load_placeholder(
+                    archive_path, name):
+                return True
+
+        infolist = read_infolist(archive_path, self.index, self.pool)
+        if infolist is None:
+            return False
+        with self.lock:
+            if not self._try_load_infolist(archive_path, infolist):
+                return False
+        logger.info('loaded `%s`', archive_path)
+        return True
+
+    def _load_placeholder(self, archive_path, name):
+        """
+        Load the placeholder for the archive in place of its directory
+        at name.  Return False if name is already taken, as the archive
+        will then have to be loaded right away.
+        """
+
+        if not os.path.isfile(archive_path):
+            return False
+        with self.lock:
+            if name in self.mapping:
+                return False
+            self.mapping[name] = ArchivePlaceholder(archive_path)
+            self._link(name, self.mapping[name])
+            self.generation += 1
+            self.archives[archive_path] = time()
+            self._layer(archive_path)
+            self.lazy_archives[archive_path] = name
+            self.lazy_names[name] = archive_path
+        logger.info('loaded placeholder for `%s`', archive_path)
+        return True
+
+    def load_archives(self, archive_paths, processes=1):
+        """
+        Load the archive files identified by archive_paths into the
+        mapping, with the archives parsed by up to the specified number
+        of worker processes (0 for one per CPU).  The archives are
+        loaded in the order provided regardless of the order the workers
+        finish in.  Return the number of archives loaded.
+        """
+
+        if processes == 1 or len(archive_paths) < 2 or self.lazy:
+            return sum(self.load_archive(p) for p in archive_paths)
+
+        workers = Pool(processes or None)
         try:
-            with ArchiveFile(archive_path) as af:
-                self._load_infolist(archive_path, af.infolist())
+            infolists = workers.map(
+                partial(_read_indexedinfos, index=self.index),
+                archive_paths, chunksize=1)
+        finally:
+            workers.close()
+            workers.join()
+
+        loaded = 0
+        for archive_path, infolist in zip(archive_paths, infolists):
+            if infolist is None:
+                continue
+            with self.lock:
+                if not self._try_load_infolist(archive_path, infolist):
+                    continue
             logger.info('loaded `%s`', archive_path)
-            return True
-        except BadArchiveFile:
-            logger.warning(
-                '`%s` appears to be an invalid archive file', archive_path)
-        except UnsupportedArchiveFile as e:
-            logger.warning('`%s` %s', archive_path, str(e))
-        except FileNotFoundError:
-            logger.warning(
-                '`%s` does not exist.', archive_path)
-        except:
-            logger.exception('Exception')
-        return False
+            loaded += 1
+        return loaded
 
     def unload_archive(self, archive_path):
-        self._unload_infolist(archive_path)
+        with self.lock:
+            name = self._forget(archive_path)
+            current = self.mapping.get(name)
+            if archive_path not in self.archives:
+                # dropped already, as it failed to load on demand.
+                pass
+            elif (isinstance(current, ArchivePlaceholder) and
+                    current.archive_path == archive_path):
+                self.mapping.pop(name)
+                self._unlink(name)
+                self.generation += 1
+                self.archives.pop(archive_path)
+                self.layers.pop(archive_path)
+            else:
+                self._unload_infolist(archive_path)
+                if name is not None:
+                    # the directory belonged to this archive alone.
+                    self.mapping.pop(name, None)
+                    self._unlink(name)
+                    self.generation += 1
+        self.pool.discard(archive_path)
+        self.entry_cache.discard_archive(archive_path)
+        self.inode_seeds.pop(archive_path, None)
         logger.info('unloaded `%s`', archive_path)
 
+    def inode(self, path, node):
+        """
+        Return the inode number of the node at path.  Files are numbered
+        by the identity of their archive along with their name within
+        it, and directories by their path, such that the numbers remain
+        the same across remounts for as long as the archives do.
+        """
+
+        if not path:
+            return ROOT_INODE
+        if not isinstance(node, tuple):
+            return inode_number(b'', path)
+        archive_path, filename = node[:2]
+        seed = self.inode_seeds.get(archive_path)
+        if seed is None:
+            try:
+                identity = archive_identity(archive_path)
+            except OSError:
+                identity = (archive_path,)
+            seed = self.inode_seeds[archive_path] = sha1(
+                repr(identity).encode('utf8')).digest()
+        return inode_number(seed, filename)
+
+    def toplevel_paths(self, archive_path):
+        """
+        Return the paths of the nodes at the root of the mapping that
+        the archive provides entries within, such that everything the
+        archive provides is beneath one of these.
+        """
+
+        with self.lock:
+            names = set(
+                ifilename.partition('/')[0]
+                for ifilename in self.archive_ifilenames.get(
+                    archive_path, ()))
+            name = self.lazy_archives.get(archive_path)
+            if name is not None:
+                names.add(name)
+        names.discard('')
+        return set('/' + name for name in names)
+
     def open(self, path):
         info = self.traverse(path)
         if info is None:
             return
-        archive_path, filename, _ = info
+        fp = self.open_fentry(info)
+        if not fp:
+            return fp
+        return (id(info), fp)
+
+    def _readcached(self, fentry):
+        """
+        Return the complete contents of the file entry if it is small
+        enough to be held by the entry cache, otherwise None.
+        """
+
+        archive_path, filename, file_size = fentry
+        if not self.entry_cache.admits(file_size):
+            return None
+        with self.pool.archive(archive_path) as af:
+            # keyed as the readers are, such that an archive replaced in
+            # place does not keep serving what it held before.
+            key = af.entry_key(filename)
+            data = self.entry_cache.get(key)
+            if data is None:
+                with af.open(filename) as f:
+                    data = f.read()
+                self.entry_cache.put(key, data)
+        return data
+
+    def open_fentry(self, fentry):
+        """
+        Return a reader for the file entry.
+        """
+
+        archive_path, filename, _ = fentry
         # it is possible to return those values, but given that the
         # underlying files can change, or that new stack comes in, it's
         # best not to directly expose this.
         try:
-            with ArchiveFile(archive_path) as zf:
-                # zf does remain open because of this.
-                return (id(info), zf.open(filename))
+            data = self._readcached(fentry)
+            if data is not None:
+                return MemoryReader(data)
+            with self.pool.archive(archive_path) as af:
+                # the reader keeps its own reference to the archive.
+                return af.open_reader(filename, self.checkpoints)
         except BadArchiveFile:  # pragma: no cover
             logger.warning(
                 '`%s` became an invalid archive file', archive_path)
@@ -294,6 +917,17 @@ class DefaultMapper(object):
             logger.exception('Exception')
         return False
 
+    def mtime(self, path, fentry):
+        """
+        Return the modification time recorded for the file entry found
+        at path, or None if the archive did not record one.
+        """
+
+        table = self.archive_tables.get(fentry.archive_path)
+        if table is None:
+            return None
+        return table.mtime(path)
+
     def readfile(self, path):
         """
         Return the complete file with information contained in path.
@@ -304,9 +938,12 @@ class DefaultMapper(object):
         # but that pattern should really be generalized.
 
         info = self.traverse(path)
+        data = self._readcached(info)
+        if data is not None:
+            return data
 
         archive_filename, filename, _ = info
-        with ArchiveFile(archive_filename) as af:
+        with self.pool.archive(archive_filename) as af:
             with af.open(filename) as f:
                 return f.read()
 
@@ -316,6 +953,8 @@ class DefaultMapper(object):
         """
 
         info = self.traverse(path)
+        if isinstance(info, ArchivePlaceholder):
+            info = self._materialize(info.archive_path)
         if not isinstance(info, dict):
             return []
         return list(info.keys())
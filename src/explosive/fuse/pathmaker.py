@@ -1,6 +1,11 @@
+import codecs
 import re
 
 FLATTEN_CHAR = '_'
+# Encodings that may carry state across, or encode to something other
+# than the single byte for, the path separator, such that paths in these
+# cannot be recoded one fragment at a time.
+_STATEFUL_ENCODINGS = ('utf-7', 'utf-16', 'utf-32', 'iso2022', 'hz')
 
 __all__ = [
     'codepage',
@@ -10,6 +15,42 @@ __all__ = [
 ]
 
 
+def _batch(dir_frags, basename=None):
+    """
+    Return the batch form of a pathmaker for which the frags only depend
+    on the directory of the path, with dir_frags producing the frags
+    from the directory (None for paths without one), and basename the
+    filename from the final fragment.
+
+    The batch form takes a list of paths and returns the list of frags
+    and filename pairs, with the frags of each directory produced once
+    and the same list returned for every path within it, so these lists
+    must not be modified.
+    """
+
+    def batch(inner_paths):
+        memo = {}
+        result = []
+        for inner_path in inner_paths:
+            dirname, sep, filename = inner_path.rpartition('/')
+            if not sep:
+                dirname = None
+            frags = memo.get(dirname)
+            if frags is None:
+                frags = memo[dirname] = dir_frags(dirname)
+            if basename is not None:
+                filename = basename(filename)
+            result.append((frags, filename))
+        return result
+
+    return batch
+
+
+def _splits_cleanly(encoding):
+    name = codecs.lookup(encoding).name
+    return not name.startswith(_STATEFUL_ENCODINGS)
+
+
 def codepage(target='', original='cp437'):
     """
     Treat the names of each file entry in archive as that codepage but
@@ -28,6 +69,18 @@ def codepage(target='', original='cp437'):
 
         return frags, filename
 
+    def recode(name):
+        p = name.encode(original) if bytes != str else name
+        return p.decode(target)
+
+    def dir_frags(dirname):
+        if dirname is None:
+            return []
+        return recode(dirname).split('/')
+
+    if _splits_cleanly(original) and _splits_cleanly(target):
+        # only the directory of each path needs recoding once.
+        codepage.batch = _batch(dir_frags, recode)
     return codepage
 
 
@@ -43,6 +96,10 @@ def default():
 
         return frags, filename
 
+    def dir_frags(dirname):
+        return [] if dirname is None else dirname.split('/')
+
+    default.batch = _batch(dir_frags)
     return default
 
 
@@ -68,6 +125,15 @@ def flatten(char=FLATTEN_CHAR):
 
         return [], inner_path.replace('/', char)
 
+    def batch(inner_paths):
+        frags = []
+        return [
+            (frags, '' if inner_path.endswith('/') else
+                inner_path.replace('/', char))
+            for inner_path in inner_paths
+        ]
+
+    flatten.batch = batch
     return flatten
 
 
@@ -99,6 +165,14 @@ def junk(keep='0'):
             frags = dirname.split('/')[level:]
         return frags, basename
 
+    def dir_frags(dirname):
+        if dirname is None:
+            return []
+        if level >= 0:
+            return dirname.split('/')[:level]
+        return dirname.split('/')[level:]
+
+    junk.batch = _batch(dir_frags)
     return junk
 
 
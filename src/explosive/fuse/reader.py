@@ -0,0 +1,626 @@
+"""
+Positional readers for file entries within archives.
+"""
+
+import os
+import zlib
+from bisect import bisect_right
+from collections import namedtuple
+from collections import OrderedDict
+from logging import getLogger
+from threading import Condition
+from threading import Lock
+from threading import RLock
+from threading import Thread
+
+from .exception import BadArchiveFile
+
+logger = getLogger(__name__)
+
+# Size of each compressed chunk read from the archive.
+CHUNK_SIZE = 1 << 16
+# Upper bound of each inflated block produced by a single decompress.
+BLOCK_SIZE = 1 << 17
+# Uncompressed distance between checkpoints recorded for an entry.
+CHECKPOINT_INTERVAL = 1 << 20
+# Total memory all checkpoints may occupy.
+CHECKPOINT_BUDGET = 1 << 26
+# Estimated memory cost of a single checkpoint, which is dominated by
+# the 32 KiB sliding window plus the rest of the inflate state.
+CHECKPOINT_COST = 44 << 10
+# Initial and maximum sizes of the read-ahead window.
+READAHEAD_INITIAL = 1 << 18
+READAHEAD_MAXIMUM = 1 << 22
+# Number of consecutive sequential reads before read-ahead starts.
+READAHEAD_TRIGGER = 2
+
+Checkpoint = namedtuple('Checkpoint', ['offset', 'coffset', 'decompressor'])
+
+
+def pread(fp, size, offset):
+    """
+    Read up to size bytes at offset from the file object, without using
+    its position where the platform allows it.  If the file object has
+    a view of its memory-mapped contents, a slice of that is returned
+    instead.
+    """
+
+    view = getattr(fp, 'view', None)
+    if view is not None:
+        return view[offset:offset + size]
+    if hasattr(os, 'pread'):
+        return os.pread(fp.fileno(), size, offset)
+    fp.seek(offset)  # pragma: no cover
+    return fp.read(size)  # pragma: no cover
+
+
+class CheckpointIndex(object):
+    """
+    The checkpoints recorded for a single deflate stream, ordered by
+    their uncompressed offsets.
+    """
+
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self.offsets = []
+        self.checkpoints = []
+
+    def __len__(self):
+        return len(self.checkpoints)
+
+    def nearest(self, offset):
+        """
+        Return the checkpoint closest to, but not after offset, or None
+        if the stream must be inflated from the start.
+        """
+
+        idx = bisect_right(self.offsets, offset)
+        if idx:
+            return self.checkpoints[idx - 1]
+        return None
+
+    def due(self, offset):
+        """
+        Whether a checkpoint should be recorded at offset.
+        """
+
+        last = self.offsets[-1] if self.offsets else 0
+        return offset >= last + self.interval
+
+    def add(self, offset, coffset, decompressor):
+        """
+        Record a copy of the decompressor state at offset, which must be
+        beyond the furthest checkpoint recorded.
+        """
+
+        self.offsets.append(offset)
+        self.checkpoints.append(
+            Checkpoint(offset, coffset, decompressor.copy()))
+
+    def thin(self):
+        """
+        Drop every other checkpoint and double the interval, halving the
+        memory used.  Return the number of checkpoints dropped.
+        """
+
+        count = len(self.checkpoints)
+        self.checkpoints = self.checkpoints[1::2]
+        self.offsets = self.offsets[1::2]
+        self.interval *= 2
+        return count - len(self.checkpoints)
+
+
+class CheckpointStore(object):
+    """
+    Tracks the checkpoint indexes of all deflate streams, keeping the
+    total estimated memory used under the budget by discarding the
+    least recently used indexes.
+    """
+
+    def __init__(self, budget=CHECKPOINT_BUDGET,
+            interval=CHECKPOINT_INTERVAL, cost=CHECKPOINT_COST):
+        self.budget = budget
+        self.interval = interval
+        self.cost = cost
+        self.used = 0
+        self.indexes = OrderedDict()
+        self.lock = RLock()
+
+    def index(self, key):
+        """
+        Return the index for key, creating it if not already tracked.
+        """
+
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is None:
+                index = CheckpointIndex(self.interval)
+            self.indexes[key] = index
+            return index
+
+    def nearest(self, key, offset):
+        """
+        Return the nearest checkpoint at or before offset for the stream
+        identified by key.
+        """
+
+        with self.lock:
+            return self.index(key).nearest(offset)
+
+    def record(self, key, offset, coffset, decompressor):
+        """
+        Record a checkpoint for the stream identified by key if one is
+        due at offset.
+        """
+
+        with self.lock:
+            index = self.index(key)
+            if not index.due(offset) or self.cost > self.budget:
+                return
+            index.add(offset, coffset, decompressor)
+            self.used += self.cost
+
+            while self.used > self.budget:
+                victim = next((
+                    k for k, i in self.indexes.items() if i is not index
+                ), None)
+                if victim is None:
+                    # only the current index is left, so thin it out.
+                    self.used -= index.thin() * self.cost
+                else:
+                    self.discard(victim)
+
+    def discard(self, key):
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is not None:
+                self.used -= len(index) * self.cost
+
+
+class EntryReader(object):
+    """
+    Base reader for an archive entry, which provides random access
+    through pread while also presenting a minimal file-like interface.
+    The key identifies the entry along with the archive it belongs to.
+    """
+
+    # whether the data is expensive enough to produce to be worth caching
+    cacheable = True
+    # whether reads at any offset are cheap, such that the reader may be
+    # shared by handles reading at different offsets.
+    shareable = True
+
+    def __init__(self, size, key=None, crc=None):
+        self.size = size
+        self.key = key
+        self.pos = 0
+        self.closed = False
+        # the expected CRC-32 of the data, which is checked against the
+        # CRC-32 of the data read sequentially from the start.
+        self.crc = crc
+        self.crc_offset = 0 if crc is not None else None
+        self._crc = 0
+        self.corrupt = False
+
+    def _verify(self, data, offset):
+        """
+        Keep the running CRC-32 of the data read sequentially from the
+        start, and raise BadArchiveFile if it does not match the one
+        expected once the end is reached.
+        """
+
+        if self.corrupt:
+            raise BadArchiveFile('bad CRC-32')
+        start = self.crc_offset
+        if start is None or not offset <= start < offset + len(data):
+            return
+        self._crc = zlib.crc32(data[start - offset:], self._crc)
+        self.crc_offset = offset + len(data)
+        if self.crc_offset >= self.size:
+            self.crc_offset = None
+            if self._crc & 0xffffffff != self.crc:
+                self.corrupt = True
+                raise BadArchiveFile('bad CRC-32')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def pread(self, size, offset):
+        """
+        Return up to size bytes starting at offset.
+        """
+
+        raise NotImplementedError
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        data = self.pread(size, self.pos)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(offset, 0)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.closed = True
+
+
+class MemoryReader(EntryReader):
+    """
+    Reader for an entry whose complete contents are already in memory.
+    """
+
+    cacheable = False
+
+    def __init__(self, data, key=None):
+        super(MemoryReader, self).__init__(len(data), key)
+        self.data = data
+
+    def pread(self, size, offset):
+        return self.data[offset:offset + size]
+
+
+class StreamReader(EntryReader):
+    """
+    Generic reader that wraps the sequential file object produced by the
+    opener, which gets called again whenever a backward seek is needed.
+    The handle, if provided, is closed along with the reader.
+    """
+
+    shareable = False
+
+    def __init__(self, opener, size, key=None, handle=None):
+        super(StreamReader, self).__init__(size, key)
+        self.opener = opener
+        self.fp = opener()
+        self.handle = handle
+        self.offset = 0
+
+    def pread(self, size, offset):
+        if offset < self.offset:
+            logger.info('seeking backward to %d, need reopening', offset)
+            self.fp.close()
+            self.fp = self.opener()
+            self.offset = 0
+        while self.offset < offset:
+            junk = self.fp.read(min(offset - self.offset, BLOCK_SIZE))
+            if not junk:
+                return b''
+            self.offset += len(junk)
+        data = self.fp.read(size)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+        if self.handle is not None:
+            self.handle.close()
+        super(StreamReader, self).close()
+
+
+class StoredReader(EntryReader):
+    """
+    Reader for an entry stored without compression, where every read is
+    served directly from the archive at the resolved data offset.
+    """
+
+    cacheable = False
+
+    def __init__(self, fp, data_offset, size, key=None, crc=None):
+        super(StoredReader, self).__init__(size, key, crc)
+        self.fp = fp
+        self.data_offset = data_offset
+
+    def pread(self, size, offset):
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return b''
+        data = bytes(pread(self.fp, size, self.data_offset + offset))
+        self._verify(data, offset)
+        return data
+
+    def close(self):
+        self.fp.close()
+        super(StoredReader, self).close()
+
+
+class DeflateReader(EntryReader):
+    """
+    Reader for a raw deflate stream in an archive, which records the
+    decompressor state at regular intervals into the checkpoint index
+    so that later reads at any offset can resume from the nearest
+    checkpoint rather than inflating from the start of the stream.
+    """
+
+    def __init__(self, fp, data_offset, compress_size, size, key,
+            store=None, crc=None):
+        super(DeflateReader, self).__init__(size, key, crc)
+        self.fp = fp
+        self.data_offset = data_offset
+        self.compress_size = compress_size
+        self.store = CheckpointStore() if store is None else store
+        self._restore(None)
+
+    def _restore(self, checkpoint):
+        if checkpoint is None:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            self._offset = self._coffset = 0
+        else:
+            self._decompressor = checkpoint.decompressor.copy()
+            self._offset = checkpoint.offset
+            self._coffset = checkpoint.coffset
+        # compressed input not yet consumed by the decompressor.
+        self._tail = b''
+        # the most recently inflated block, which ends at _offset.
+        self._block = b''
+
+    def _read(self, size, coffset):
+        return pread(self.fp, size, self.data_offset + coffset)
+
+    def _inflate(self):
+        """
+        Inflate the next block from the stream.
+        """
+
+        decompressor = self._decompressor
+        self.store.record(
+            self.key, self._offset, self._coffset - len(self._tail),
+            decompressor)
+
+        block = b''
+        while not block:
+            if not self._tail:
+                remaining = self.compress_size - self._coffset
+                if remaining <= 0 or getattr(decompressor, 'eof', False):
+                    raise BadArchiveFile('deflate stream ended prematurely')
+                self._tail = self._read(
+                    min(CHUNK_SIZE, remaining), self._coffset)
+                if not self._tail:
+                    raise BadArchiveFile('archive truncated')
+                self._coffset += len(self._tail)
+            block = decompressor.decompress(self._tail, BLOCK_SIZE)
+            self._tail = decompressor.unconsumed_tail
+
+        self._block = block
+        self._offset += len(block)
+
+    def pread(self, size, offset):
+        end = min(offset + size, self.size)
+        if offset >= end:
+            return b''
+
+        start = self._offset - len(self._block)
+        checkpoint = self.store.nearest(self.key, offset)
+        if offset < start or (
+                checkpoint is not None and checkpoint.offset > self._offset):
+            # Either the position is behind the current block, or the
+            # nearest checkpoint is further ahead of the stream.
+            self._restore(checkpoint)
+
+        result = []
+        while offset < end:
+            if offset >= self._offset:
+                self._inflate()
+                continue
+            start = self._offset - len(self._block)
+            chunk = self._block[offset - start:end - start]
+            result.append(chunk)
+            offset += len(chunk)
+        data = b''.join(result)
+        self._verify(data, offset - len(data))
+        return data
+
+    def close(self):
+        self.fp.close()
+        super(DeflateReader, self).close()
+
+
+class SharedReader(EntryReader):
+    """
+    A reader shared by every handle opened on the same entry, such that
+    the entry is decompressed once regardless of the number of handles
+    reading it, with each handle tracking its own position.  The reader
+    is opened through the opener by the first handle, with the handles
+    opened on the same entry meanwhile waiting on it alone.  Reads from
+    the underlying reader are serialized, and it is closed as soon as
+    the last handle releases it.
+    """
+
+    def __init__(self, opener, entry=None):
+        super(SharedReader, self).__init__(0)
+        self.opener = opener
+        self.reader = None
+        # the entry being read, kept for as long as its id is in use.
+        self.entry = entry
+        self.refs = 0
+        # guards the references, and is never held across a read.
+        self.refs_lock = Lock()
+        # serializes the opening of and the reads from the reader.
+        self.lock = Lock()
+
+    def acquire(self):
+        """
+        Acquire a reference, return None if the last one was already
+        released, as the reader is then closed.
+        """
+
+        with self.refs_lock:
+            if self.closed:
+                return None
+            self.refs += 1
+        return self
+
+    def release(self):
+        """
+        Release a reference, return True if it was the last one.
+        """
+
+        with self.refs_lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return False
+            self.closed = True
+        if self.reader:
+            self.reader.close()
+        return True
+
+    def open(self):
+        """
+        Open the reader unless it was already, and return True if it was
+        opened by this call.  The reader is left False if it could not
+        be opened.
+        """
+
+        with self.lock:
+            if self.reader is not None:
+                return False
+            self.reader = self.opener() or False
+            if self.reader:
+                self.size = self.reader.size
+                self.key = self.reader.key
+                self.cacheable = self.reader.cacheable
+                self.shareable = self.reader.shareable
+            return True
+
+    def pread(self, size, offset):
+        with self.lock:
+            return self.reader.pread(size, offset)
+
+
+class ReadAhead(object):
+    """
+    Tracks the reads made through a single handle, and once these reads
+    are found to be sequential, data beyond the most recent read is
+    fetched by a background worker into a bounded buffer.  The window
+    doubles for every read-ahead made while access stays sequential, up
+    to the maximum, and both the window and the buffer are dropped as
+    soon as a read at any other offset happens.
+
+    The fetch callable takes the same arguments as EntryReader.pread,
+    and calls to it are serialized.
+    """
+
+    def __init__(self, fetch, size, maximum=READAHEAD_MAXIMUM,
+            initial=READAHEAD_INITIAL, trigger=READAHEAD_TRIGGER):
+        self.fetch = fetch
+        self.size = size
+        self.maximum = maximum
+        self.initial = min(initial, maximum)
+        self.trigger = trigger
+
+        self.window = 0
+        self.sequential = 0
+        self.next_offset = 0
+        self.buffer = b''
+        self.buffer_offset = 0
+
+        self.generation = 0
+        # the generation, offset and size of the read-ahead in flight.
+        self.pending = None
+        self.worker = None
+
+        self._fetch_lock = Lock()
+        self._cond = Condition(Lock())
+
+    def _fetch(self, size, offset):
+        with self._fetch_lock:
+            return self.fetch(size, offset)
+
+    def _drop(self):
+        self.generation += 1
+        self.window = 0
+        self.sequential = 0
+        self.buffer = b''
+        self.buffer_offset = 0
+
+    def _work(self, generation, size, offset):
+        try:
+            data = self._fetch(size, offset)
+        except Exception:
+            logger.exception('read-ahead failed at offset %d', offset)
+            data = b''
+        with self._cond:
+            if generation == self.generation:
+                buffer_end = self.buffer_offset + len(self.buffer)
+                if buffer_end == offset:
+                    self.buffer += data
+                else:
+                    self.buffer = data
+                    self.buffer_offset = offset
+            self.pending = None
+            self._cond.notify_all()
+
+    def _schedule(self, end):
+        """
+        Start a read-ahead past end if the buffer is running low.
+        """
+
+        buffer_end = self.buffer_offset + len(self.buffer)
+        start = max(end, buffer_end)
+        if (self.pending is not None or start >= self.size or
+                start - end > self.window // 2):
+            return
+
+        self.window = min(self.window * 2 or self.initial, self.maximum)
+        self.pending = (self.generation, start, self.window)
+        self.worker = Thread(
+            target=self._work, args=(self.generation, self.window, start))
+        self.worker.daemon = True
+        self.worker.start()
+
+    def pread(self, size, offset):
+        end = min(offset + size, self.size)
+        with self._cond:
+            if offset == self.next_offset:
+                self.sequential += 1
+            else:
+                self._drop()
+            self.next_offset = end
+
+            # wait for the read-ahead that covers this offset.
+            while self.pending is not None:
+                generation, start, length = self.pending
+                if (generation != self.generation or
+                        not start <= offset < start + length):
+                    break
+                self._cond.wait()
+
+            start = offset - self.buffer_offset
+            if 0 <= start < len(self.buffer):
+                data = self.buffer[start:end - self.buffer_offset]
+                # discard what have been consumed.
+                self.buffer = self.buffer[start + len(data):]
+                self.buffer_offset += start + len(data)
+            else:
+                data = b''
+
+        if offset + len(data) < end:
+            data += self._fetch(end - offset - len(data), offset + len(data))
+
+        with self._cond:
+            if self.maximum and self.sequential >= self.trigger:
+                self._schedule(end)
+        return data
+
+    def close(self):
+        """
+        Drop the buffer and wait for any read-ahead in flight.
+        """
+
+        with self._cond:
+            self._drop()
+            worker = self.worker
+        if worker is not None:
+            worker.join()
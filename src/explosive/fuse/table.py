@@ -0,0 +1,253 @@
+"""
+Columnar tables of the metadata of the entries within archives.
+"""
+
+from array import array
+from collections import Counter
+from operator import attrgetter
+from time import mktime
+
+try:
+    import numpy
+    NUMPY_SUPPORT = True
+except ImportError:  # pragma: no cover
+    NUMPY_SUPPORT = False
+
+# Value recorded for the metadata not known for an entry.
+UNKNOWN = -1
+
+# The integer columns of the table, with the attribute of the info
+# objects (ZipInfo/RarInfo/IndexedInfo) each is derived from.
+COLUMNS = (
+    ('file_size', 'file_size'),
+    ('compress_size', 'compress_size'),
+    ('crc', 'CRC'),
+    ('compress_type', 'compress_type'),
+    ('data_offset', 'data_offset'),
+)
+
+try:
+    array('q')
+    _TYPECODE = 'q'
+except ValueError:  # pragma: no cover
+    # python 2 has no long long arrays.
+    _TYPECODE = 'l'
+
+
+def pack_date_time(date_time):
+    """
+    Pack the date_time tuple of an entry into a single integer, which
+    keeps the ordering of the tuples.
+    """
+
+    year, month, day, hour, minute, second = date_time[:6]
+    return (((((year * 16 + month) * 32 + day) * 32 + hour) * 64 +
+        minute) * 64 + second)
+
+
+def unpack_date_time(value):
+    """
+    Return the timestamp of the packed date_time, taken as local time
+    as the archive formats record it.
+    """
+
+    value, second = divmod(value, 64)
+    value, minute = divmod(value, 64)
+    value, hour = divmod(value, 32)
+    value, day = divmod(value, 32)
+    year, month = divmod(value, 16)
+    return mktime((year, month, day, hour, minute, second, 0, 0, -1))
+
+
+def _column(values):
+    if NUMPY_SUPPORT:
+        return numpy.array(values, dtype=numpy.int64)
+    return array(_TYPECODE, values)
+
+
+class ArchiveTable(object):
+    """
+    The metadata of all the entries within an archive stored as columns,
+    with every attribute other than the names of the entries held in a
+    typed array (NumPy arrays if available), such that aggregates over
+    the entries are computed over these columns rather than by going
+    through an object for every entry.
+    """
+
+    def __init__(self, names, columns):
+        self.names_list = names
+        self.columns = columns
+        # the rows ordered by the names of their entries, such that the
+        # rows of a name are found by bisection, along with whether the
+        # last of the entries sharing a name is the visible one rather
+        # than the first.
+        self.order = None
+        self.last = False
+        # the timestamps of the packed date_time values seen, as entries
+        # tend to share these.
+        self.mtimes = {}
+
+    @classmethod
+    def from_infolist(cls, infolist, names=None):
+        """
+        Build the table from the infolist.  The names of the entries
+        default to their filenames, but may be provided as a list that
+        is kept as is, such that it can be shared with its owner.
+        """
+
+        if names is None:
+            names = [info.filename for info in infolist]
+        columns = {}
+        for column, attr in COLUMNS:
+            try:
+                values = list(map(attrgetter(attr), infolist))
+            except AttributeError:
+                values = [getattr(info, attr, None) for info in infolist]
+            if None in values:
+                values = [
+                    UNKNOWN if value is None else value for value in values]
+            columns[column] = _column(values)
+        values = [getattr(info, 'date_time', None) for info in infolist]
+        columns['date_time'] = _column([
+            UNKNOWN if value is None else pack_date_time(value)
+            for value in values
+        ])
+        return cls(names, columns)
+
+    def __len__(self):
+        return len(self.names_list)
+
+    def name(self, index):
+        return self.names_list[index]
+
+    def names(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self.name(i) for i in indices]
+
+    def column(self, name):
+        return self.columns[name]
+
+    def sort(self, last=False):
+        """
+        Record the order of the rows by the names of their entries, with
+        the last of the entries sharing a name taken as the visible one
+        if last is set, otherwise the first.
+        """
+
+        names = self.names_list
+        self.order = array(_TYPECODE, sorted(
+            range(len(names)), key=names.__getitem__))
+        self.last = last
+
+    def row(self, name):
+        """
+        Return the index of the entry visible under the name, or None if
+        there is no such entry.
+        """
+
+        names = self.names_list
+        if self.order is None or len(self.order) != len(names):
+            # the names may be added to after the table was built.
+            self.sort(self.last)
+        order = self.order
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = names[order[mid]]
+            if key < name or (self.last and key == name):
+                lo = mid + 1
+            else:
+                hi = mid
+        if self.last:
+            lo -= 1
+        if 0 <= lo < len(order) and names[order[lo]] == name:
+            return order[lo]
+        return None
+
+    def mtime(self, name):
+        """
+        Return the modification time of the entry with the name, or None
+        if it is not known.
+        """
+
+        index = self.row(name)
+        if index is None:
+            return None
+        value = int(self.columns['date_time'][index])
+        if value == UNKNOWN:
+            return None
+        result = self.mtimes.get(value)
+        if result is None:
+            result = self.mtimes[value] = unpack_date_time(value)
+        return result
+
+    def select(self, column, minimum=None, maximum=None):
+        """
+        Return the indices of the entries with a known value within the
+        column that is no less than minimum and no more than maximum.
+        """
+
+        values = self.columns[column]
+        if NUMPY_SUPPORT:
+            mask = values != UNKNOWN
+            if minimum is not None:
+                mask &= values >= minimum
+            if maximum is not None:
+                mask &= values <= maximum
+            return [int(i) for i in numpy.flatnonzero(mask)]
+        return [
+            i for i, value in enumerate(values)
+            if value != UNKNOWN and
+            (minimum is None or value >= minimum) and
+            (maximum is None or value <= maximum)
+        ]
+
+    def total(self, column='file_size'):
+        """
+        Return the sum of the known values within the column.
+        """
+
+        values = self.columns[column]
+        if NUMPY_SUPPORT:
+            return int(values[values != UNKNOWN].sum())
+        return sum(value for value in values if value != UNKNOWN)
+
+    def larger_than(self, size):
+        """
+        Return the names of the entries larger than size.
+        """
+
+        return self.names(self.select('file_size', minimum=size + 1))
+
+    def count_by(self, column='compress_type'):
+        """
+        Return the number of entries for every value of the column.
+        """
+
+        values = self.columns[column]
+        if NUMPY_SUPPORT:
+            keys, counts = numpy.unique(values, return_counts=True)
+            return dict(
+                (int(key), int(count)) for key, count in zip(keys, counts))
+        return dict(Counter(values))
+
+    def total_by(self, column='file_size', key='compress_type'):
+        """
+        Return the sum of the known values of the column for every value
+        of the key column.
+        """
+
+        values = self.columns[column]
+        keys = self.columns[key]
+        if NUMPY_SUPPORT:
+            known = values != UNKNOWN
+            return dict(
+                (int(k), int(values[known & (keys == k)].sum()))
+                for k in numpy.unique(keys)
+            )
+        result = dict((k, 0) for k in keys)
+        for k, value in zip(keys, values):
+            if value != UNKNOWN:
+                result[k] += value
+        return result
@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 from zipfile import ZipFile
 from zipfile import ZipInfo
@@ -10,7 +13,11 @@ except (ImportError, LookupError, OSError) as e:
     RarFile = None
 
 from explosive.fuse.archive import ArchiveFile
+from explosive.fuse.archive import ArchiveHandle
+from explosive.fuse.archive import ArchivePool
 from explosive.fuse.archive import FileNotFoundError
+from explosive.fuse.archive import map_view
+from explosive.fuse.exception import BadArchiveFile
 from explosive.fuse.exception import UnsupportedArchiveFile
 
 path = lambda p: join(dirname(__file__), 'data', p)
@@ -70,6 +77,128 @@ class ArchiveFileZipTestCase(unittest.TestCase):
             'demo/file4', 'demo/file5', 'demo/file6',
         ])
 
+    def test_archive_handle_read(self):
+        demo1 = path('demo1.zip')
+
+        with ArchiveFile(demo1) as af:
+            handle = ArchiveHandle(af)
+            data_offset = af.data_offset(af.archive_file.getinfo('file1'))
+        self.assertFalse(af.archive_file.fp is None)
+        # taken along with the streams reading from the same file.
+        lock = getattr(af.archive_file, '_lock', None)
+        if lock is not None:
+            self.assertIs(af._read_lock, lock)
+
+        # reads from its own position, as the fallback for pread.
+        handle.seek(data_offset)
+        with open(demo1, 'rb') as fd:
+            fd.seek(data_offset)
+            expected = fd.read(4)
+        self.assertEqual(handle.read(2), expected[:2])
+        self.assertEqual(handle.read(2), expected[2:])
+        self.assertEqual(handle.pos, data_offset + 4)
+        handle.close()
+        self.assertIsNone(af.archive_file.fp)
+
+
+class ArchivePoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.demo1 = join(self.tmpdir, 'demo1.zip')
+        self.demo2 = join(self.tmpdir, 'demo2.zip')
+        shutil.copy(path('demo1.zip'), self.demo1)
+        shutil.copy(path('demo2.zip'), self.demo2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_acquire_reuse(self):
+        pool = ArchivePool()
+        with pool.archive(self.demo1) as af1:
+            self.assertEqual(af1.refs, 1)
+        with pool.archive(self.demo1) as af2:
+            pass
+        self.assertIs(af1, af2)
+        self.assertEqual(af1.refs, 0)
+        self.assertIsNotNone(af1.archive_file.fp)
+
+        pool.discard(self.demo1)
+        self.assertEqual(len(pool), 0)
+        self.assertIsNone(af1.archive_file.fp)
+
+    def test_evict_lru(self):
+        pool = ArchivePool(size=1)
+        with pool.archive(self.demo1) as af1:
+            reader = af1.open_reader('file1')
+        with pool.archive(self.demo2) as af2:
+            pass
+        self.assertEqual(list(pool.archives.keys()), [self.demo2])
+        # closing deferred until the reader is done.
+        self.assertTrue(af1.closing)
+        self.assertIsNotNone(af1.archive_file.fp)
+        self.assertEqual(reader.read(), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        reader.close()
+        self.assertIsNone(af1.archive_file.fp)
+
+        pool.close()
+        self.assertEqual(len(pool), 0)
+        self.assertIsNone(af2.archive_file.fp)
+
+    def test_stale(self):
+        pool = ArchivePool()
+        with pool.archive(self.demo1) as af1:
+            self.assertFalse(af1.stale())
+        shutil.copy(path('demo2.zip'), self.demo1 + '.tmp')
+        os.rename(self.demo1 + '.tmp', self.demo1)
+        self.assertTrue(af1.stale())
+        with pool.archive(self.demo1) as af2:
+            self.assertEqual(
+                sorted(f.filename for f in af2.infolist())[0], 'demo/')
+        self.assertIsNot(af1, af2)
+        self.assertIsNone(af1.archive_file.fp)
+
+        os.unlink(self.demo1)
+        self.assertTrue(af2.stale())
+        with self.assertRaises(FileNotFoundError):
+            pool.acquire(self.demo1)
+        self.assertEqual(len(pool), 0)
+
+    def test_mmap(self):
+        pool = ArchivePool(use_mmap=True)
+        with pool.archive(self.demo1) as af:
+            self.assertIsNotNone(af.map)
+            self.assertEqual(
+                sorted(f.filename for f in af.infolist())[0], 'file1')
+            self.assertEqual(af.identity, ArchiveFile(self.demo1).identity)
+            self.assertFalse(af.stale())
+            reader = af.open_reader('file1')
+            self.assertIs(reader.fp.view, af.view)
+        pool.discard(self.demo1)
+        # still mapped for the reader.
+        self.assertFalse(af.map.closed)
+        self.assertEqual(reader.read(), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        reader.close()
+        self.assertTrue(af.map.closed)
+
+    def test_mmap_unviewable(self):
+        # as with Python 2, where a map cannot be viewed.
+        unviewable = object()
+        self.assertIs(map_view(unviewable), unviewable)
+        with ArchiveFile(self.demo1, use_mmap=True) as af:
+            af.view.release()
+            af.view = af.map
+            with af.open_reader('file1') as reader:
+                self.assertEqual(
+                    reader.read(), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertTrue(af.map.closed)
+
+    def test_mmap_empty(self):
+        empty = join(self.tmpdir, 'empty.zip')
+        open(empty, 'wb').close()
+        with self.assertRaises(BadArchiveFile):
+            ArchiveFile(empty, use_mmap=True)
+
 
 @unittest.skipIf(RarFile is None, reason='unrar not found')
 class ArchiveFileRarTestCase(unittest.TestCase):
@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import CachedReader
+from explosive.fuse.cache import DiskCache
+from explosive.fuse.cache import EntryCache
+from explosive.fuse.reader import EntryReader
+
+
+class BytesReader(EntryReader):
+
+    def __init__(self, data, key):
+        super(BytesReader, self).__init__(len(data), key)
+        self.data = data
+        self.reads = []
+
+    def pread(self, size, offset):
+        self.reads.append((size, offset))
+        return self.data[offset:offset + size]
+
+
+class BlockCacheTestCase(unittest.TestCase):
+
+    def test_get_put_lru(self):
+        cache = BlockCache(budget=10, block_size=4)
+        cache.put('a', b'1234')
+        cache.put('b', b'5678')
+        self.assertEqual(cache.get('a'), b'1234')
+        cache.put('c', b'9012')
+        # b was the least recently used.
+        self.assertEqual(list(cache.blocks.keys()), ['a', 'c'])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.used, 8)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+        cache.put('a', b'12')
+        self.assertEqual(cache.used, 6)
+        cache.discard('a')
+        self.assertEqual(cache.used, 4)
+        cache.clear()
+        self.assertEqual(cache.used, 0)
+        self.assertEqual(len(cache), 0)
+
+    def test_put_oversized(self):
+        cache = BlockCache(budget=3, block_size=4)
+        cache.put('a', b'1234')
+        self.assertEqual(len(cache), 0)
+
+    def test_pread(self):
+        cache = BlockCache(budget=100, block_size=4)
+        reader = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(reader, 3, 2), b'234')
+        self.assertEqual(reader.reads, [(4, 0), (4, 4)])
+        self.assertEqual(cache.pread(reader, 2, 4), b'45')
+        self.assertEqual(cache.pread(reader, 20, 0), b'0123456789')
+        self.assertEqual(reader.reads, [(4, 0), (4, 4), (4, 8)])
+        self.assertEqual(cache.pread(reader, 1, 10), b'')
+        self.assertEqual(cache.stats(), {
+            'blocks': 3,
+            'used': 10,
+            'budget': 100,
+            'hits': 3,
+            'misses': 3,
+        })
+
+        # shared by all readers of the same entry
+        other = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(other, 10, 0), b'0123456789')
+        self.assertEqual(other.reads, [])
+
+    def test_pread_uncached(self):
+        cache = BlockCache(budget=0, block_size=4)
+        reader = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(reader, 3, 2), b'234')
+        self.assertEqual(reader.reads, [(3, 2)])
+
+        cache = BlockCache(budget=100, block_size=4)
+        reader.cacheable = False
+        self.assertEqual(cache.pread(reader, 3, 2), b'234')
+        self.assertEqual(reader.reads, [(3, 2), (3, 2)])
+        self.assertEqual(len(cache), 0)
+
+
+class EntryCacheTestCase(unittest.TestCase):
+
+    def test_admits(self):
+        cache = EntryCache(budget=10, threshold=4)
+        self.assertTrue(cache.admits(0))
+        self.assertTrue(cache.admits(4))
+        self.assertFalse(cache.admits(5))
+        cache = EntryCache(budget=3, threshold=4)
+        self.assertFalse(cache.admits(4))
+        cache = EntryCache(budget=10, threshold=0)
+        self.assertFalse(cache.admits(0))
+
+    def test_discard_archive(self):
+        cache = EntryCache(budget=10, threshold=4)
+        a, b = ('a.zip', 1, 2, 3, 4), ('b.zip', 1, 3, 3, 4)
+        cache.put((a, 'file1', 1, 4), b'1234')
+        cache.put((b, 'file1', 2, 2), b'56')
+        cache.put((a, 'file2', 3, 0), b'')
+        self.assertEqual(cache.get((a, 'file2', 3, 0)), b'')
+        cache.discard_archive('a.zip')
+        self.assertEqual(list(cache.items.keys()), [(b, 'file1', 2, 2)])
+        self.assertEqual(cache.stats(), {
+            'entries': 1,
+            'threshold': 4,
+            'used': 2,
+            'budget': 10,
+            'hits': 1,
+            'misses': 0,
+        })
+
+
+class DiskCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_pread(self):
+        cache = DiskCache(self.path, budget=100, chunk_size=4)
+        reader = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(reader, 3, 2), b'234')
+        self.assertEqual(reader.reads, [(4, 0), (4, 4)])
+        self.assertEqual(cache.pread(reader, 20, 0), b'0123456789')
+        self.assertEqual(reader.reads, [(4, 0), (4, 4), (4, 8)])
+        self.assertEqual(cache.pread(reader, 1, 10), b'')
+        self.assertEqual(cache.stats(), {
+            'chunks': 3,
+            'used': 10,
+            'budget': 100,
+            'hits': 2,
+            'misses': 3,
+        })
+        self.assertEqual(len(os.listdir(self.path)), 3)
+
+        # persisted for the next instance.
+        cache = DiskCache(self.path, budget=100, chunk_size=4)
+        self.assertEqual(cache.used, 10)
+        other = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(other, 5, 3), b'34567')
+        self.assertEqual(other.reads, [])
+
+        # different key, or chunk size, are different chunks.
+        other = BytesReader(b'abcdefghij', 'other')
+        self.assertEqual(cache.pread(other, 5, 3), b'defgh')
+        cache = DiskCache(self.path, budget=100, chunk_size=8)
+        self.assertEqual(cache.pread(reader, 5, 3), b'34567')
+        self.assertEqual(reader.reads[-1], (8, 0))
+
+    def test_evict_lru(self):
+        cache = DiskCache(self.path, budget=8, chunk_size=4)
+        reader = BytesReader(b'0123456789ab', 'key')
+        cache.pread(reader, 4, 0)
+        cache.pread(reader, 4, 4)
+        cache.pread(reader, 4, 0)
+        cache.pread(reader, 4, 8)
+        self.assertEqual(cache.used, 8)
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        reads = len(reader.reads)
+        self.assertEqual(cache.pread(reader, 4, 0), b'0123')
+        self.assertEqual(cache.pread(reader, 4, 8), b'89ab')
+        self.assertEqual(len(reader.reads), reads)
+
+        # shrinking the budget evicts on startup.
+        cache = DiskCache(self.path, budget=4, chunk_size=4)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        cache.clear()
+        self.assertEqual(cache.used, 0)
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_missing_or_partial(self):
+        os.makedirs(self.path)
+        with open(os.path.join(self.path, '.tmpabc-' + '0' * 40), 'wb') as fd:
+            fd.write(b'0')
+        cache = DiskCache(self.path, budget=100, chunk_size=4)
+        self.assertEqual(os.listdir(self.path), [])
+
+        reader = BytesReader(b'0123456789', 'key')
+        cache.pread(reader, 4, 0)
+        name = cache._name('key', 0)
+        with open(os.path.join(self.path, name), 'wb') as fd:
+            fd.write(b'01')
+        self.assertEqual(cache.pread(reader, 4, 0), b'0123')
+        os.unlink(os.path.join(self.path, name))
+        self.assertEqual(cache.pread(reader, 4, 0), b'0123')
+        self.assertEqual(reader.reads, [(4, 0), (4, 0), (4, 0)])
+        self.assertEqual(cache.hits, 0)
+
+    def test_foreign_files(self):
+        # files not named as chunks are neither adopted nor evicted.
+        os.makedirs(self.path)
+        names = ['.tmpleftover', 'notes.txt', 'A' * 40]
+        for name in names:
+            with open(os.path.join(self.path, name), 'wb') as fd:
+                fd.write(b'0123456789')
+        cache = DiskCache(self.path, budget=4, chunk_size=4)
+        self.assertEqual(cache.used, 0)
+        reader = BytesReader(b'0123456789', 'key')
+        self.assertEqual(cache.pread(reader, 10, 0), b'0123456789')
+        cache.clear()
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(names))
+
+    def test_uncached(self):
+        cache = DiskCache(self.path, budget=100, chunk_size=4)
+        reader = BytesReader(b'0123456789', 'key')
+        reader.cacheable = False
+        self.assertEqual(cache.pread(reader, 3, 2), b'234')
+        self.assertEqual(reader.reads, [(3, 2)])
+        self.assertEqual(len(cache), 0)
+
+    def test_cached_reader(self):
+        cache = DiskCache(self.path, budget=100, chunk_size=4)
+        reader = CachedReader(BytesReader(b'0123456789', 'key'), cache)
+        self.assertEqual(reader.size, 10)
+        self.assertEqual(reader.key, 'key')
+        self.assertEqual(reader.read(), b'0123456789')
+        self.assertEqual(len(cache), 3)
+        reader.close()
+        self.assertTrue(reader.closed)
+        self.assertTrue(reader.reader.closed)
@@ -1,5 +1,6 @@
 import sys
 import os
+import shutil
 from argparse import ArgumentParser
 from argparse import ArgumentError
 from contextlib import contextmanager
@@ -68,6 +69,52 @@ class PathMakerChoiceTestCase(unittest.TestCase):
         self.assertEqual(ap.dummy.__name__, 'flatten')
 
 
+class FuseOptionsTestCase(unittest.TestCase):
+
+    def options(self, args, invalidation=True):
+        parsed_args = ctrl.get_argparse().parse_args(args + ['dir', 'a.zip'])
+        return ctrl.get_fuse_options(parsed_args, invalidation=invalidation)
+
+    def test_default(self):
+        self.assertEqual(self.options([]), {
+            'attr_timeout': 60.0,
+            'entry_timeout': 60.0,
+            'kernel_cache': True,
+        })
+        # the archives never change without the manager.
+        self.assertEqual(self.options([], invalidation=False), {
+            'attr_timeout': 60.0,
+            'entry_timeout': 60.0,
+            'kernel_cache': True,
+        })
+
+    def test_specified(self):
+        self.assertEqual(self.options([
+            '--attr-timeout', '5', '--entry-timeout', '0.5',
+            '--negative-timeout', '2', '--no-kernel-cache',
+        ]), {
+            'attr_timeout': 5.0,
+            'entry_timeout': 0.5,
+            'negative_timeout': 2.0,
+        })
+
+    def test_manager(self):
+        self.assertEqual(self.options(['-m']), {
+            'attr_timeout': 60.0,
+            'entry_timeout': 60.0,
+            'kernel_cache': True,
+        })
+        # libfuse defaults are kept without the means to invalidate.
+        self.assertEqual(self.options(['-m'], invalidation=False), {})
+        self.assertEqual(self.options(
+            ['-m', '--attr-timeout', '5', '--kernel-cache'],
+            invalidation=False,
+        ), {
+            'attr_timeout': 5.0,
+            'kernel_cache': True,
+        })
+
+
 class IntegrationTestCase(unittest.TestCase):
 
     def test_simple(self):
@@ -97,6 +144,41 @@ class IntegrationTestCase(unittest.TestCase):
             with self.assertRaises(SystemExit):
                 ctrl.main(['-m', '-d', '/tmp/to/no/such/dir', 'somezip.zip'])
 
+    def test_index(self):
+        index_dir = mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(index_dir))
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            ctrl.index_main([
+                '--index-dir', index_dir,
+                path('demo1.zip'), path('demo2.zip')])
+            self.assertEqual(
+                out.items[0], 'indexed 2 of 2 archive(s).')
+        self.assertEqual(len(os.listdir(index_dir)), 2)
+
+    def test_index_failure(self):
+        index_dir = mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(index_dir))
+        with capture_stdio() as stdio:
+            in_, out, err = stdio
+            with self.assertRaises(SystemExit):
+                ctrl.index_main([
+                    '--index-dir', index_dir,
+                    path('demo1.zip'), path('bad.zip')])
+            self.assertEqual(
+                out.items[0], 'indexed 1 of 2 archive(s).')
+
+    def test_index_missing_dir(self):
+        with capture_stdio() as stdio:
+            with self.assertRaises(SystemExit):
+                ctrl.index_main([path('demo1.zip')])
+
+    def test_index_not_a_command(self):
+        # mounting at a directory named index remains possible.
+        parsed_args = ctrl.get_argparse().parse_args(['index', 'a.zip'])
+        self.assertEqual(parsed_args.dir, 'index')
+        self.assertEqual(parsed_args.archives, ['a.zip'])
+
     def test_invalid_layout_choice(self):
         with capture_stdio() as stdio:
             in_, out, err = stdio
@@ -1,13 +1,22 @@
 import unittest
 import tempfile
 import shutil
+from time import mktime
+from threading import Thread
 from os.path import dirname
 from os.path import join
+import zipfile
+from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED
 
 from fuse import FuseOSError
 
+from explosive.fuse.cache import BlockCache
+from explosive.fuse.cache import DiskCache
 from explosive.fuse.fs import ExplosiveFUSE
+from explosive.fuse.fs import kernel_invalidation
 from explosive.fuse.fs import ManagedExplosiveFUSE
+from explosive.fuse.fs import PagedFUSE
 from explosive.fuse.fs import SymlinkFUSE
 from explosive.fuse import pathmaker
 
@@ -16,6 +25,21 @@ path = lambda p: join(dirname(__file__), 'data', p)
 
 class BaseExplosiveFsTestCase(object):
 
+    def make_archive(self, name='deflated.zip', compression=ZIP_DEFLATED):
+        """
+        Write an archive holding a single file of compressible data into
+        a temporary directory, and return the directory, the path to the
+        archive and the data.
+        """
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        target = join(tmpdir, name)
+        data = b''.join(('%d\n' % i).encode('ascii') for i in range(100000))
+        with ZipFile(target, 'w', compression) as zf:
+            zf.writestr('file', data)
+        return tmpdir, target, data
+
     def test_simple(self):
         fs = self.factory([path('demo1.zip')])
         self.assertEqual(fs.mapping.pathmaker.__name__, 'default')
@@ -47,6 +71,34 @@ class BaseExplosiveFsTestCase(object):
         with self.assertRaises(FuseOSError):
             fs.getattr('/file1')
 
+    def test_getattr_records(self):
+        fs = self.factory([path('demo1.zip')], include_arcname=True)
+        record = fs.getattr('/demo1.zip/file1')
+        self.assertEqual(record['st_size'], 33)
+        self.assertEqual(
+            record['st_mtime'], mktime((2015, 10, 18, 17, 46, 8, 0, 0, -1)))
+        # the same record is returned until the mapping is modified.
+        self.assertIs(fs.getattr('/demo1.zip/file1'), record)
+        fs.mapping.load_archive(path('demo2.zip'))
+        self.assertIsNot(fs.getattr('/demo1.zip/file1'), record)
+        self.assertEqual(fs.getattr('/demo1.zip/file1'), record)
+        fs.mapping.unload_archive(path('demo1.zip'))
+        with self.assertRaises(FuseOSError):
+            fs.getattr('/demo1.zip/file1')
+
+    def test_getattr_inode(self):
+        fs = self.factory([path('demo2.zip')], include_arcname=True)
+        self.assertEqual(fs.getattr('/')['st_ino'], 1)
+        inodes = [
+            fs.getattr(p)['st_ino'] for p in (
+                '/demo2.zip', '/demo2.zip/demo', '/demo2.zip/demo/file1',
+                '/demo2.zip/demo/file2')
+        ]
+        self.assertEqual(len(set(inodes)), 4)
+        fs = self.factory([path('demo2.zip')], include_arcname=True)
+        self.assertEqual(fs.getattr('/demo2.zip/demo/file1')['st_ino'],
+            inodes[2])
+
     def test_open_release(self):
         fs = self.factory([path('demo1.zip')], include_arcname=True)
         fh = fs.open('/demo1.zip/file1', 0)
@@ -59,6 +111,81 @@ class BaseExplosiveFsTestCase(object):
         fs.release('/demo1.zip/file1', fh)
         self.assertTrue(fp.closed)
 
+    def test_open_shared(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo2.zip')],
+            include_arcname=True,
+        )
+        fh1 = fs.open('/demo1.zip/file1', 0)
+        fh2 = fs.open('/demo1.zip/file1', 0)
+        fh3 = fs.open('/demo1.zip/file2', 0)
+        fp = fs.open_entries[fh1][0]
+        # handles on the same entry share the reader, but not the
+        # position.
+        self.assertIs(fs.open_entries[fh2][0], fp)
+        self.assertIsNot(fs.open_entries[fh3][0], fp)
+        self.assertEqual(len(fs.shared_readers), 2)
+        self.assertEqual(fs.read('/demo1.zip/file1', 1, 1, fh1), b'0')
+        self.assertEqual(fs.read('/demo1.zip/file1', 1, 0, fh2), b'b')
+        self.assertEqual(fs.open_entries[fh1][1], 2)
+        self.assertEqual(fs.open_entries[fh2][1], 1)
+
+        fs.release('/demo1.zip/file1', fh1)
+        self.assertFalse(fp.closed)
+        self.assertEqual(fs.read('/demo1.zip/file1', 1, 2, fh2), b'2')
+        fs.release('/demo1.zip/file1', fh2)
+        self.assertTrue(fp.closed)
+        self.assertEqual(len(fs.shared_readers), 1)
+        fs.release('/demo1.zip/file2', fh3)
+        self.assertEqual(fs.shared_readers, {})
+
+    @unittest.skipIf(
+        not hasattr(zipfile, 'ZIP_BZIP2'), reason='bzip2 not supported')
+    def test_open_streams_unshared(self):
+        tmpdir, target, data = self.make_archive(
+            'bzip2.zip', zipfile.ZIP_BZIP2)
+
+        fs = self.factory([target], include_arcname=True)
+        fh1 = fs.open('/bzip2.zip/file', 0)
+        fh2 = fs.open('/bzip2.zip/file', 0)
+        fp1 = fs.open_entries[fh1][0]
+        fp2 = fs.open_entries[fh2][0]
+        # streams are only read forward, so each handle has its own.
+        self.assertIsNot(fp1, fp2)
+        self.assertEqual(fs.shared_readers, {})
+        self.assertEqual(
+            fs.read('/bzip2.zip/file', 10, 300000, fh1),
+            data[300000:300010])
+        self.assertEqual(fs.read('/bzip2.zip/file', 10, 10, fh2), data[10:20])
+        fs.release('/bzip2.zip/file', fh1)
+        self.assertTrue(fp1.closed)
+        self.assertFalse(fp2.closed)
+        fs.release('/bzip2.zip/file', fh2)
+        self.assertTrue(fp2.closed)
+
+    def test_open_release_during_read(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo2.zip')],
+            include_arcname=True,
+        )
+        fh1 = fs.open('/demo1.zip/file1', 0)
+        fh2 = fs.open('/demo1.zip/file1', 0)
+        fp = fs.open_entries[fh1][0]
+
+        def work():
+            fs.release('/demo1.zip/file1', fh2)
+            fs.release(
+                '/demo1.zip/file2', fs.open('/demo1.zip/file2', 0))
+
+        # neither open nor release waits on a read in progress.
+        with fp.lock:
+            t = Thread(target=work)
+            t.start()
+            t.join(10)
+            self.assertFalse(t.is_alive())
+        fs.release('/demo1.zip/file1', fh1)
+        self.assertEqual(fs.shared_readers, {})
+
     def test_read(self):
         fs = self.factory(
             [path('demo1.zip'), path('demo2.zip')],
@@ -81,10 +208,80 @@ class BaseExplosiveFsTestCase(object):
         fs.mapping.load_archive(path('demo4.zip'))
         # keep reading should be fine
         self.assertEqual(fs.read('/demo/dir1/file1', 1, 2, fh), b'2')
-        # but try to restart, it will fail because demo4.zip was read.
-        # and overwrite was specified.
-        with self.assertRaises(FuseOSError):
-            fs.read('/demo/dir1/file1', 1, 0, fh)
+        # seeking back is also fine, as the handle remains bound to the
+        # entry it was opened with despite demo4.zip overwriting it.
+        self.assertEqual(fs.read('/demo/dir1/file1', 1, 0, fh), b'b')
+        fh = fs.open('/demo/dir1/file1', 0)
+        self.assertEqual(fs.read('/demo/dir1/file1', 1, 0, fh), b'd')
+
+    def test_read_deflated_shared_cache(self):
+        tmpdir, target, data = self.make_archive()
+
+        fs = self.factory([target], include_arcname=True,
+            block_cache=BlockCache(block_size=4096))
+        fh1 = fs.open('/deflated.zip/file', 0)
+        fh2 = fs.open('/deflated.zip/file', 0)
+        self.assertEqual(
+            fs.read('/deflated.zip/file', 10, 5000, fh1), data[5000:5010])
+        self.assertEqual(fs.block_cache.misses, 1)
+        self.assertEqual(
+            fs.read('/deflated.zip/file', 10, 5000, fh2), data[5000:5010])
+        self.assertEqual(fs.block_cache.hits, 1)
+        self.assertEqual(
+            fs.read('/deflated.zip/file', 8192, 4090, fh2),
+            data[4090:4090 + 8192])
+        self.assertEqual(fs.block_cache.hits, 2)
+        self.assertEqual(fs.block_cache.misses, 3)
+
+    def test_read_disk_cache(self):
+        tmpdir, target, data = self.make_archive()
+
+        fs = self.factory([target], include_arcname=True,
+            block_cache=BlockCache(block_size=4096),
+            disk_cache=DiskCache(join(tmpdir, 'cache'), chunk_size=4096))
+        fh = fs.open('/deflated.zip/file', 0)
+        self.assertEqual(
+            fs.read('/deflated.zip/file', 10, 5000, fh), data[5000:5010])
+        fs.release('/deflated.zip/file', fh)
+        self.assertEqual(fs.disk_cache.misses, 1)
+
+        # a fresh mount serves the same data from the persisted chunks.
+        fs = self.factory([target], include_arcname=True,
+            block_cache=BlockCache(block_size=4096),
+            disk_cache=DiskCache(join(tmpdir, 'cache'), chunk_size=4096))
+        fh = fs.open('/deflated.zip/file', 0)
+        self.assertEqual(
+            fs.read('/deflated.zip/file', 10, 5000, fh), data[5000:5010])
+        self.assertEqual(fs.disk_cache.hits, 1)
+        self.assertEqual(fs.disk_cache.misses, 0)
+        fs.release('/deflated.zip/file', fh)
+
+    def test_read_concurrent(self):
+        tmpdir, target, data = self.make_archive()
+
+        fs = self.factory([target], include_arcname=True,
+            block_cache=BlockCache(block_size=4096))
+        fh = fs.open('/deflated.zip/file', 0)
+        results = {}
+
+        def work(n):
+            fh_n = fs.open('/deflated.zip/file', 0)
+            for offset in range(n * 1000, len(data), 50000):
+                # both the shared and an exclusive handle.
+                for h in (fh, fh_n):
+                    if fs.read('/deflated.zip/file', 100, offset, h) != (
+                            data[offset:offset + 100]):
+                        results[n] = False
+                        return
+            fs.release('/deflated.zip/file', fh_n)
+            results[n] = True
+
+        threads = [Thread(target=work, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, dict((n, True) for n in range(8)))
 
     def test_read_no_such_path(self):
         fs = self.factory([path('demo3.zip')],
@@ -114,6 +311,59 @@ class BaseExplosiveFsTestCase(object):
                 '.', '..', 'file1', 'file2', 'file3', 'file4',
                 'file5', 'file6'])
 
+    def test_readdir_paged(self):
+        fs = self.factory([path('demo1.zip')], include_arcname=True)
+        names = [
+            '.', '..', 'file1', 'file2', 'file3', 'file4', 'file5', 'file6']
+        listing = fs.readdir('/demo1.zip', 0)
+        self.assertEqual(sorted(listing), names)
+        self.assertEqual(
+            [(name, i) for name, attrs, i in fs.readdir('/demo1.zip', 0, 0)],
+            [(name, i) for i, name in enumerate(listing, 1)])
+        self.assertEqual(
+            [(name, i) for name, attrs, i in fs.readdir('/demo1.zip', 0, 5)],
+            [(name, i) for i, name in enumerate(listing[5:], 6)])
+        self.assertEqual(list(fs.readdir('/demo1.zip', 0, 8)), [])
+
+    def test_readdir_attrs(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo2.zip')], include_arcname=True)
+        result = list(fs.readdir('/demo2.zip', 0, 0))
+        self.assertEqual(result[0][1], fs.getattr('/demo2.zip'))
+        self.assertIsNone(result[1][1])
+        self.assertEqual(result[2][1], fs.getattr('/demo2.zip/demo'))
+
+        result = dict(
+            (name, attrs) for name, attrs, offset in fs.readdir(
+                '/demo1.zip', 0, 2))
+        self.assertEqual(sorted(result), [
+            'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+        for name, attrs in result.items():
+            self.assertEqual(attrs, fs.getattr('/demo1.zip/' + name))
+            self.assertEqual(attrs['st_mode'], 0o100444)
+        # the records listed are kept for the lookups that follow.
+        generation, records = fs.stat_records
+        self.assertIs(records['/demo1.zip/file1'], result['file1'])
+
+    def test_readdir_snapshot(self):
+        fs = self.factory([path('demo1.zip')], include_arcname=True)
+        listing = fs.readdir('/', 0)
+        # the listing is kept until the mapping is modified.
+        self.assertIs(fs._listing('/'), fs._listing('/'))
+
+        fh = fs.opendir('/')
+        self.assertEqual(next(fs.readdir('/', fh, 0))[::2], ('.', 1))
+        fs.mapping.load_archive(path('demo2.zip'))
+        self.assertEqual(sorted(fs.readdir('/', 0)), sorted(
+            listing + ['demo2.zip']))
+        # the handle opened before the archive was loaded keeps listing
+        # what was there when it was opened.
+        self.assertEqual(
+            [name for name, attrs, offset in fs.readdir('/', fh, 2)],
+            listing[2:])
+        fs.releasedir('/', fh)
+        self.assertEqual(fs.open_listings, {})
+
     def test_readdir_omit_arcname(self):
         fs = self.factory(
             [path('demo1.zip'), path('demo2.zip')],
@@ -137,6 +387,21 @@ class BaseExplosiveFsTestCase(object):
         fh = fs.open('/demo1/file1', 0)
         self.assertEqual(fs.read('/demo1/file1', 1, 0, fh), b'b')
 
+    def test_lazy(self):
+        fs = self.factory(
+            [path('demo1.zip'), path('demo2.zip')],
+            include_arcname=True, lazy=True,
+        )
+        self.assertEqual(fs.getattr('/demo1.zip')['st_mode'], 0o40555)
+        self.assertEqual(len(fs.mapping.archive_ifilenames), 0)
+        self.assertEqual(
+            sorted(fs.readdir('/demo1.zip', None)),
+            ['.', '..', 'file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+        fh = fs.open('/demo2.zip/demo/file1', 0)
+        self.assertEqual(fs.read('/demo2.zip/demo/file1', 1, 0, fh), b'b')
+        fs.release('/demo2.zip/demo/file1', fh)
+        self.assertEqual(len(fs.mapping.archive_ifilenames), 2)
+
     def test_statfs(self):
         fs = self.factory(
             [path('demo1.zip'), path('demo2.zip')],
@@ -145,6 +410,9 @@ class BaseExplosiveFsTestCase(object):
         report = fs.statfs('/')
         # This should always be true.
         self.assertEqual(report['f_bavail'], 0)
+        # the 12 files of 33 bytes each, and the directory entry.
+        self.assertEqual(report['f_blocks'], 1)
+        self.assertEqual(report['f_files'], 13)
 
 
 class ExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
@@ -257,6 +525,17 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         self.assertEqual(sorted(fs('readdir', '/.management', 0)), [
                 '.', '..', 'demo2.zip'])
 
+    def test_readdir_attrs_management(self):
+        fs = ManagedExplosiveFUSE('/mnt', 'file1', [path('demo1.zip')])
+        result = dict(
+            (name, attrs) for name, attrs, offset in fs('readdir', '/', 0, 2))
+        self.assertEqual(result['file1']['st_mode'], 0o40555)
+        self.assertEqual(result['file2']['st_mode'], 0o100444)
+        self.assertEqual(
+            [(name, attrs['st_mode']) for name, attrs, offset in fs(
+                'readdir', '/file1', 0, 2)],
+            [('demo1.zip', 0o120444)])
+
     def test_getattr_mangement(self):
         fs = ManagedExplosiveFUSE('/mnt', '.management', [])
         self.assertEqual(fs('getattr', '/.management')['st_mode'], 0o40555)
@@ -280,6 +559,71 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         fs('unlink', '/.management/demo1.zip')
         self.assertEqual(fs('readdir', '/', 0), ['.', '..', '.management'])
 
+    def test_symlink_invalidate(self):
+        invalidated = []
+
+        class RecordingFUSE(ManagedExplosiveFUSE):
+            def invalidate(self, paths):
+                invalidated.append(sorted(paths))
+
+        fs = RecordingFUSE('/mnt', '.management', [], include_arcname=True)
+        fs('symlink', '/.management/demo2.zip', path('demo2.zip'))
+        self.assertEqual(invalidated, [['/demo2.zip']])
+        fs('unlink', '/.management/demo2.zip')
+        self.assertEqual(invalidated, [['/demo2.zip'], ['/demo2.zip']])
+
+        invalidated[:] = []
+        fs = RecordingFUSE('/mnt', '.management', [])
+        fs('symlink', '/.management/demo2.zip', path('demo2.zip'))
+        fs('symlink', '/.management/demo1.zip', path('demo1.zip'))
+        fs('unlink', '/.management/demo2.zip')
+        self.assertEqual(invalidated, [
+            ['/demo'],
+            ['/file1', '/file2', '/file3', '/file4', '/file5', '/file6'],
+            ['/demo'],
+        ])
+
+        # nothing is invalidated for the archives that failed to load.
+        invalidated[:] = []
+        with self.assertRaises(FuseOSError):
+            fs('symlink', '/.management/bad_archive', '/no_such_archive')
+        self.assertEqual(invalidated, [])
+
+    def test_kernel_invalidation(self):
+        calls = []
+
+        def notify_inval_entry(*a):
+            calls.append(a)
+            return 0
+
+        libfuse = type('libfuse', (object,), {})()
+        libfuse.fuse_get_session = lambda fuse_ptr: ('session', fuse_ptr)
+        libfuse.fuse_session_next_chan = lambda se, ch: ('chan', se)
+        libfuse.fuse_lowlevel_notify_inval_entry = notify_inval_entry
+
+        self.assertIsNone(kernel_invalidation(object()))
+        invalidate_path = kernel_invalidation(libfuse)
+        self.assertEqual(invalidate_path('fuse', b'/demo2.zip'), 0)
+        self.assertEqual(calls, [
+            (('chan', ('session', 'fuse')), 1, b'demo2.zip', 9)])
+        # nested paths and the root itself are left alone.
+        self.assertIsNone(invalidate_path('fuse', b'/demo/file1'))
+        self.assertIsNone(invalidate_path('fuse', b'/'))
+        self.assertEqual(len(calls), 1)
+
+    def test_symlink_lazy_bad_archive(self):
+        fs = ManagedExplosiveFUSE(
+            '/mnt', '.management', [], include_arcname=True, lazy=True)
+        # only found to be bad once accessed.
+        fs('symlink', '/.management/bad.zip', path('bad.zip'))
+        self.assertEqual(
+            sorted(fs('readdir', '/.management', 0)), ['.', '..', 'bad.zip'])
+        with self.assertRaises(FuseOSError):
+            fs('getattr', '/bad.zip/file')
+        self.assertEqual(sorted(fs('readdir', '/', 0)), [
+            '.', '..', '.management'])
+        self.assertEqual(sorted(fs('readdir', '/.management', 0)), ['.', '..'])
+
     def test_symlink_bad_archive(self):
         fs = ManagedExplosiveFUSE('/mnt', '.management', [])
         self.assertEqual(fs.readdir('/.management', 0), ['.', '..'])
@@ -309,6 +653,51 @@ class ManagedExplosiveFsTestCase(BaseExplosiveFsTestCase, unittest.TestCase):
         self.assertEqual(fs('getattr', '/demo1.zip')['st_mode'], 0o40555)
 
 
+class PagedFUSETestCase(unittest.TestCase):
+
+    class FileInfo(object):
+
+        def __init__(self, fh):
+            self.contents = self
+            self.fh = fh
+
+    def readdir(self, operations, offset, size):
+        # the bindings without the mount, as from after its creation.
+        bindings = PagedFUSE.__new__(PagedFUSE)
+        bindings.operations = operations
+        bindings.encoding = 'utf-8'
+        bindings.use_ns = False
+        filled = []
+
+        def filler(buf, name, st, offset):
+            if len(filled) >= size:
+                return 1
+            filled.append((name, offset))
+            return 0
+
+        self.assertEqual(bindings.readdir(
+            b'/demo1.zip', None, filler, offset, self.FileInfo(0)), 0)
+        return filled
+
+    def test_readdir(self):
+        fs = ExplosiveFUSE([path('demo1.zip')], include_arcname=True)
+        listing = fs.readdir('/demo1.zip', 0)
+        self.assertEqual(self.readdir(fs, 0, 3), [
+            (name.encode('utf8'), i) for i, name in enumerate(
+                listing[:3], 1)])
+        self.assertEqual(self.readdir(fs, 3, 3), [
+            (name.encode('utf8'), i) for i, name in enumerate(
+                listing[3:6], 4)])
+        self.assertEqual(self.readdir(fs, 6, 3), [
+            (name.encode('utf8'), i) for i, name in enumerate(
+                listing[6:], 7)])
+
+    def test_readdir_names(self):
+        # operations listing only the names leave the paging to libfuse.
+        self.assertEqual(self.readdir(
+            lambda op, path, *a: ['.', '..'], 0, 8), [(b'.', 0), (b'..', 0)])
+
+
 class SymlinkFUSETestCase(unittest.TestCase):
 
     def test_simple(self):
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+from os.path import dirname
+from os.path import join
+
+from explosive.fuse.archive import ArchiveFile
+from explosive.fuse.archive import ArchivePool
+from explosive.fuse.index import ArchiveIndex
+from explosive.fuse.index import IndexedInfo
+from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.mapper import _read_indexedinfos
+from explosive.fuse.table import ArchiveTable
+
+path = lambda p: join(dirname(__file__), 'data', p)
+
+
+class ArchiveIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = ArchiveIndex(join(self.tmpdir, 'index'))
+        self.demo1 = join(self.tmpdir, 'demo1.zip')
+        shutil.copy(path('demo1.zip'), self.demo1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build(self):
+        self.assertIsNone(self.index.get(self.demo1))
+        self.assertTrue(self.index.build(self.demo1))
+        infolist = self.index.get(self.demo1)
+        self.assertEqual(len(infolist), 6)
+        self.assertEqual(infolist[0].filename, 'file1')
+        self.assertEqual(infolist[0].file_size, 33)
+        with ArchiveFile(self.demo1) as af:
+            info = af.archive_file.getinfo('file1')
+            self.assertEqual(infolist[0].data_offset, af.data_offset(info))
+        self.assertEqual(
+            sorted(self.index.data_offsets(self.demo1).keys()),
+            ['file1', 'file2', 'file3', 'file4', 'file5', 'file6'])
+        # already indexed.
+        self.assertTrue(self.index.build(self.demo1))
+
+    def test_build_failure(self):
+        self.assertFalse(self.index.build(join(self.tmpdir, 'no_such.zip')))
+        self.assertFalse(self.index.build(path('bad.zip')))
+        self.assertEqual(os.listdir(self.index.path), [])
+
+    def test_put_unresolved(self):
+        with ArchiveFile(self.demo1) as af:
+            self.assertTrue(self.index.put(af))
+        info = af.archive_file.getinfo('file1')
+        self.assertEqual(self.index.get(self.demo1)[0], IndexedInfo(
+            'file1', 33, None, (2015, 10, 18, 17, 46, 8),
+            info.compress_size, info.CRC, info.compress_type))
+        self.assertEqual(self.index.data_offsets(self.demo1), {})
+
+    def test_changed(self):
+        self.index.build(self.demo1)
+        shutil.copy(path('demo2.zip'), self.demo1 + '.tmp')
+        os.rename(self.demo1 + '.tmp', self.demo1)
+        self.assertIsNone(self.index.get(self.demo1))
+        self.assertEqual(self.index.data_offsets(self.demo1), {})
+        os.unlink(self.demo1)
+        self.assertIsNone(self.index.get(self.demo1))
+
+    def test_corrupted(self):
+        self.index.build(self.demo1)
+        with open(self.index._target(self.demo1), 'w') as fd:
+            fd.write('{')
+        self.assertIsNone(self.index.get(self.demo1))
+
+    def test_mapper(self):
+        self.index.build(self.demo1)
+        m = DefaultMapper(index=self.index)
+        self.assertTrue(m.load_archive(self.demo1))
+        # loaded without parsing the archive.
+        self.assertEqual(len(m.pool), 0)
+        self.assertEqual(m.mapping['file1'], (self.demo1, 'file1', 33))
+        self.assertEqual(
+            m.readfile('file1'), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+
+    def test_mapper_table(self):
+        with ArchiveFile(self.demo1) as af:
+            expected = ArchiveTable.from_infolist(af.infolist())
+        columns = ('file_size', 'compress_size', 'crc', 'compress_type',
+            'date_time')
+
+        def check(table):
+            for column in columns:
+                self.assertEqual(
+                    list(table.column(column)),
+                    list(expected.column(column)))
+
+        self.index.build(self.demo1)
+        m = DefaultMapper(index=self.index)
+        self.assertTrue(m.load_archive(self.demo1))
+        check(m.archive_tables[self.demo1])
+        # as sent back by the worker processes.
+        check(ArchiveTable.from_infolist(_read_indexedinfos(self.demo1)))
+
+    def test_mapper_unindexed(self):
+        m = DefaultMapper(index=self.index)
+        self.assertTrue(m.load_archive(self.demo1))
+        self.assertEqual(len(m.pool), 1)
+        self.assertEqual(len(self.index.get(self.demo1)), 6)
+
+    def test_pool_data_offsets(self):
+        self.index.build(self.demo1)
+        pool = ArchivePool(index=self.index)
+        with pool.archive(self.demo1) as af:
+            self.assertEqual(len(af.data_offsets), 6)
+            with af.open_reader('file1') as reader:
+                self.assertEqual(
+                    reader.read(), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
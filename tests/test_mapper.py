@@ -1,10 +1,26 @@
+import gc
+import os
+import shutil
+import tempfile
 import unittest
+from threading import Thread
+from time import mktime
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
 from zipfile import ZipFile
 from zipfile import ZipInfo
 from os.path import dirname
 from os.path import join
 
+from explosive.fuse.cache import EntryCache
+from explosive.fuse.mapper import ArchivePlaceholder
+from explosive.fuse.index import IndexedInfo
 from explosive.fuse.mapper import DefaultMapper
+from explosive.fuse.mapper import ENTRY_MEMORY_TARGET
+from explosive.fuse.mapper import inode_number
+from explosive.fuse.reader import MemoryReader
 
 path = lambda p: join(dirname(__file__), 'data', p)
 
@@ -15,6 +31,17 @@ def zipinfo(name, size=0):
     return zi
 
 
+def walk_nodes(current, prefix=''):
+    # the full paths of every node within the mapping, as the index of
+    # the mapper is expected to have them.
+    result = {} if prefix else {'': current}
+    for name, node in current.items():
+        result[prefix + name] = node
+        if isinstance(node, dict):
+            result.update(walk_nodes(node, prefix + name + '/'))
+    return result
+
+
 class DefaultMapperTestCase(unittest.TestCase):
 
     maxDiff = 12300
@@ -395,9 +422,6 @@ class DefaultMapperTestCase(unittest.TestCase):
             ['/tmp/demo1.zip', '/tmp/demo2.zip', '/tmp/demo3.zip']
         )
 
-        # lazy way to check
-        old_reverse_mapping = str(m.reverse_mapping)
-
         m._unload_infolist('/tmp/demo2.zip')
 
         # Not the oldest entry
@@ -409,7 +433,11 @@ class DefaultMapperTestCase(unittest.TestCase):
             'file5': ('/tmp/demo1.zip', 'demo/file5', 33),
             'file6': ('/tmp/demo1.zip', 'demo/file6', 33),
         })
-        self.assertEqual(str(m.reverse_mapping), old_reverse_mapping)
+        # its entries are gone from the reverse mapping right away.
+        self.assertEqual(
+            list(f[0] for f in m.reverse_mapping['demo/file1']),
+            ['/tmp/demo1.zip', '/tmp/demo3.zip']
+        )
         self.assertEqual(len(m.archives), 2)
         self.assertNotIn('/tmp/demo2.zip', m.archives)
         self.assertEqual(
@@ -545,7 +573,7 @@ class DefaultMapperTestCase(unittest.TestCase):
         })
         self.assertEqual(
             list(f[0] for f in m.reverse_mapping['demo/']),
-           ['/tmp/demo1.zip', '/tmp/demo2.zip', '/tmp/demo4.zip']
+            ['/tmp/demo2.zip', '/tmp/demo4.zip']
         )
 
         m._unload_infolist('/tmp/demo2.zip')
@@ -554,7 +582,7 @@ class DefaultMapperTestCase(unittest.TestCase):
         })
         self.assertEqual(
             list(f[0] for f in m.reverse_mapping['demo/']),
-           ['/tmp/demo1.zip', '/tmp/demo2.zip', '/tmp/demo4.zip']
+            ['/tmp/demo4.zip']
         )
 
         # Finally everything that can be cleaned, cleaned.
@@ -792,7 +820,531 @@ class DefaultMapperTestCase(unittest.TestCase):
         m.load_archive(demo4)
         self.assertEqual(m.open('demo/dir1/file1')[1].read(1), b'b')
 
+    def test_mapping_entry_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        target = join(tmpdir, 'demo1.zip')
+        shutil.copy(path('demo1.zip'), target)
+        m = DefaultMapper(target, entry_cache=EntryCache(threshold=33))
+        self.assertEqual(
+            m.readfile('file1'), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        with m.pool.archive(target) as af:
+            key = af.entry_key('file1')
+        self.assertEqual(list(m.entry_cache.items.keys()), [key])
+        # served without reading the entry again.
+        self.assertEqual(
+            m.readfile('file1'), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        fp = m.open('file1')[1]
+        self.assertTrue(isinstance(fp, MemoryReader))
+        self.assertEqual(fp.pread(4, 1), b'0263')
+        self.assertEqual(m.entry_cache.hits, 2)
+
+        # the contents of an archive replaced in place are not served.
+        replacement = join(tmpdir, 'replacement.zip')
+        with ZipFile(replacement, 'w') as zf:
+            zf.writestr('file1', b'0' * 33)
+        os.rename(replacement, target)
+        self.assertEqual(m.readfile('file1'), b'0' * 33)
+        self.assertEqual(m.open('file1')[1].pread(4, 1), b'0000')
+        self.assertEqual(m.entry_cache.hits, 3)
+        self.assertEqual(len(m.entry_cache), 2)
+        m.unload_archive(target)
+        self.assertEqual(len(m.entry_cache), 0)
+
+    def test_mapping_entry_cache_threshold(self):
+        m = DefaultMapper(
+            path('demo1.zip'), entry_cache=EntryCache(threshold=32))
+        self.assertFalse(isinstance(m.open('file1')[1], MemoryReader))
+        self.assertEqual(
+            m.readfile('file1'), b'b026324c6904b2a9cb4b88d6d61c81d1\n')
+        self.assertEqual(len(m.entry_cache), 0)
+
     def test_mapping_open_missing(self):
         m = DefaultMapper()
         m._load_infolist('/nowhere/no_such_file.zip', [zipinfo('demo.txt')])
         self.assertFalse(m.open('demo.txt'))
+
+    def test_mapping_concurrent_load_unload(self):
+        m = DefaultMapper(include_arcname=True)
+        m.load_archive(path('demo1.zip'))
+        errors = []
+
+        def churn():
+            try:
+                for i in range(50):
+                    m.load_archive(path('demo2.zip'))
+                    m.unload_archive(path('demo2.zip'))
+            except Exception as e:
+                errors.append(e)
+
+        def lookup():
+            try:
+                for i in range(500):
+                    self.assertTrue(m.traverse('demo1.zip/file1'))
+                    m.traverse('demo2.zip/demo/file2')
+                    m.readdir('demo2.zip/demo')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=churn), Thread(target=lookup)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertIsNone(m.traverse('demo2.zip/demo/file2'))
+
+    def test_load_infolist_nodes(self):
+        m = DefaultMapper(include_arcname=True)
+        m._load_infolist('/tmp/a.zip', [zipinfo('dir/file')])
+        m._load_infolist('/tmp/b.zip', [zipinfo('dir/file')])
+        # the names are shared.
+        self.assertIs(
+            list(m.mapping['a.zip'].keys())[0],
+            list(m.mapping['b.zip'].keys())[0])
+        self.assertEqual(m.reverse_mapping['a.zip/dir/file'], (
+            ('/tmp/a.zip', 'dir/file', 0),))
+        self.assertEqual(len(m.archive_tables['/tmp/a.zip']), 1)
+        m.unload_archive('/tmp/a.zip')
+        self.assertEqual(list(m.archive_tables.keys()), ['/tmp/b.zip'])
+
+    @unittest.skipIf(tracemalloc is None, 'tracemalloc not available')
+    def test_load_infolist_memory(self):
+        count = 20000
+        infolist = [
+            IndexedInfo('dir%d/sub%d/file%d.txt' % (i % 50, i % 7, i), i, None)
+            for i in range(count)
+        ]
+        m = DefaultMapper(include_arcname=True)
+        tracemalloc.start()
+        try:
+            m._load_infolist('/tmp/archive.zip', infolist)
+            used, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertTrue(used / count < ENTRY_MEMORY_TARGET, used / count)
+
+    def test_mtime_duplicates(self):
+        infolist = [
+            IndexedInfo('file', 1, None, (2001, 2, 3, 4, 5, 6)),
+            IndexedInfo('dir/other', 1, None, (2001, 2, 3, 4, 5, 6)),
+            IndexedInfo('file', 2, None, (2002, 2, 3, 4, 5, 6)),
+        ]
+        first = mktime((2001, 2, 3, 4, 5, 6, 0, 0, -1))
+        last = mktime((2002, 2, 3, 4, 5, 6, 0, 0, -1))
+        for overwrite, size, expected in (
+                (False, 1, first), (True, 2, last)):
+            m = DefaultMapper(overwrite=overwrite)
+            m._load_infolist('/tmp/archive.zip', infolist)
+            m._load_infolist('/tmp/other.zip', [
+                IndexedInfo('file', 3, None, (2003, 2, 3, 4, 5, 6))])
+            m.unload_archive('/tmp/other.zip')
+            fentry = m.mapping['file']
+            self.assertEqual(fentry.ifile_size, size)
+            self.assertEqual(m.mtime('file', fentry), expected)
+
+    def test_load_archives_parallel(self):
+        paths = [
+            path('demo3.zip'), path('bad.zip'), path('demo4.zip'),
+            path('demo1.zip'), path('no_such.zip'),
+        ]
+        for overwrite in (False, True):
+            m1 = DefaultMapper(overwrite=overwrite)
+            self.assertEqual(m1.load_archives(paths), 3)
+            m2 = DefaultMapper(overwrite=overwrite)
+            self.assertEqual(m2.load_archives(paths, processes=2), 3)
+            self.assertEqual(m1.mapping, m2.mapping)
+            self.assertEqual(
+                dict(m1.reverse_mapping), dict(m2.reverse_mapping))
+            self.assertEqual(
+                list(m1.archive_ifilenames.keys()),
+                list(m2.archive_ifilenames.keys()))
+        self.assertEqual(
+            m2.readfile('demo/dir1/file1'),
+            b'demo4.zip demo/dir1/file1\n')
+
+    def test_load_archive_pathmaker_failure(self):
+        def failing(inner_path):
+            if inner_path == 'file4':
+                raise UnicodeDecodeError('utf8', b'\xff', 0, 1, 'invalid')
+            frags = inner_path.split('/')
+            return frags, frags.pop()
+
+        m = DefaultMapper(_pathmaker=failing)
+        self.assertTrue(m.load_archive(path('demo2.zip')))
+        mapping = dict(m.mapping)
+        # demo1.zip got as far as file3 before failing.
+        self.assertFalse(m.load_archive(path('demo1.zip')))
+        self.assertEqual(m.mapping, mapping)
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+        self.assertEqual(list(m.archives), [path('demo2.zip')])
+        self.assertEqual(list(m.archive_ifilenames), [path('demo2.zip')])
+        self.assertEqual(list(m.archive_tables), [path('demo2.zip')])
+        self.assertEqual(list(m.layers), [path('demo2.zip')])
+        self.assertEqual(
+            sorted(m.reverse_mapping),
+            sorted(m.archive_ifilenames[path('demo2.zip')]))
+
+        m = DefaultMapper(_pathmaker=failing)
+        self.assertEqual(m.load_archives(
+            [path('demo1.zip'), path('demo2.zip')], processes=2), 1)
+        self.assertEqual(list(m.archives), [path('demo2.zip')])
+
+    def test_nodes_index(self):
+        for overwrite in (False, True):
+            m = DefaultMapper(overwrite=overwrite)
+            m.mkdir(['demo', 'empty'])
+            for name in ('demo3.zip', 'demo4.zip', 'demo2.zip'):
+                m.load_archive(path(name))
+                self.assertEqual(m.nodes, walk_nodes(m.mapping))
+            self.assertEqual(
+                m.traverse('demo/dir3/dir3/file5'),
+                m.mapping['demo']['dir3']['dir3']['file5'])
+            self.assertIs(m.traverse('demo/dir1'), m.mapping['demo']['dir1'])
+            self.assertIsNone(m.traverse('demo/dir1/file1/nothing'))
+            self.assertIsNone(m.traverse('demo/dir1/'))
+            for name in ('demo4.zip', 'demo2.zip', 'demo3.zip'):
+                m.unload_archive(path(name))
+                self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+    def test_nodes_index_replaced_mapping(self):
+        m = DefaultMapper()
+        m.mapping = {'dir': {'file': ('somezip.zip', 'file', 1)}}
+        self.assertEqual(m.traverse('dir/file'), ('somezip.zip', 'file', 1))
+        self.assertIs(m.mkdir(['dir']), m.mapping['dir'])
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+    def test_inode_number_bytes(self):
+        # names may be byte strings on Python 2, taken as they are.
+        name = u'caf\xe9'
+        self.assertEqual(
+            inode_number(b'', name.encode('utf8')), inode_number(b'', name))
+        self.assertNotEqual(
+            inode_number(b'', name.encode('latin1')), inode_number(b'', name))
+
+    def test_inode(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        target = join(tmpdir, 'demo.zip')
+        shutil.copy(path('demo2.zip'), target)
+
+        def inodes(m):
+            return dict(
+                (key, m.inode(key, node)) for key, node in m.nodes.items())
+
+        m = DefaultMapper(include_arcname=True)
+        m.load_archive(target)
+        m.load_archive(path('demo1.zip'))
+        result = inodes(m)
+        self.assertEqual(result[''], 1)
+        self.assertEqual(len(set(result.values())), len(result))
+        self.assertTrue(all(0 < ino < 1 << 63 for ino in result.values()))
+
+        # the same across instances, regardless of the order loaded.
+        m = DefaultMapper(include_arcname=True)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(target)
+        self.assertEqual(inodes(m), result)
+
+        # the files take new numbers once their archive is changed,
+        # unlike the directories.
+        m.unload_archive(target)
+        self.assertNotIn(target, m.inode_seeds)
+        with ZipFile(target, 'a') as zf:
+            zf.writestr('demo/new', b'new')
+        m.load_archive(target)
+        changed = inodes(m)
+        self.assertEqual(
+            changed['demo.zip/demo'], result['demo.zip/demo'])
+        self.assertNotEqual(
+            changed['demo.zip/demo/file1'], result['demo.zip/demo/file1'])
+        self.assertEqual(
+            changed['demo1.zip/file1'], result['demo1.zip/file1'])
+
+    def test_toplevel_paths(self):
+        demo1 = path('demo1.zip')
+        demo2 = path('demo2.zip')
+        m = DefaultMapper(include_arcname=True)
+        m.load_archive(demo1)
+        self.assertEqual(m.toplevel_paths(demo1), {'/demo1.zip'})
+        self.assertEqual(m.toplevel_paths(demo2), set())
+
+        m = DefaultMapper()
+        m.load_archive(demo1)
+        m.load_archive(demo2)
+        self.assertEqual(m.toplevel_paths(demo1), set(
+            '/file%d' % i for i in range(1, 7)))
+        self.assertEqual(m.toplevel_paths(demo2), {'/demo'})
+
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        m.load_archive(demo1)
+        self.assertEqual(m.toplevel_paths(demo1), {'/demo1.zip'})
+
+    def test_unload_prune(self):
+        m = DefaultMapper()
+        m._load_infolist('/tmp/a.zip', [zipinfo('x/'), zipinfo('x/a/')])
+        m._load_infolist('/tmp/b.zip', [
+            zipinfo('x/a/b/c/file'), zipinfo('x/d/e/file')])
+
+        def fail(*a):
+            raise AssertionError('walked from the root')
+
+        m._traverse = fail
+        m._unload_infolist('/tmp/b.zip')
+        # the directories still declared by a.zip remain.
+        self.assertEqual(m.mapping, {'x': {'a': {}}})
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+        m._unload_infolist('/tmp/a.zip')
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+    def test_layers(self):
+        for overwrite, visible in ((False, 'a'), (True, 'd')):
+            m = DefaultMapper(overwrite=overwrite)
+            for name in 'abcd':
+                m._load_infolist('/tmp/%s.zip' % name, [zipinfo('file')])
+            self.assertEqual(m.traverse('file').archive_path,
+                '/tmp/%s.zip' % visible)
+            # unloading from the middle leaves no entries behind.
+            m._unload_infolist('/tmp/b.zip')
+            m._unload_infolist('/tmp/c.zip')
+            self.assertEqual(
+                [f.archive_path for f in m.reverse_mapping['file']],
+                ['/tmp/a.zip', '/tmp/d.zip'])
+            self.assertEqual(m.traverse('file').archive_path,
+                '/tmp/%s.zip' % visible)
+            self.assertEqual(sorted(m.layers), ['/tmp/a.zip', '/tmp/d.zip'])
+
+            # archives loaded again are placed above all others.
+            m._load_infolist('/tmp/b.zip', [zipinfo('file')])
+            self.assertEqual(
+                [f.archive_path for f in m.reverse_mapping['file']],
+                ['/tmp/a.zip', '/tmp/d.zip', '/tmp/b.zip'])
+            m._unload_infolist('/tmp/%s.zip' % visible)
+            self.assertEqual(m.traverse('file').archive_path,
+                '/tmp/%s.zip' % ('d' if visible == 'a' else 'b'))
+
+    def test_layers_duplicates(self):
+        for overwrite in (False, True):
+            m = DefaultMapper(overwrite=overwrite)
+            m._load_infolist('/tmp/a.zip', [zipinfo('file', 1)])
+            m._load_infolist('/tmp/b.zip', [
+                zipinfo('file', 2), zipinfo('file', 3)])
+            m._load_infolist('/tmp/c.zip', [zipinfo('file', 4)])
+            self.assertEqual(
+                [f.ifile_size for f in m.reverse_mapping['file']],
+                [1, 2, 3, 4])
+            m._unload_infolist('/tmp/b.zip')
+            self.assertEqual(
+                [f.ifile_size for f in m.reverse_mapping['file']], [1, 4])
+            self.assertEqual(
+                m.traverse('file').ifile_size, 4 if overwrite else 1)
+
+    def test_load_infolist_grouped(self):
+        # entries of the same directory, whether consecutive or not.
+        m = DefaultMapper()
+        m._load_infolist('/tmp/b.zip', [zipinfo('blocked', 1)])
+        m._load_infolist('/tmp/a.zip', [
+            zipinfo('a/b/file1', 1),
+            zipinfo('a/b/file2', 2),
+            zipinfo('blocked/file1', 3),
+            zipinfo('blocked/file2', 4),
+            zipinfo('a/file3', 5),
+            zipinfo('a/b/file4', 6),
+            zipinfo('file5', 7),
+        ])
+        self.assertEqual(m.mapping, {
+            'a': {
+                'b': {
+                    'file1': ('/tmp/a.zip', 'a/b/file1', 1),
+                    'file2': ('/tmp/a.zip', 'a/b/file2', 2),
+                    'file4': ('/tmp/a.zip', 'a/b/file4', 6),
+                },
+                'file3': ('/tmp/a.zip', 'a/file3', 5),
+            },
+            'blocked': ('/tmp/b.zip', 'blocked', 1),
+            'file5': ('/tmp/a.zip', 'file5', 7),
+        })
+        self.assertEqual(m.archive_ifilenames['/tmp/a.zip'], [
+            'a/b/file1', 'a/b/file2', 'blocked/file1', 'blocked/file2',
+            'a/file3', 'a/b/file4', 'file5'])
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+        self.assertTrue(gc.isenabled())
+
+    def test_load_infolist_replaced_dir(self):
+        m = DefaultMapper(overwrite=True)
+        m._load_infolist('/tmp/a.zip', [
+            zipinfo('x/a/file1', 1),
+            zipinfo('x/a', 2),
+            zipinfo('x/a/file2', 3),
+        ])
+        self.assertEqual(m.mapping, {'x': {'a': ('/tmp/a.zip', 'x/a', 2)}})
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+    def test_traverse_depth(self):
+        # lookups of deeply nested entries cost no more than the ones at
+        # the root, as they are done against the index of full paths.
+        m = DefaultMapper()
+        deep = '/'.join('dir%d' % i for i in range(200)) + '/file'
+        m._load_infolist('/tmp/archive.zip', [
+            IndexedInfo('file', 1, None),
+            IndexedInfo(deep, 1, None),
+        ])
+        walked = []
+        m._traverse = lambda frags: walked.append(frags)
+        self.assertEqual(m.traverse(deep), ('/tmp/archive.zip', deep, 1))
+        self.assertEqual(m.traverse('file'), ('/tmp/archive.zip', 'file', 1))
+        self.assertEqual(walked, [])
+
+
+class LazyMapperTestCase(unittest.TestCase):
+
+    def test_placeholder(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        self.assertTrue(m.load_archive(path('demo1.zip')))
+        self.assertTrue(m.load_archive(path('demo2.zip')))
+        self.assertEqual(
+            sorted(m.readdir('')), ['demo1.zip', 'demo2.zip'])
+        self.assertTrue(isinstance(m.mapping['demo1.zip'], ArchivePlaceholder))
+        self.assertEqual(sorted(m.archives.keys()), [
+            path('demo1.zip'), path('demo2.zip')])
+        # the directory itself does not need the archive to be parsed.
+        self.assertEqual(m.traverse('demo1.zip'), {})
+        self.assertEqual(len(m.pool), 0)
+        self.assertEqual(m.archive_ifilenames, {})
+
+        self.assertEqual(
+            m.traverse('demo1.zip/file1'),
+            (path('demo1.zip'), 'file1', 33))
+        self.assertFalse(
+            isinstance(m.mapping['demo1.zip'], ArchivePlaceholder))
+        self.assertEqual(list(m.archive_ifilenames.keys()), [
+            path('demo1.zip')])
+        self.assertEqual(m.readdir('demo2.zip'), ['demo'])
+        self.assertEqual(sorted(m.accessed.keys()), [
+            path('demo1.zip'), path('demo2.zip')])
+
+    def test_layout_not_lazy(self):
+        m = DefaultMapper(
+            include_arcname=True, lazy=True, pathmaker_name='flatten')
+        m.load_archive(path('demo2.zip'))
+        self.assertEqual(m.lazy_archives, {})
+        self.assertIn('demo2.zip_demo_file1', m.mapping)
+
+        m = DefaultMapper(lazy=True)
+        m.load_archive(path('demo1.zip'))
+        self.assertEqual(m.lazy_archives, {})
+        self.assertIn('file1', m.mapping)
+
+    def test_missing_and_bad(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        self.assertFalse(m.load_archive(path('no_such.zip')))
+        self.assertTrue(m.load_archive(path('bad.zip')))
+        self.assertIsNone(m.traverse('bad.zip/file'))
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.lazy_archives, {})
+
+    def test_dropped(self):
+        dropped = []
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        m.on_dropped = dropped.append
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('bad.zip'))
+        self.assertIsNone(m.traverse('bad.zip/file'))
+        self.assertEqual(dropped, [path('bad.zip')])
+        # unloading what was already dropped leaves the rest alone.
+        m.unload_archive(path('bad.zip'))
+        self.assertEqual(list(m.mapping.keys()), ['demo1.zip'])
+        self.assertEqual(list(m.archives.keys()), [path('demo1.zip')])
+
+    def test_pathmaker_failure(self):
+        def failing(inner_path):
+            if inner_path == 'demo1.zip/file4':
+                raise UnicodeDecodeError('utf8', b'\xff', 0, 1, 'invalid')
+            frags = inner_path.split('/')
+            return frags, frags.pop()
+
+        m = DefaultMapper(include_arcname=True, lazy=True, _pathmaker=failing)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('demo2.zip'))
+        self.assertIsNone(m.traverse('demo1.zip/file1'))
+        self.assertEqual(list(m.mapping.keys()), ['demo2.zip'])
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+        self.assertEqual(list(m.archives.keys()), [path('demo2.zip')])
+        self.assertEqual(list(m.lazy_archives.keys()), [path('demo2.zip')])
+        self.assertEqual(dict(m.reverse_mapping), {})
+        m.unload_archive(path('demo1.zip'))
+        self.assertEqual(list(m.archives.keys()), [path('demo2.zip')])
+
+    def test_unload(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('demo2.zip'))
+        m.unload_archive(path('demo1.zip'))
+        self.assertEqual(list(m.mapping.keys()), ['demo2.zip'])
+        m.traverse('demo2.zip/demo/file1')
+        m.unload_archive(path('demo2.zip'))
+        self.assertEqual(m.mapping, {})
+        self.assertEqual(m.archives, {})
+        self.assertEqual(m.lazy_archives, {})
+        self.assertEqual(m.lazy_names, {})
+        self.assertEqual(m.accessed, {})
+
+    def test_shared_name(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(tmpdir))
+        os.mkdir(join(tmpdir, 'alt'))
+        target = join(tmpdir, 'alt', 'demo1.zip')
+        with ZipFile(target, 'w') as zf:
+            zf.writestr('file1', b'replaced')
+            zf.writestr('file7', b'new')
+
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(target)
+        # the first archive is loaded, as both share the directory.
+        self.assertEqual(m.lazy_archives, {})
+        self.assertEqual(
+            m.traverse('demo1.zip/file1'), (path('demo1.zip'), 'file1', 33))
+        self.assertEqual(
+            m.traverse('demo1.zip/file7'), (target, 'file7', 3))
+
+    def test_hibernate(self):
+        m = DefaultMapper(include_arcname=True, lazy=True)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('demo2.zip'))
+        m.traverse('demo1.zip/file1')
+        m.traverse('demo2.zip/demo/file1')
+        m.accessed[path('demo1.zip')] -= 100
+        m.hibernate(50)
+        self.assertTrue(isinstance(m.mapping['demo1.zip'], ArchivePlaceholder))
+        self.assertFalse(
+            isinstance(m.mapping['demo2.zip'], ArchivePlaceholder))
+        self.assertEqual(list(m.archive_ifilenames.keys()), [
+            path('demo2.zip')])
+        self.assertEqual(sorted(m.archives.keys()), [
+            path('demo1.zip'), path('demo2.zip')])
+        self.assertNotIn('demo1.zip/file1', m.reverse_mapping)
+
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+        # loaded again when needed.
+        self.assertEqual(
+            m.traverse('demo1.zip/file1'),
+            (path('demo1.zip'), 'file1', 33))
+        self.assertEqual(m.nodes, walk_nodes(m.mapping))
+
+    def test_hibernate_after(self):
+        m = DefaultMapper(include_arcname=True, lazy=True, hibernate=50)
+        m.load_archive(path('demo1.zip'))
+        m.load_archive(path('demo2.zip'))
+        m.traverse('demo1.zip/file1')
+        m.traverse('demo2.zip/demo/file1')
+        m.accessed[path('demo1.zip')] -= 100
+        m.traverse('demo2.zip/demo/file1')
+        self.assertFalse(
+            isinstance(m.mapping['demo1.zip'], ArchivePlaceholder))
+        m.hibernate_checked -= 100
+        m.traverse('demo2.zip/demo/file1')
+        self.assertTrue(isinstance(m.mapping['demo1.zip'], ArchivePlaceholder))
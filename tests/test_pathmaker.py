@@ -14,6 +14,10 @@ class PathmakerTestCase(unittest.TestCase):
 
         for path, output in pairs:
             self.assertEqual(func(path), output)
+        # the batch form produces the same output.
+        self.assertEqual(
+            func.batch([path for path, output in pairs]),
+            [output for path, output in pairs])
 
     def test_codepage(self):
         with self.assertRaises(ValueError) as cm:
@@ -98,6 +102,21 @@ class PathmakerTestCase(unittest.TestCase):
             ('path/to/some/file', (['to', 'some'], 'file')),
         ])
 
+    def test_batch_shared(self):
+        paths = ['a/b/file1', 'a/b/file2', 'c/file3', 'a/b/file4', 'file5']
+        for func in (pathmaker.default(), pathmaker.junk('1'),
+                pathmaker.codepage('utf8')):
+            result = func.batch(paths)
+            self.assertEqual(result, [func(path) for path in paths])
+            self.assertIs(result[0][0], result[1][0])
+            self.assertIs(result[0][0], result[3][0])
+
+    def test_codepage_stateful(self):
+        # paths in these encodings are only recoded as a whole.
+        self.assertFalse(hasattr(pathmaker.codepage('utf-7'), 'batch'))
+        self.assertFalse(
+            hasattr(pathmaker.codepage('utf8', 'utf-16-le'), 'batch'))
+
 
 class ProcessArgTestCase(unittest.TestCase):
 
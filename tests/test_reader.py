@@ -0,0 +1,390 @@
+import unittest
+import tempfile
+import shutil
+import zlib
+from io import BytesIO
+from os.path import join
+from zipfile import ZipFile
+import zipfile
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+
+from explosive.fuse.archive import ArchiveFile
+from explosive.fuse.exception import BadArchiveFile
+from explosive.fuse.reader import CheckpointStore
+from explosive.fuse.reader import DeflateReader
+from explosive.fuse.reader import MemoryReader
+from explosive.fuse.reader import ReadAhead
+from explosive.fuse.reader import SharedReader
+from explosive.fuse.reader import StoredReader
+from explosive.fuse.reader import StreamReader
+
+
+def make_data(size):
+    # compressible, but not trivially so.
+    lines = []
+    total = 0
+    n = 0
+    while total < size:
+        line = ('%d %x %o\n' % (n, n * 7919, n * 104729)).encode('ascii')
+        lines.append(line)
+        total += len(line)
+        n += 1
+    return b''.join(lines)[:size]
+
+
+def make_zip(target, entries, compression=ZIP_DEFLATED):
+    with ZipFile(target, 'w', compression) as zf:
+        for name, data in entries:
+            zf.writestr(name, data)
+
+
+def corrupt_crc(target):
+    # flip the CRC-32 recorded in the central directory of an archive
+    # holding a single entry.
+    with ZipFile(target) as zf:
+        offset = zf.start_dir + 16
+    with open(target, 'r+b') as fd:
+        fd.seek(offset)
+        crc = bytearray(fd.read(4))
+        crc[0] ^= 0xff
+        fd.seek(offset)
+        fd.write(bytes(crc))
+
+
+class CheckpointStoreTestCase(unittest.TestCase):
+
+    def test_record_interval(self):
+        store = CheckpointStore(interval=10, cost=1)
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        store.record('key', 0, 0, d)
+        store.record('key', 5, 1, d)
+        store.record('key', 10, 2, d)
+        store.record('key', 15, 3, d)
+        store.record('key', 21, 4, d)
+        index = store.index('key')
+        self.assertEqual(index.offsets, [10, 21])
+        self.assertEqual(store.used, 2)
+        self.assertIsNone(index.nearest(9))
+        self.assertEqual(index.nearest(10).coffset, 2)
+        self.assertEqual(index.nearest(20).coffset, 2)
+        self.assertEqual(index.nearest(99).coffset, 4)
+
+    def test_budget_evict_lru(self):
+        store = CheckpointStore(budget=3, interval=10, cost=1)
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        store.record('a', 10, 0, d)
+        store.record('a', 20, 0, d)
+        store.record('b', 10, 0, d)
+        store.record('b', 20, 0, d)
+        self.assertEqual(list(store.indexes.keys()), ['b'])
+        self.assertEqual(store.used, 2)
+
+    def test_budget_thin(self):
+        store = CheckpointStore(budget=3, interval=10, cost=1)
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        for offset in (10, 20, 30, 40):
+            store.record('a', offset, 0, d)
+        index = store.index('a')
+        self.assertEqual(index.offsets, [20, 40])
+        self.assertEqual(index.interval, 20)
+        self.assertEqual(store.used, 2)
+
+    def test_budget_zero(self):
+        store = CheckpointStore(budget=0, interval=10, cost=1)
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+        store.record('a', 10, 0, d)
+        self.assertEqual(len(store.index('a')), 0)
+        self.assertEqual(store.used, 0)
+
+
+class ReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = make_data(3000000)
+        self.target = join(self.tmpdir, 'deflated.zip')
+        make_zip(self.target, [
+            ('small.txt', b'hello world\n'),
+            ('large.txt', self.data),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_open_reader_deflated(self):
+        store = CheckpointStore(interval=1 << 18)
+        with ArchiveFile(self.target) as af:
+            reader = af.open_reader('large.txt', store)
+        self.assertTrue(isinstance(reader, DeflateReader))
+        self.assertEqual(reader.read(), self.data)
+        # checkpoints recorded along the way.
+        self.assertTrue(len(store.index(reader.key)) >= 8)
+        reader.close()
+        self.assertTrue(reader.closed)
+        self.assertTrue(reader.fp.closed)
+
+    def test_deflate_random_access(self):
+        store = CheckpointStore(interval=1 << 18)
+        with ArchiveFile(self.target) as af:
+            reader = af.open_reader('large.txt', store)
+        self.addCleanup(reader.close)
+
+        self.assertEqual(reader.pread(10, 2999995), self.data[2999995:])
+        for offset in (1234567, 5, 2500000, 262144, 262143, 0, 2999999):
+            self.assertEqual(
+                reader.pread(4096, offset), self.data[offset:offset + 4096])
+        self.assertEqual(reader.pread(10, 3000000), b'')
+
+        # a backward seek resumes from the nearest checkpoint.
+        reader.pread(1, 2900000)
+        coffsets = []
+        read = reader._read
+
+        def track(size, coffset):
+            coffsets.append(coffset)
+            return read(size, coffset)
+
+        reader._read = track
+        self.assertEqual(reader.pread(1, 1300000), self.data[1300000:1300001])
+        checkpoint = store.index(reader.key).nearest(1300000)
+        self.assertTrue(checkpoint.offset > 1000000)
+        self.assertEqual(min(coffsets), checkpoint.coffset)
+
+    def test_deflate_mmap(self):
+        store = CheckpointStore(interval=1 << 18)
+        with ArchiveFile(self.target, use_mmap=True) as af:
+            reader = af.open_reader('large.txt', store)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.pread(10, 2999995), self.data[2999995:])
+        for offset in (1234567, 5, 2500000, 0):
+            self.assertEqual(
+                reader.pread(4096, offset), self.data[offset:offset + 4096])
+        self.assertEqual(reader.read(), self.data)
+
+    def test_deflate_truncated(self):
+        with ArchiveFile(self.target) as af:
+            info = af.archive_file.getinfo('large.txt')
+            reader = af.open_reader('large.txt')
+        self.addCleanup(reader.close)
+        reader.compress_size = info.compress_size // 2
+        with self.assertRaises(BadArchiveFile):
+            reader.pread(10, 2999990)
+
+    def test_bad_crc(self):
+        for compression in (ZIP_DEFLATED, ZIP_STORED):
+            target = join(self.tmpdir, 'crc.zip')
+            make_zip(target, [('file', self.data)], compression=compression)
+            with ArchiveFile(target) as af:
+                reader = af.open_reader('file')
+            self.assertEqual(reader.read(), self.data)
+            reader.close()
+
+            corrupt_crc(target)
+            with ArchiveFile(target) as af:
+                reader = af.open_reader('file')
+            self.addCleanup(reader.close)
+            # only checked once the data was read through to the end.
+            self.assertEqual(reader.pread(10, 0), self.data[:10])
+            self.assertEqual(reader.pread(10, 2999990), self.data[-10:])
+            with self.assertRaises(BadArchiveFile):
+                reader.read()
+            with self.assertRaises(BadArchiveFile):
+                reader.pread(10, 0)
+
+    def test_open_reader_stored(self):
+        target = join(self.tmpdir, 'stored.zip')
+        make_zip(target, [
+            ('empty', b''),
+            ('file', b'0123456789'),
+        ], compression=ZIP_STORED)
+        with ArchiveFile(target) as af:
+            reader = af.open_reader('file')
+            # resolved once, then cached.
+            self.assertEqual(
+                list(af.data_offsets.keys()), ['file'])
+            self.assertEqual(
+                af.open_reader('file').data_offset, reader.data_offset)
+            empty = af.open_reader('empty')
+        self.assertTrue(isinstance(reader, StoredReader))
+        self.assertEqual(reader.pread(2, 4), b'45')
+        self.assertEqual(reader.pread(2, 1), b'12')
+        self.assertEqual(reader.pread(20, 8), b'89')
+        self.assertEqual(reader.pread(2, 10), b'')
+        reader.seek(8)
+        self.assertEqual(reader.read(), b'89')
+        reader.close()
+        self.assertTrue(reader.closed)
+        self.assertTrue(reader.fp.closed)
+
+        self.assertEqual(empty.read(), b'')
+        empty.close()
+
+    def test_open_reader_stored_mmap(self):
+        target = join(self.tmpdir, 'stored.zip')
+        make_zip(target, [('file', b'0123456789')], compression=ZIP_STORED)
+        with ArchiveFile(target, use_mmap=True) as af:
+            reader = af.open_reader('file')
+        self.assertTrue(isinstance(reader, StoredReader))
+        self.assertEqual(reader.pread(2, 4), b'45')
+        self.assertTrue(isinstance(reader.pread(2, 4), bytes))
+        self.assertEqual(reader.pread(20, 8), b'89')
+        reader.close()
+
+    def test_open_reader_bad_local_header(self):
+        target = join(self.tmpdir, 'stored.zip')
+        make_zip(target, [('file', b'0123456789')], compression=ZIP_STORED)
+        with open(target, 'r+b') as fd:
+            fd.write(b'XX')
+        with ArchiveFile(target) as af:
+            with self.assertRaises(BadArchiveFile):
+                af.open_reader('file')
+
+    @unittest.skipIf(
+        not hasattr(zipfile, 'ZIP_BZIP2'), reason='bzip2 not supported')
+    def test_open_reader_bzip2(self):
+        target = join(self.tmpdir, 'bzip2.zip')
+        make_zip(target, [('file', self.data)], compression=zipfile.ZIP_BZIP2)
+        with ArchiveFile(target) as af:
+            reader = af.open_reader('file')
+        self.addCleanup(reader.close)
+        self.assertTrue(isinstance(reader, StreamReader))
+        self.assertEqual(reader.pread(5, 2000000), self.data[2000000:2000005])
+        self.assertEqual(reader.pread(5, 1000000), self.data[1000000:1000005])
+
+
+class StreamReaderTestCase(unittest.TestCase):
+
+    def test_reopen(self):
+        opened = []
+
+        def opener():
+            opened.append(1)
+            return BytesIO(b'0123456789')
+
+        reader = StreamReader(opener, 10)
+        self.assertEqual(reader.pread(3, 2), b'234')
+        self.assertEqual(reader.pread(3, 5), b'567')
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(reader.pread(3, 0), b'012')
+        self.assertEqual(len(opened), 2)
+        self.assertEqual(reader.pread(3, 20), b'')
+
+
+class SharedReaderTestCase(unittest.TestCase):
+
+    def test_refs(self):
+        reader = StreamReader(lambda: BytesIO(b'0123456789'), 10, key='k')
+        shared = SharedReader(lambda: reader)
+        self.assertIs(shared.acquire(), shared)
+        self.assertTrue(shared.open())
+        self.assertEqual(shared.size, 10)
+        self.assertEqual(shared.key, 'k')
+        self.assertTrue(shared.cacheable)
+        self.assertFalse(shared.shareable)
+        shared.acquire()
+        self.assertFalse(shared.open())
+        self.assertEqual(shared.pread(3, 2), b'234')
+        self.assertFalse(shared.release())
+        self.assertFalse(reader.closed)
+        self.assertEqual(shared.pread(3, 5), b'567')
+        self.assertTrue(shared.release())
+        self.assertTrue(reader.closed)
+        self.assertTrue(shared.closed)
+        # nothing more may take a reference once closed.
+        self.assertIsNone(shared.acquire())
+
+    def test_open_failure(self):
+        shared = SharedReader(lambda: False).acquire()
+        self.assertTrue(shared.open())
+        self.assertIs(shared.reader, False)
+        self.assertFalse(shared.open())
+        self.assertTrue(shared.release())
+
+    def test_release_during_read(self):
+        # the references are not held up by a read in progress.
+        shared = SharedReader(lambda: MemoryReader(b'data'))
+        shared.acquire()
+        shared.acquire()
+        shared.open()
+        with shared.lock:
+            self.assertFalse(shared.release())
+
+
+class ReadAheadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data = make_data(100000)
+        self.fetches = []
+
+    def fetch(self, size, offset):
+        self.fetches.append((size, offset))
+        return self.data[offset:offset + size]
+
+    def test_sequential(self):
+        ra = ReadAhead(self.fetch, len(self.data), maximum=4000, initial=1000)
+        self.addCleanup(ra.close)
+        self.assertEqual(ra.pread(100, 0), self.data[:100])
+        self.assertIsNone(ra.worker)
+        self.assertEqual(ra.pread(100, 100), self.data[100:200])
+        # read-ahead started.
+        ra.worker.join()
+        self.assertEqual(ra.window, 1000)
+        self.assertEqual(self.fetches, [(100, 0), (100, 100), (1000, 200)])
+        self.assertEqual(ra.buffer_offset, 200)
+        self.assertEqual(len(ra.buffer), 1000)
+
+        offset = 200
+        while offset < 5000:
+            self.assertEqual(
+                ra.pread(100, offset), self.data[offset:offset + 100])
+            offset += 100
+        ra.worker.join()
+        # the window grew to the maximum, and every read after the
+        # second was served from the buffer.
+        self.assertEqual(ra.window, 4000)
+        self.assertEqual(self.fetches[:2], [(100, 0), (100, 100)])
+        self.assertEqual(
+            [size for size, offset in self.fetches[2:]], [1000, 2000, 4000])
+        self.assertTrue(len(ra.buffer) <= 8000)
+
+    def test_seek_drops(self):
+        ra = ReadAhead(self.fetch, len(self.data), maximum=4000, initial=1000)
+        self.addCleanup(ra.close)
+        ra.pread(100, 0)
+        ra.pread(100, 100)
+        ra.pread(100, 200)
+        ra.worker.join()
+        self.assertTrue(ra.buffer)
+
+        self.assertEqual(ra.pread(100, 50000), self.data[50000:50100])
+        self.assertEqual(ra.window, 0)
+        self.assertEqual(ra.buffer, b'')
+        self.assertEqual(self.fetches[-1], (100, 50000))
+        # sequential access has to be detected again.
+        self.assertEqual(ra.pread(100, 50100), self.data[50100:50200])
+        self.assertEqual(self.fetches[-1], (100, 50100))
+        self.assertEqual(ra.pread(100, 50200), self.data[50200:50300])
+        ra.worker.join()
+        self.assertEqual(ra.buffer_offset, 50300)
+        self.assertEqual(ra.window, 1000)
+
+    def test_end_of_entry(self):
+        ra = ReadAhead(self.fetch, len(self.data), maximum=4000, initial=1000)
+        self.addCleanup(ra.close)
+        offset = 90000
+        while offset < len(self.data):
+            self.assertEqual(
+                ra.pread(4096, offset), self.data[offset:offset + 4096])
+            offset += 4096
+        self.assertEqual(ra.pread(4096, offset), b'')
+        ra.close()
+        self.assertTrue(all(o < len(self.data) for s, o in self.fetches))
+
+    def test_disabled(self):
+        ra = ReadAhead(self.fetch, len(self.data), maximum=0)
+        for offset in range(0, 1000, 100):
+            self.assertEqual(
+                ra.pread(100, offset), self.data[offset:offset + 100])
+        self.assertIsNone(ra.worker)
+        self.assertEqual(len(self.fetches), 10)
@@ -0,0 +1,115 @@
+import unittest
+from time import mktime
+from zipfile import ZipFile
+from zipfile import ZipInfo
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
+from os.path import dirname
+from os.path import join
+
+from explosive.fuse.index import IndexedInfo
+from explosive.fuse.table import ArchiveTable
+from explosive.fuse.table import UNKNOWN
+from explosive.fuse.table import pack_date_time
+from explosive.fuse.table import unpack_date_time
+
+path = lambda p: join(dirname(__file__), 'data', p)
+
+
+def zipinfo(name, size, compress_size, compress_type):
+    zi = ZipInfo(name, date_time=(2001, 2, 3, 4, 5, size % 60))
+    zi.file_size = size
+    zi.compress_size = compress_size
+    zi.compress_type = compress_type
+    zi.CRC = size * 7
+    return zi
+
+
+class ArchiveTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.table = ArchiveTable.from_infolist([
+            zipinfo('dir/', 0, 0, ZIP_STORED),
+            zipinfo('dir/small', 10, 10, ZIP_STORED),
+            zipinfo(u'dir/é', 1000, 100, ZIP_DEFLATED),
+            zipinfo('large', 5000, 300, ZIP_DEFLATED),
+        ])
+
+    def test_columns(self):
+        table = self.table
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table.name(2), u'dir/é')
+        self.assertEqual(
+            table.names(), ['dir/', 'dir/small', u'dir/é', 'large'])
+        self.assertEqual(list(table.column('crc')), [0, 70, 7000, 35000])
+        self.assertEqual(list(table.column('data_offset')), [UNKNOWN] * 4)
+
+    def test_aggregates(self):
+        table = self.table
+        self.assertEqual(table.total(), 6010)
+        self.assertEqual(table.total('compress_size'), 410)
+        self.assertEqual(table.total('data_offset'), 0)
+        self.assertEqual(table.larger_than(10), [u'dir/é', 'large'])
+        self.assertEqual(table.select('file_size', 1, 1000), [1, 2])
+        self.assertEqual(table.count_by(), {ZIP_STORED: 2, ZIP_DEFLATED: 2})
+        self.assertEqual(
+            table.total_by(), {ZIP_STORED: 10, ZIP_DEFLATED: 6000})
+        self.assertEqual(
+            table.total_by('compress_size'),
+            {ZIP_STORED: 10, ZIP_DEFLATED: 400})
+
+    def test_date_time(self):
+        self.assertLess(
+            pack_date_time((2001, 2, 3, 4, 5, 59)),
+            pack_date_time((2001, 2, 3, 4, 6, 0)))
+        self.assertEqual(
+            unpack_date_time(pack_date_time((2001, 2, 3, 4, 5, 6))),
+            mktime((2001, 2, 3, 4, 5, 6, 0, 0, -1)))
+
+    def test_mtime(self):
+        table = self.table
+        self.assertEqual(table.row('dir/small'), 1)
+        self.assertIsNone(table.row('nowhere'))
+        self.assertEqual(
+            table.mtime('dir/small'), mktime((2001, 2, 3, 4, 5, 10, 0, 0, -1)))
+        self.assertIsNone(table.mtime('nowhere'))
+        # rows of names added after the lookup are found.
+        table.names_list.append('late')
+        self.assertEqual(table.row('late'), 4)
+
+    def test_row_duplicates(self):
+        table = ArchiveTable.from_infolist([
+            zipinfo('file', 1, 1, ZIP_STORED),
+            zipinfo('file', 2, 2, ZIP_STORED),
+        ])
+        # the first of these, unless the last is taken as the visible one.
+        self.assertEqual(table.row('file'), 0)
+        table.sort(last=True)
+        self.assertEqual(table.row('file'), 1)
+        self.assertIsNone(table.row('nowhere'))
+        self.assertEqual(
+            table.mtime('file'), mktime((2001, 2, 3, 4, 5, 2, 0, 0, -1)))
+
+    def test_partial_info(self):
+        table = ArchiveTable.from_infolist([
+            IndexedInfo('file1', 33, 40),
+            IndexedInfo('file2', 66, None),
+        ])
+        self.assertEqual(list(table.column('data_offset')), [40, UNKNOWN])
+        self.assertEqual(table.total('compress_size'), 0)
+        self.assertEqual(table.count_by(), {UNKNOWN: 2})
+        self.assertIsNone(table.mtime('file1'))
+
+    def test_empty(self):
+        table = ArchiveTable.from_infolist([])
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.total(), 0)
+        self.assertEqual(table.larger_than(0), [])
+        self.assertEqual(table.count_by(), {})
+
+    def test_archive(self):
+        with ZipFile(path('demo2.zip')) as zf:
+            table = ArchiveTable.from_infolist(zf.infolist())
+        self.assertEqual(len(table), 7)
+        self.assertEqual(table.total(), 198)
+        self.assertEqual(sorted(table.larger_than(0))[0], 'demo/file1')